@@ -0,0 +1,71 @@
+'''Microbenchmark of the attribute access on ChemicalEntity.
+
+Compare the throughput of getting and setting System attributes (by
+name and by alias) with the one of a plain Python attribute::
+
+    python benchmarks/bench_attribute_access.py [n_iterations]
+
+Each case is checked against a limit on its cost relative to the plain
+attribute access, the script exits with an error if any is exceeded.
+
+'''
+from __future__ import print_function
+import itertools
+import sys
+import timeit
+
+import numpy as np
+
+from chemlab.core import System
+
+
+class Plain(object):
+    pass
+
+
+# Maximum cost of each case, as a multiple of the plain get or set
+LIMITS = {'get': 40, 'set': 50}
+
+
+def main(number=200000):
+    s = System.from_arrays(r_array=np.random.random((30, 3)),
+                           type_array=['O', 'H', 'H'] * 10,
+                           maps={('atom', 'molecule'): np.repeat(np.arange(10), 3)})
+    r = np.random.random((30, 3))
+
+    p = Plain()
+    p.r_array = r
+
+    namespace = {'s': s, 'p': p, 'r': r, 'arrays': itertools.cycle([r, r.copy()])}
+    # Each case is compared with the plain access in the third column
+    cases = [('plain get', 'p.r_array', None),
+             ('plain set', 'p.r_array = r', None),
+             ('plain set (new array)', 'p.r_array = next(arrays)', None),
+             ('get s.r_array', 's.r_array', 'plain get'),
+             ('get s.coords (alias)', 's.coords', 'plain get'),
+             ('set s.r_array', 's.r_array = r', 'plain set'),
+             ('set s.coords (alias)', 's.coords = r', 'plain set'),
+             ('set s.r_array (new array)', 's.r_array = next(arrays)', 'plain set (new array)'),
+             ('get s.box_vectors (field)', 's.box_vectors', 'plain get')]
+
+    timings = {}
+    failed = []
+    for name, stmt, reference in cases:
+        elapsed = min(timeit.repeat(stmt, globals=namespace, number=number, repeat=3))
+        timings[name] = elapsed
+        ratio = ''
+        if reference is not None:
+            ratio = elapsed / timings[reference]
+            if ratio > LIMITS[name.split()[0]]:
+                failed.append(name)
+            ratio = '{:6.1f}x plain'.format(ratio)
+
+        print('{:<28} {:10.0f} ops/s  ({:.2f} us/op) {}'
+              .format(name, number / elapsed, elapsed / number * 1e6, ratio))
+
+    if failed:
+        sys.exit('Slower than the limits: {}'.format(', '.join(failed)))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
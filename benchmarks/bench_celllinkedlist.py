@@ -0,0 +1,62 @@
+'''Benchmark the CellLinkedList queries, that return arrays or a CSR
+matrix, against filling a scipy.sparse.dok_matrix one pair at a time
+(as query_distances_other used to do).
+
+Run from the repository root::
+
+    python benchmarks/bench_celllinkedlist.py [n_points]
+
+'''
+from __future__ import print_function
+import sys
+import time
+
+import numpy as np
+from scipy.sparse import dok_matrix
+
+from chemlab.utils.celllinkedlist import CellLinkedList
+
+
+def legacy_dok(n_points, i, j, d):
+    '''Insert the pairs in a dok_matrix one by one, kept here for reference'''
+    ret = dok_matrix((n_points, n_points), dtype=np.double)
+    for a, b, dist in zip(i, j, d):
+        ret[a, b] = dist
+    return ret
+
+
+def timeit(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+def main(n_points=20000, cutoff=0.35):
+    # Liquid-like density, 100 points per nm^3
+    size = (n_points / 100.0) ** (1.0 / 3.0)
+    coords = np.random.uniform(0, size, (n_points, 3))
+    periodic = np.array([size, size, size])
+
+    t_build, cl = timeit(CellLinkedList, coords, cutoff, periodic)
+    print('{} points, cutoff {}, build {:.4f} s'.format(n_points, cutoff, t_build))
+
+    t_pairs, (i, j, d) = timeit(cl.query_pairs, cutoff, cl)
+    t_ball, csr = timeit(cl.query_ball, cl, cutoff)
+    t_count, counts = timeit(cl.count_within, cl, cutoff)
+    t_half, half = timeit(cl.query_pairs, cutoff)
+    t_old, dok = timeit(legacy_dok, n_points, i, j, d)
+
+    assert csr.nnz == len(d) == counts.sum() == 2 * len(half[0]) + n_points
+
+    n_pairs = len(d)
+    for name, t in [('dok_matrix, pair by pair', t_old),
+                    ('query_pairs (i, j, dist)', t_pairs),
+                    ('query_ball (CSR)', t_ball),
+                    ('count_within', t_count),
+                    ('query_pairs, i < j', t_half)]:
+        print('{:<26} {:8.4f} s   {:8.2f} M pairs/s   ({:.0f}x)'
+              .format(name, t, n_pairs / t / 1e6, t_old / t))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,44 @@
+'''Measure the time taken to import the chemlab modules, and list the
+optional dependencies that each import loads.
+
+Each module is imported in a fresh interpreter, after numpy (which is
+always needed). Run from the repository root::
+
+    python benchmarks/bench_import.py [module ...]
+
+'''
+from __future__ import print_function
+import os
+import sys
+
+# The import check is shared with the tests
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tests.test_import import run_import
+
+
+MODULES = ['chemlab', 'chemlab.core', 'chemlab.io', 'chemlab.db',
+           'chemlab.table', 'chemlab.utils']
+
+
+def import_time(module, repeat=5):
+    '''Return the best time to import *module* in a new interpreter,
+    the heavy dependencies it loaded and whether it parsed the element
+    table.
+
+    '''
+    best = None
+    for i in range(repeat):
+        elapsed, loaded, parsed = run_import(module)
+        best = elapsed if best is None else min(best, elapsed)
+    return best, loaded, parsed
+
+
+def main(modules=MODULES):
+    for module in modules:
+        elapsed, loaded, parsed = import_time(module)
+        print('{:<15} {:8.1f} ms   element table parsed: {:<5}   heavy: {}'
+              .format(module, elapsed * 1000, str(parsed), ', '.join(loaded) or '-'))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:] or MODULES)
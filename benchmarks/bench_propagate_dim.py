@@ -0,0 +1,95 @@
+'''Benchmark ChemicalEntity._propagate_dim against the previous,
+set-based, implementation.
+
+Run from the repository root::
+
+    python benchmarks/bench_propagate_dim.py [n_molecules]
+
+'''
+from __future__ import print_function
+import sys
+import time
+from collections import defaultdict
+
+import numpy as np
+
+from chemlab.core import System
+from chemlab.core.base import normalize_index
+
+
+def legacy_propagate_dim(entity, index, dimension, propagate=True):
+    '''The set-based implementation, kept here for reference'''
+    index = normalize_index(index)
+    
+    result = defaultdict(set)
+    for dim in entity.dimensions:
+        result[dim] |= set(range(entity.dimensions[dim]))
+    
+    result[dimension] &= set(index)
+    
+    for rel in entity.__relations__.values():
+        if rel.map == dimension:
+            result[rel.dim] &= set(rel.argfilter(index))
+    
+    for (a, b), rel in entity.maps.items():
+        if not propagate: continue
+        
+        if a == dimension:
+            result[b] &= set(np.unique(rel.sub(index).value))
+            prop = legacy_propagate_dim(entity, np.array(sorted(result[b]), 'int'), b)
+            for r in result:
+                result[r] &= set(prop[r])
+        
+        if b == dimension:
+            result[rel.dim] &= set(rel.argfilter(index))
+    
+    return {k: np.array(sorted(v), 'int') for k, v in result.items()}
+
+
+def water_system(n_mol):
+    bonds = np.array([[0, 1], [0, 2]])[np.newaxis] + 3 * np.arange(n_mol)[:, np.newaxis, np.newaxis]
+    return System.from_arrays(type_array=np.tile(['O', 'H', 'H'], n_mol),
+                              r_array=np.random.random((3 * n_mol, 3)),
+                              bonds=bonds.reshape(-1, 2),
+                              maps={('atom', 'molecule'): np.repeat(np.arange(n_mol), 3),
+                                    ('bond', 'molecule'): np.repeat(np.arange(n_mol), 2)})
+
+
+def timeit(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+def main(n_mol=100000):
+    s = water_system(n_mol)
+    print('System with {} atoms'.format(s.n_atoms))
+    
+    cases = [('every other molecule', np.arange(0, n_mol, 2), 'molecule'),
+             ('oxygen atoms', s.type_array == 'O', 'atom'),
+             ('first half of the bonds', np.arange(n_mol), 'bond')]
+    
+    for name, index, dim in cases:
+        t_old, old = timeit(legacy_propagate_dim, s, index, dim)
+        t_new, new = timeit(s._propagate_dim, index, dim)
+        
+        for k in old:
+            assert np.array_equal(old[k], new[k]), k
+        
+        print('{:<25} legacy {:8.3f} s   vectorized {:8.4f} s   ({:.0f}x)'
+              .format(name, t_old, t_new, t_old/t_new))
+    
+    for name, kwargs in [('where(type_array=O)', {'type_array': 'O'}),
+                         ('sub(molecule_index=...)', {'molecule_index': np.arange(0, n_mol, 2)})]:
+        func = s.where if name.startswith('where') else s.sub
+        start = time.time()
+        func(**kwargs)
+        print('{:<25} {:8.4f} s'.format(name, time.time() - start))
+    
+    start = time.time()
+    s.atom_to_molecule_indices(np.arange(0, s.n_atoms, 7))
+    print('{:<25} {:8.4f} s'.format('atom_to_molecule_indices', time.time() - start))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
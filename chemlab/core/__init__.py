@@ -4,7 +4,8 @@ from .atom import Atom
 
 from .system import (subsystem_from_molecules,
                      subsystem_from_atoms,
-                     merge_systems)
+                     merge_systems,
+                     solvate)
 from .trajectory import Trajectory
 from .spacegroup.crystal import crystal
 from .random import random_lattice_box, random_box
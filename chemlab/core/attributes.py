@@ -1,3 +1,5 @@
+import copy
+import weakref
 import numpy as np
 import six.moves
 from six import string_types
@@ -21,6 +23,16 @@ class Attribute(EntityProperty):
     def create(self, name):
         return InstanceAttribute(name, self.shape, self.dtype, self.dim, self.alias)
 
+class CategoricalAttribute(Attribute):
+    def __init__(self, dim=None, alias=None):
+        '''An array of strings that belong to the current
+        ChemicalEntity, for example atom types. The strings are
+        stored as integer codes into a table of categories.'''
+        super(CategoricalAttribute, self).__init__(dtype='unicode', dim=dim, alias=alias)
+    
+    def create(self, name):
+        return InstanceCategoricalAttribute(name, self.shape, self.dtype, self.dim, self.alias)
+
 class Relation(EntityProperty):
     def __init__(self, map=None, dim=None, alias=None, shape=None):
         '''An array of values that connects items belonging to the same dimension'''
@@ -56,6 +68,26 @@ class InstanceProperty(object):
     '''Instanced version of EntityProperty'''
 
 class InstanceArray(InstanceProperty):
+    
+    _value = None
+    
+    # Pending (function, size) pair for arrays created with view()
+    _lazy = None
+    
+    # Storage with spare capacity, the value is a prefix of it 
+    _buffer = None
+    
+    # Arrays sharing the same value, see _share
+    _shared = None
+    
+    # Whether the storage was allocated here. Arrays passed by the
+    # caller are stored without copying, and they are never modified
+    # in place by reorder.
+    _owned = False
+    
+    # Whether arrays outside may refer to the storage (it was returned
+    # by value, or passed by the caller), see _share
+    _exposed = False
 
     def empty(self, size, inplace=True):
         # If it is its own dimension, we need shape 1
@@ -65,57 +97,297 @@ class InstanceArray(InstanceProperty):
             shape = (size,) + self.shape if self.shape else (size,)
             value = np.zeros(shape, dtype=self.dtype)
         
-        if inplace:
-            self.value = value
-        else:
-            obj = self.copy()
-            obj.value = value.copy()
+        obj = self if inplace else self._shallow_copy()
+        obj.value = value
+        # The zeros are not referred to by anything else
+        obj._owned = True
+        obj._exposed = False
+        if not inplace:
             return obj
     
+    def shrink_to_fit(self):
+        """Release the extra memory reserved by append operations."""
+        if self._buffer is not None:
+            self._value = self._value.copy()
+            self._owned = True
+            self._exposed = False
+            self._buffer = None
+    
+    def _extend(self, values):
+        # Append values to the current value, reserving extra capacity
+        # so that repeated appends take amortized constant time.
+        dtype = self._value.dtype
+        if self.dtype is None or dtype.kind in 'SU':
+            # Values may require a larger type
+            dtype = np.promote_types(dtype, values.dtype)
+        
+        self._buffer, self._value = extend_buffer(self._buffer, self._value, 
+                                                  values, dtype)
+        self._owned = True
+    
+    def _shallow_copy(self):
+        # Copy that shares the value but not the spare capacity. The
+        # callers always replace the value of the copy (copy.copy goes
+        # through __getstate__, so the copy doesn't join _shared).
+        inst = copy.copy(self)
+        inst._buffer = None
+        return inst
+    
+    def _share(self, other):
+        # Copy-on-write: *other* refers to the same value as this array.
+        # Handing out the value counts as a modification, as the array
+        # returned can be written in any way: the one that hands it out
+        # keeps the data and the others take a copy (see value). A value
+        # that was already handed out is copied right away.
+        value = self._data
+        other._lazy = None
+        other._buffer = None
+        other._shared = None
+        other._exposed = False
+        
+        if value is not None and self._exposed:
+            other._value = value.copy()
+            other._owned = True
+            return
+        
+        other._value = value
+        other._owned = self._owned
+        if value is not None:
+            if self._shared is None:
+                self._shared = weakref.WeakSet([self])
+            self._shared.add(other)
+            other._shared = self._shared
+    
+    def _unshare(self):
+        shared, self._shared = self._shared, None
+        shared.discard(self)
+        if len(shared) > 0 and self._data is not None:
+            self._value = self._value.copy()
+            self._owned = True
+            self._exposed = False
+            self._buffer = None
+    
+    def _is_shared(self):
+        # Whether the value is shared with another live array
+        if self._shared is not None and len(self._shared) < 2:
+            self._shared.discard(self)
+            self._shared = None
+        return self._shared is not None
+    
+    def _detach_others(self):
+        # The other arrays sharing the value take a copy of it, this
+        # one keeps the storage
+        others = [other for other in self._shared if other is not self]
+        group = weakref.WeakSet(others) if len(others) > 1 else None
+        snapshot = self._value.copy()
+        for other in others:
+            other._value = snapshot
+            other._owned = True
+            other._exposed = False
+            other._buffer = None
+            other._shared = group
+            other._invalidate()
+        self._shared = None
+    
+    def _holds(self, array):
+        # Whether array is the value itself (as after an in-place operator)
+        value = self._value
+        if value is None or self._lazy is not None:
+            return False
+        if array is value:
+            return True
+        # Otherwise only a view may have the same memory layout
+        return (isinstance(array, np.ndarray) and array.base is not None and
+                array.__array_interface__ == value.__array_interface__)
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_shared', None)
+        return state
+    
     def copy(self):
         raise NotImplementedError()
     
     @property
     def size(self):
-        if self.value is None:
+        if self._lazy is not None:
+            return self._lazy[1]
+        
+        if self._data is None:
             return 0
         else:
-            return len(self.value)
+            return len(self._data)
     
     @property
     def value(self):
+        if self._lazy is not None:
+            self._evaluate()
+        value = self._value
+        if value is not None:
+            if self._shared is not None and self._is_shared():
+                self._detach_others()
+            self._exposed = True
+        return value
+    
+    @property
+    def _data(self):
+        # The value, for operations that don't modify it in place. It
+        # may be shared with other arrays.
+        if self._lazy is not None:
+            self._evaluate()
         return self._value
     
     @value.setter
     def value(self, value):
-        if value is None:
-            self._value = None
+        if self._holds(value):
+            # Modified in place, the storage doesn't change
+            self._invalidate()
+        
+        elif value is None:
+            self._store(None)
         
         elif isinstance(value, list):
-            self._value = np.asarray(value, dtype=self.dtype)
+            self._store(np.asarray(value, dtype=self.dtype))
+        
+        elif (type(value) is np.ndarray and self._value is not None and
+              value.dtype is self._value.dtype):
+            # Same type as the current value, nothing to convert
+            self._store(value, owned=False)
         
         elif isinstance(value, np.ndarray):
-            self._value = np.asarray(value, dtype=self.dtype)
+            # Not copied if the type is already right
+            data = np.asarray(value, dtype=self.dtype)
+            self._store(data, owned=data is not value and 
+                        not np.may_share_memory(data, value))
         else:
             raise ValueError("Only array and lists are supported")
+    
+    def _store(self, data, owned=True):
+        # Replace the stored data, without any conversion. *owned* is
+        # False if data may be referred to by the caller.
+        self._lazy = None
+        self._owned = owned
+        self._exposed = not owned
+        self._buffer = None
+        if self._shared is not None:
+            self._shared.discard(self)
+            self._shared = None
+        self._value = data
+        self._invalidate()
+    
+    def _invalidate(self):
+        # Drop the results cached from the data (if any)
+        pass
 
     def reorder(self, neworder, inplace=True):
-        if self.value is None:
+        if self._data is None:
             return # No reordering
         else:
             if len(neworder) != self.size:
                 raise ValueError("'%s': neworder doesn't have enough elements %d (value %d)" % (self.name, len(neworder), self.size))
             
-            if set(neworder) != set(range(self.size)):
+            if not is_permutation(neworder, self.size):
                 raise ValueError("'%s': the new order is invalid as it doesn't contain all the indices." % self.name)
             
             if inplace:
-                self.value = self.value.take(neworder, axis=0)
+                self._permute(np.asarray(neworder))
             else:
                 obj = self.copy()
-                obj.value = self.value.take(neworder, axis=0)
+                obj._store(self._data.take(neworder, axis=0))
                 return obj
     
+    def _permute(self, order, table=None, scratch=None):
+        # Rearrange the elements as value[order] (order is not
+        # validated), and translate the result through *table* if given.
+        # When possible the storage is modified in place, using the
+        # ScratchBuffer *scratch* for the intermediate result.
+        data = self._data
+        if data is None:
+            return
+        
+        if scratch is None:
+            scratch = ScratchBuffer()
+        
+        inplace = (self._owned and not self._is_shared() and 
+                   data.flags.writeable and data.flags.c_contiguous and
+                   not isinstance(data, np.memmap) and 
+                   not data.dtype.hasobject and
+                   (table is None or table.dtype == data.dtype))
+        if not inplace:
+            if order is not None:
+                data = data.take(order, axis=0)
+            if table is not None:
+                data = table.take(data)
+            self._store(data, owned=self._owned or data is not self._data)
+            return
+        
+        if order is not None:
+            out = scratch.array(data.shape, data.dtype)
+            data.take(order, axis=0, out=out, mode='clip')
+            if table is None:
+                data[...] = out
+            else:
+                table.take(out, out=data, mode='clip')
+        elif table is not None:
+            out = scratch.array(data.shape, data.dtype)
+            out[...] = data
+            table.take(out, out=data, mode='clip')
+        self._invalidate()
+    
+    def view(self, index):
+        """Return a sub-attribute that refers to the data of this one.
+        
+        The values are gathered only when they are accessed for the first
+        time. If *index* is a contiguous range no data is copied at all
+        and the value is a slice of the original array.
+        
+        The value of a view is read-only, to modify it either assign a new
+        value or call :meth:`materialize` first.
+        
+        """
+        index = np.asarray(index)
+        if index.dtype == 'bool':
+            index = index.nonzero()[0]
+        
+        return self._lazy_copy(len(index), _gather, self._data, 
+                               as_slice(index) or index)
+    
+    def materialize(self):
+        """Turn a view into an independent and writable array."""
+        if self._is_shared():
+            self._unshare()
+        value = self._data
+        if value is not None and not value.flags.writeable:
+            self._buffer = None
+            if value.flags.owndata and self._owned:
+                value.flags.writeable = True
+            else:
+                self._value = value.copy()
+                self._owned = True
+                self._exposed = False
+    
+    def _lazy_copy(self, size, func, *args):
+        inst = self._shallow_copy()
+        
+        if args[0] is None:
+            # Nothing to refer to
+            inst._value = None
+            inst._lazy = None
+        else:
+            inst._lazy = (lambda: func(*args), size)
+        return inst
+    
+    def _evaluate(self):
+        func, size = self._lazy
+        self._lazy = None
+        
+        value = func()
+        value.flags.writeable = False
+        self._value = value
+        # Gathered by take, or a slice of the original
+        self._owned = value.flags.owndata
+        self._exposed = not self._owned
+    
     def sub(self, index):
         """Return a sub-attribute"""
         index = np.asarray(index)
@@ -125,17 +397,22 @@ class InstanceArray(InstanceProperty):
         if self.size < len(index):
             raise ValueError('Can\'t subset "{}": index ({}) is bigger than the number of elements ({})'.format(self.name, len(index), self.size))
         
-        inst = self.copy()
-        size = len(index)
-        inst.empty(size)
+        # The value is not copied, this makes sub proportional to the
+        # size of index
+        inst = self._shallow_copy()
         
         if len(index) > 0:
-            inst.value = self.value.take(index, axis=0)
+            inst._store(self._data.take(index, axis=0))
+        else:
+            inst._store(None)
         
         return inst
 
 class InstanceAttribute(InstanceArray):
     
+    # Cached result of inverted_index(), with the value it refers to
+    _inverted = None
+    
     def __init__(self, name, shape=None, dtype=None, dim=None, alias=None):
         if not isinstance(dim, string_types):
             raise ValueError('dim parameter is required and should be a string.')
@@ -152,7 +429,8 @@ class InstanceAttribute(InstanceArray):
                          dtype=self.dtype,
                          dim=self.dim,
                          alias=self.alias)
-        obj.value = self.value.copy() if self.value is not None else None
+        # The value is copied only when needed
+        self._share(obj)
         return obj
     
     def field(self, index):
@@ -170,26 +448,221 @@ class InstanceAttribute(InstanceArray):
         
         # We deal also when the values are None
         if isinstance(attr_or_field, InstanceAttribute):
-            if self.value is None:
+            if self._data is None:
                 self.value = attr_or_field.value
             else:
-                self.value = np.append(self.value, attr_or_field.value, axis=0)
+                self._extend(attr_or_field._peek())
         elif isinstance(attr_or_field, InstanceField):
-            if self.value is None:
+            if self._data is None:
                 self.value = [attr_or_field.value]
             else:
-                self.value = np.append(self.value, [attr_or_field.value], axis=0)
+                self._extend(np.asarray([attr_or_field.value], dtype=self.dtype))
         else:
             raise ValueError('Can append only InstanceAttribute or InstanceField')
+    
+    def _peek(self):
+        # The values, for operations that don't modify them (see _data)
+        return self._data
+    
+    def _invalidate(self):
+        self._inverted = None
+    
+    def inverted_index(self):
+        """Return the sorted distinct values of the attribute, and for
+        each of them the sorted indices of the elements having that
+        value, as a tuple (keys, order, offsets). The indices for
+        keys[i] are order[offsets[i]:offsets[i+1]].
+        
+        The result is cached until the attribute is reassigned. Changes
+        made in place to the value are not detected.
+        
+        """
+        value = self._data
+        if self._inverted is None or self._inverted[0] is not value:
+            if value is None:
+                value = np.zeros(0, dtype=self.dtype)
+            keys, codes = np.unique(value, return_inverse=True)
+            order = np.argsort(codes, kind='mergesort')
+            offsets = np.zeros(len(keys) + 1, dtype='int')
+            np.cumsum(np.bincount(codes, minlength=len(keys)), out=offsets[1:])
+            self._inverted = (self._data, keys, order, offsets)
+        
+        return self._inverted[1:]
+    
+    def _groups_of(self, values):
+        # Indices of the elements for each of the values found
+        keys, order, offsets = self.inverted_index()
+        values = np.unique(np.array(values, dtype=keys.dtype.kind))
+        pos = np.searchsorted(keys, values)
+        found = pos < len(keys)
+        found[found] = keys[pos[found]] == values[found]
+        return [order[offsets[p]:offsets[p + 1]] for p in pos[found]]
+    
+    def indices_of(self, values):
+        """Return the sorted indices of the elements equal to any of
+        *values*, using :meth:`inverted_index`.
+        
+        """
+        groups = self._groups_of(values)
+        if len(groups) == 1:
+            return groups[0]
+        return np.sort(np.concatenate(groups + [np.zeros(0, dtype='int')]))
+    
+    def mask_of(self, values):
+        """Return a boolean mask of the elements equal to any of
+        *values*, using :meth:`inverted_index`.
+        
+        """
+        mask = np.zeros(self.size, dtype='bool')
+        for group in self._groups_of(values):
+            mask[group] = True
+        return mask
+    
     def __repr__(self):
-        value_str = str(self.value).replace('\n', ' ')
+        value_str = str(self._peek()).replace('\n', ' ')
         if len(value_str) > 52:
             value_str = value_str[:52] + ' ...'
         return '<Attribute[{}={}] {} = {}>'.format(self.dim, self.size, self.name, value_str)
 
 
+class InstanceCategoricalAttribute(InstanceAttribute):
+    '''An InstanceAttribute of strings stored as integer codes, that
+    refer to a table of categories. 
+    
+    The codes are decoded the first time the value is read, and from
+    then on the strings are stored instead, so that the value can be
+    modified in any way. The operations that don't read the value
+    (copy, sub, concatenate, where...) work on the codes. The codes
+    can be accessed through :meth:`encoded`, :attr:`codes` and
+    :attr:`categories`.
+    
+    '''
+    
+    def __init__(self, name, shape=None, dtype='unicode', dim=None, alias=None):
+        self._categories = np.zeros(0, dtype='unicode')
+        super(InstanceCategoricalAttribute, self).__init__(name, shape, 'unicode', dim, alias)
+    
+    def _decoded(self):
+        # Whether the strings are stored instead of the codes
+        return self._categories is None
+    
+    @property
+    def value(self):
+        codes = self._data
+        if codes is not None and not self._decoded():
+            # The array returned can be modified, the strings are stored
+            strings = self._categories.take(codes)
+            self._categories = None
+            self._store(strings)
+        return super(InstanceCategoricalAttribute, self).value
+    
+    @value.setter
+    def value(self, value):
+        self._inverted = None
+        if value is None:
+            self._categories = np.zeros(0, dtype='unicode')
+            self._store(None)
+        elif self._decoded() and self._holds(value):
+            # Modified in place
+            self._invalidate()
+        elif isinstance(value, (list, np.ndarray)):
+            self._categories, codes = encode_categories(np.zeros(0, dtype='unicode'), 
+                                                        np.asarray(value, dtype='unicode'))
+            self._store(codes)
+        else:
+            raise ValueError("Only array and lists are supported")
+    
+    def encoded(self):
+        """Return the categories and the codes of the value, such that
+        ``value == categories[codes]``. Once the value was read the
+        strings are encoded again at each call, without changing what
+        is stored.
+        
+        """
+        codes = self._data
+        if not self._decoded():
+            return self._categories, codes
+        if codes is None:
+            return np.zeros(0, dtype='unicode'), None
+        return encode_categories(np.zeros(0, dtype='unicode'), codes)
+    
+    @property
+    def codes(self):
+        """The integer codes, see :meth:`encoded`."""
+        return self.encoded()[1]
+    
+    @property
+    def categories(self):
+        """The distinct strings, see :meth:`encoded`."""
+        return self.encoded()[0]
+    
+    @categories.setter
+    def categories(self, value):
+        self._categories = value
+    
+    def _peek(self):
+        # The strings, without storing them
+        if self._decoded() or self._data is None:
+            return self._data
+        return self._categories.take(self._data)
+    
+    def _extend(self, values):
+        if self._decoded():
+            return super(InstanceCategoricalAttribute, self)._extend(values)
+        
+        self._categories, codes = encode_categories(self._categories, values)
+        dtype = np.promote_types(self._value.dtype, codes.dtype)
+        self._buffer, self._value = extend_buffer(self._buffer, self._value, 
+                                                  codes, dtype)
+        self._owned = True
+    
+    def copy(self):
+        obj = super(InstanceCategoricalAttribute, self).copy()
+        obj._categories = self._categories
+        return obj
+    
+    def field(self, index):
+        obj = InstanceField(name=self.name, dtype=self.dtype, shape=self.shape, alias=self.alias)
+        
+        if self._data is None:
+            raise ValueError("Attribute '%s' is not initialized" % (self.name))
+        
+        obj.value = self._peek()[index]
+        return obj
+    
+    def inverted_index(self):
+        if self._decoded():
+            return super(InstanceCategoricalAttribute, self).inverted_index()
+        
+        codes = self._data
+        categories = self._categories
+        if self._inverted is None or self._inverted[0] is not codes:
+            if codes is None:
+                codes = np.zeros(0, dtype='int16')
+            # Only the (few) categories need to be sorted as strings
+            used = np.bincount(codes, minlength=len(categories)) > 0
+            perm = np.argsort(categories)
+            perm = perm[used[perm]]
+            rank = np.zeros(len(categories), dtype='int')
+            rank[perm] = np.arange(len(perm))
+            
+            ranked = rank.take(codes)
+            order = np.argsort(ranked, kind='mergesort')
+            offsets = np.zeros(len(perm) + 1, dtype='int')
+            np.cumsum(np.bincount(ranked, minlength=len(perm)), out=offsets[1:])
+            self._inverted = (self._data, categories[perm], order, offsets)
+        
+        return self._inverted[1:]
+
+
 class InstanceRelation(InstanceArray):
     
+    # Cached result of groups()
+    _groups = None
+    
+    # Storage with spare capacity for the index
+    _index_buffer = None
+    
     def __init__(self, name, map=None, index=None, dim=None, shape=None, alias=None):
         if not isinstance(dim, string_types):
             raise ValueError('dim parameter is required and should be a string.')
@@ -217,30 +690,48 @@ class InstanceRelation(InstanceArray):
 
     def copy(self):
         obj = type(self)(self.name, self.map, self.index, self.dim, self.shape, self.alias)
-        obj.value = self.value.copy() if self.value is not None else None
-        obj.index = self.index.copy() if self.index is not None else None
+        # The value is copied only when needed. The index is always
+        # replaced rather than modified in place, so it can be shared.
+        self._share(obj)
+        obj._index = self._index
         return obj
 
     def append(self, rel):
         newix = rel.index + len(self.index)
         newrel = rel.remap(rel.index, newix, inplace=False)
         # Extend index
-        self.index = np.append(self.index, newix, axis=0)
+        self._index_buffer, self._index = extend_buffer(self._index_buffer,
+                                                        self._index, newix)
         
         # Extend value
-        if rel.value is None:
+        if rel._data is None:
             return
-        if self.value is None:
+        if self._data is None:
             self.value = rel.value
         else:
-            self.value = np.append(self.value, newrel.value, axis=0)
+            self._groups = None
+            self._extend(newrel._data)
+    
+    def _invalidate(self):
+        self._groups = None
+    
+    def shrink_to_fit(self):
+        super(InstanceRelation, self).shrink_to_fit()
+        if self._index_buffer is not None:
+            self._index = self._index.copy()
+            self._index_buffer = None
+    
+    def _shallow_copy(self):
+        inst = super(InstanceRelation, self)._shallow_copy()
+        inst._index_buffer = None
+        return inst
     
     def remap(self, from_map, to_map, inplace=True):
         if (not isinstance(from_map, (list, np.ndarray, six.moves.range)) or 
             not isinstance(to_map, (list, np.ndarray, six.moves.range))):
             raise ValueError('from_map and to_map should be either lists or arrays')
         
-        if self.value is None:
+        if self._data is None:
             # Nothing to remap
             if inplace:
                 return 
@@ -255,17 +746,25 @@ class InstanceRelation(InstanceArray):
         
         # This is quite a clever trick to efficiently remap column,
         # the idea is similar to an hashmap.
-        stupidhash = np.empty(max(from_map) + 2)
+        # The table starts at the smallest index, so that remapping
+        # a small range of a big index (as in subentity) is cheap. 
+        from_map = np.asarray(from_map, dtype='int')
+        start = from_map.min()
+        stupidhash = np.empty(from_map.max() - start + 2)
         stupidhash.fill(-1)
-        stupidhash[np.array(from_map)] = to_map
-        mapped = stupidhash.take(self.value.flatten('F'), mode='clip')
+        stupidhash[from_map - start] = to_map
+        
+        # Values out of the table are mapped to the last element (-1)
+        values = self._data.flatten('F') - start
+        values[values < 0] = len(stupidhash) - 1
+        mapped = stupidhash.take(values, mode='clip')
 
         if inplace:
             # Flatten and back
-            self.value = mapped.reshape(self.value.shape, order='F')
+            self.value = mapped.reshape(self._data.shape, order='F')
         else:
             obj = self.copy()
-            obj.value = mapped.reshape(self.value.shape, order='F')
+            obj.value = mapped.reshape(self._data.shape, order='F')
             return obj
 
     def reindex(self, inplace=True):
@@ -279,6 +778,23 @@ class InstanceRelation(InstanceArray):
         obj.index = newindex
         return obj
 
+    def view(self, index, map_index):
+        """Return a sub-relation containing the elements at *index* and
+        referring only to the elements at *map_index*. 
+        
+        Just like :meth:`InstanceArray.view`, the values are computed
+        lazily and they are read-only.
+        
+        """
+        index = np.asarray(index)
+        if index.dtype == 'bool':
+            index = index.nonzero()[0]
+        
+        inst = self._lazy_copy(len(index), _gather_remap, self._data, 
+                               as_slice(index) or index, self.index[map_index])
+        inst.index = range(len(self.index[map_index]))
+        return inst
+    
     def argfilter(self, index):
         if self.size == 0:
             # No relations are defined here, we don't have to filter anything
@@ -298,6 +814,79 @@ class InstanceRelation(InstanceArray):
         
         return mask.nonzero()[0]
     
+    def mask_within(self, mask):
+        """Given a boolean *mask* over the index, return a boolean mask
+        over the elements of this relation whose values are all
+        selected by *mask*.
+        
+        """
+        value = self._data
+        if value is None:
+            return np.zeros(0, dtype='bool')
+        
+        size = max(self.index.max() if len(self.index) else -1,
+                   value.max() if value.size else -1) + 1
+        selected = np.zeros(size, dtype='bool')
+        selected[self.index[mask]] = True
+        
+        result = selected[value]
+        if result.ndim == 2:
+            result = result.all(axis=1)
+        elif result.ndim != 1:
+            raise ValueError('filter only works for shapes for lenth 1 or 2')
+        return result
+    
+    def groups(self):
+        """Group the elements of a one-dimensional relation (such as a map)
+        by their value, in a CSR-like fashion.
+        
+        Return a tuple *(order, offsets)* where the elements having value
+        *i* are ``order[offsets[i]:offsets[i+1]]``. When the values are
+        already sorted *order* is None, and each group is a contiguous
+        range of elements.
+        
+        The result is cached until a new value is set.
+        """
+        value = self._data
+        if self._groups is not None and self._groups[0] is value:
+            return self._groups[1:]
+        
+        if value is None:
+            value = np.zeros(0, dtype='int')
+        
+        if value.ndim != 1:
+            raise ValueError('groups is only available for one-dimensional relations')
+        
+        counts = np.bincount(value, minlength=len(self.index))
+        offsets = np.zeros(len(counts) + 1, dtype='int')
+        np.cumsum(counts, out=offsets[1:])
+        
+        if np.all(value[1:] >= value[:-1]):
+            order = None
+        else:
+            # A stable sort keeps each group in the original order
+            order = np.argsort(value, kind='mergesort')
+        
+        self._groups = (self._data, order, offsets)
+        return order, offsets
+    
+    def members(self, groups):
+        """Return the indices of the elements whose value is in *groups*,
+        an array of indices. 
+        
+        """
+        order, offsets = self.groups()
+        groups = np.asarray(groups, dtype='int')
+        
+        starts = offsets[groups]
+        counts = offsets[groups + 1] - starts
+        
+        # Position of each element relative to the start of its group
+        shift = np.repeat(starts - (np.cumsum(counts) - counts), counts)
+        members = np.arange(counts.sum()) + shift
+        
+        return members if order is None else order[members]
+    
     def filter(self, index):
         mask = self.argfilter(index)
         newrel = self.sub(mask)
@@ -310,10 +899,18 @@ class InstanceRelation(InstanceArray):
     
     @index.setter
     def index(self, value):
+        self._index_buffer = None
         if value is None:
             self._index = None
         
-        elif isinstance(value, (list, six.moves.range)):
+        elif isinstance(value, six.moves.range):
+            # Avoid iterating over the range
+            index = np.arange(len(value), dtype='int')
+            if len(value) > 0:
+                index = value[0] + index * (value[1] - value[0] if len(value) > 1 else 1)
+            self._index = index
+        
+        elif isinstance(value, list):
             self._index = np.asarray(value, dtype='int')
         
         elif isinstance(value, np.ndarray):
@@ -328,22 +925,23 @@ class InstanceRelation(InstanceArray):
     
     @value.setter
     def value(self, value):
+        self._groups = None
         if value is None:
             pass
         else:
             # We have to check that all the values in the map are in the index
             # as well
-            ix_value = set(np.asarray(value).flatten())
-            ix_max = set(self.index)
+            ix_value = np.unique(np.asarray(value))
+            missing = np.setdiff1d(ix_value, self.index, assume_unique=True)
             
-            if ix_value > ix_max:
+            if len(missing) > 0 and np.in1d(self.index, ix_value).all():
                 raise ValueError('Error setting relation "{}". Values {} not present in index'
-                                 .format(self.name, list(ix_value - ix_max)))
+                                 .format(self.name, missing.tolist()))
         
         InstanceArray.value.__set__(self, value)
 
     def __repr__(self):
-        value_str = str(self.value).replace('\n', '')
+        value_str = str(self._data).replace('\n', '')
         if len(value_str) > 52:
             value_str = value_str[:52] + ' ...'
                 
@@ -388,3 +986,127 @@ class InstanceField(InstanceProperty):
     
     def __repr__(self):
         return '<Field: {} = {}>'.format(self.name, str(self.value))
+
+
+def extend_buffer(buffer, array, values, dtype=None):
+    """Append *values* to *array*, a prefix of *buffer*.
+    
+    When *buffer* doesn't have enough capacity, a new buffer is
+    allocated with at least twice the size of *array*. This makes
+    repeated appends run in amortized constant time.
+    
+    Return the new buffer and the extended array.
+    """
+    size = len(array)
+    newsize = size + len(values)
+    dtype = array.dtype if dtype is None else np.dtype(dtype)
+    
+    if buffer is None or len(buffer) < newsize or buffer.dtype != dtype:
+        capacity = max(newsize, 2 * size)
+        buffer = np.empty((capacity,) + array.shape[1:], dtype=dtype)
+        buffer[:size] = array
+    
+    buffer[size:newsize] = values
+    return buffer, buffer[:newsize]
+
+def is_permutation(order, size):
+    """Check if *order* contains every integer between 0 and
+    *size* - 1 exactly once."""
+    order = np.asarray(order)
+    if len(order) != size:
+        return False
+    if size == 0:
+        return True
+    if order.dtype.kind not in 'iu' or order.min() < 0 or order.max() >= size:
+        return False
+    return bool((np.bincount(order, minlength=size) == 1).all())
+
+def inverse_permutation(order):
+    """Return the permutation that undoes *order*, such that
+    ``inverse[order[i]] == i``."""
+    inverse = np.empty(len(order), dtype='int')
+    inverse[order] = np.arange(len(order))
+    return inverse
+
+class ScratchBuffer(object):
+    '''Temporary storage, that is reused by consecutive in-place
+    operations on arrays of different types and shapes.'''
+    
+    def __init__(self):
+        self._buffer = np.zeros(0, dtype='uint8')
+    
+    def array(self, shape, dtype):
+        """Return an uninitialized array, that refers to the buffer."""
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        if len(self._buffer) < nbytes:
+            self._buffer = np.empty(nbytes, dtype='uint8')
+        return self._buffer[:nbytes].view(dtype).reshape(shape)
+
+def encode_categories(categories, values):
+    """Encode the strings *values* as integer codes into the array
+    *categories*. The strings that are not present are appended to
+    the categories, the codes of the existing ones don't change.
+    
+    Return the new categories and the codes, as int16 or int32
+    depending on the number of categories.
+    """
+    uniques, inverse = np.unique(values, return_inverse=True)
+    
+    # Look up the distinct values in the categories
+    codes = np.zeros(len(uniques), dtype='int')
+    found = np.zeros(len(uniques), dtype='bool')
+    if len(categories) > 0:
+        order = np.argsort(categories)
+        pos = np.searchsorted(categories, uniques, sorter=order)
+        pos = np.minimum(pos, len(categories) - 1)
+        found = categories[order[pos]] == uniques
+        codes[found] = order[pos[found]]
+    
+    new = uniques[~found]
+    if len(new) > 0:
+        codes[~found] = len(categories) + np.arange(len(new))
+        categories = np.concatenate([categories, new])
+    
+    dtype = 'int16' if len(categories) <= np.iinfo('int16').max else 'int32'
+    return categories, codes.astype(dtype).take(inverse)
+
+def as_categories(values):
+    """Return the distinct strings in *values* and the codes of
+    the elements, such that ``values == categories[codes]``.
+    
+    *values* can also be an InstanceCategoricalAttribute, whose codes
+    are used without decoding them.
+    """
+    if isinstance(values, InstanceCategoricalAttribute):
+        return values.encoded()
+    return np.unique(np.asarray(values), return_inverse=True)
+
+def as_slice(index):
+    """Return a slice equivalent to the integer array *index* if it
+    describes a contiguous range, otherwise return None."""
+    if len(index) == 0:
+        return slice(0, 0)
+    
+    start, stop = index[0], index[-1] + 1
+    if stop - start == len(index) and np.all(np.diff(index) == 1):
+        return slice(start, stop)
+
+def _gather(array, index):
+    if isinstance(index, slice):
+        return array[index]
+    else:
+        return array.take(index, axis=0)
+
+def _gather_remap(array, index, from_map):
+    # Same as InstanceRelation.remap, to the range [0, len(from_map))
+    value = _gather(array, index)
+    start = from_map.min() if len(from_map) else 0
+    lookup = np.empty(from_map.max() - start + 2 if len(from_map) else 1, dtype='int')
+    lookup.fill(-1)
+    lookup[from_map - start] = np.arange(len(from_map))
+    
+    # Values out of the table are mapped to the last element (-1)
+    value = value - start
+    value[value < 0] = len(lookup) - 1
+    return lookup.take(value, mode='clip')
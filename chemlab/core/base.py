@@ -5,16 +5,22 @@ from __future__ import print_function
 import numpy as np
 import collections
 import operator
+import weakref
 
 
-from itertools import islice
+from itertools import islice, chain
 from functools import reduce
 from contextlib import contextmanager
 from collections import defaultdict
+from six import string_types
 from .attributes import (InstanceField, InstanceArray, 
                          InstanceRelation, InstanceAttribute, 
-                         Field, Attribute, Relation)
-from .serialization import data_to_json, json_to_data
+                         InstanceCategoricalAttribute,
+                         Field, Attribute, CategoricalAttribute, Relation,
+                         encode_categories, is_permutation, 
+                         inverse_permutation, ScratchBuffer)
+from .serialization import (data_to_json, json_to_data,
+                            data_to_directory, directory_to_data)
 
 class ChemicalEntity(object):
     
@@ -44,49 +50,71 @@ class ChemicalEntity(object):
             
         return instance
     
-    def __getattribute__(self, name):
+    def __getattr__(self, name):
+        # Called only when the normal attribute lookup fails
         try:
-            return super(ChemicalEntity, self).__getattribute__(name)
-        except AttributeError as exc:
-            try:
-                return self.get_attribute(name, alias=True).value
-            except KeyError:
-                pass
-            raise exc
+            attr = self._property_lookup()[1][name]
+        except KeyError:
+            raise AttributeError("'{}' object has no attribute '{}'"
+                                 .format(type(self).__name__, name))
+        return attr.value
     
     def __setattr__(self, name, value):
+        if name in _PROPERTY_DICTS:
+            self.__dict__['_lookup'] = None
+            value = PropertyDict(self, value)
+            return super(ChemicalEntity, self).__setattr__(name, value)
+        
         try:
-            attr = self.get_attribute(name, alias=True)
-            if isinstance(attr, InstanceArray):
-                if self.dimensions[attr.dim] != len(value):
-                    raise ValueError('Dimension {} needs {} elements.'.format(attr.dim, 
-                                                                              self.dimensions[attr.dim]))            
-            attr.value = value
+            attr = self._property_lookup()[1][name]
         except KeyError:
-            super(ChemicalEntity, self).__setattr__(name, value)
+            return super(ChemicalEntity, self).__setattr__(name, value)
+        
+        if isinstance(attr, InstanceArray):
+            if self.dimensions[attr.dim] != len(value):
+                raise ValueError('Dimension {} needs {} elements.'.format(attr.dim, 
+                                                                          self.dimensions[attr.dim]))            
+        attr.value = value
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lookup'] = None
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for name in _PROPERTY_DICTS:
+            if name in state:
+                self.__dict__[name] = PropertyDict(self, state[name])
+    
+    def _property_lookup(self):
+        # Lookup tables of the properties by name, and by name or alias. 
+        # They are rebuilt only when the property dictionaries change.
+        lookup = self.__dict__.get('_lookup')
+        if lookup is None:
+            by_name = merge_dicts(self.__attributes__,
+                                  self.__fields__,
+                                  self.__relations__)
+            by_alias = dict(by_name)
+            by_alias.update({v.alias : v for v in by_name.values() if v.alias is not None})
+            
+            lookup = self.__dict__['_lookup'] = (by_name, by_alias)
+        return lookup
+    
+    def _invalidate_lookup(self):
+        self.__dict__['_lookup'] = None
     
     def get_attribute(self, name, alias=False):
+        prop_dict = self._property_lookup()[1 if alias else 0]
         
-        prop_dict = merge_dicts(self.__attributes__,
-                                self.__fields__,
-                                self.__relations__)
-        if alias:
-            prop_dict.update({v.alias : v for v in prop_dict.values() if v.alias is not None})
-        
-        if name not in prop_dict:
+        try:
+            return prop_dict[name]
+        except KeyError:
             raise KeyError('Attribute "{}" not present in class "{}"'.format(name, type(self)))
-        
-        return prop_dict[name]
 
     def has_attribute(self, name, alias=False):
         """Check if the entity contains the attribute *name*"""
-        prop_dict = merge_dicts(self.__attributes__,
-                                self.__fields__,
-                                self.__relations__)
-        if alias:
-            prop_dict.update({v.alias : v for v in prop_dict.values() if v.alias is not None})
-        
-        return name in prop_dict
+        return name in self._property_lookup()[1 if alias else 0]
     
     @classmethod
     def empty(cls, **kwargs):
@@ -135,11 +163,58 @@ class ChemicalEntity(object):
         exp_dict['version'] = 1
         return data_to_json(exp_dict)
     
+    @classmethod
+    def load(cls, directory, mmap_mode=None):
+        """Read a ChemicalEntity stored in *directory* using
+        :py:meth:`save`.
+        
+        **Parameters**
+        
+        directory: str
+           Directory containing the serialized entity.
+        mmap_mode: None | 'r' | 'r+' | 'c'
+           If not None, the arrays are memory-mapped with the given
+           mode (see :py:func:`numpy.load`) instead of being read in
+           memory. With 'r' the arrays are read-only.
+        
+        """
+        exp_dict = directory_to_data(directory, mmap_mode=mmap_mode)
+        version = exp_dict.pop('version', 0)
+        if version != 1:
+            raise ValueError("Version %d not supported" % version)
+        return cls.from_dict(exp_dict)
+    
+    def save(self, directory):
+        """Store the ChemicalEntity in *directory* in a binary format.
+        The arrays are saved as .npy files, alongside a small json
+        header. Compared to :py:meth:`to_json`, this is much faster and
+        more compact for large entities, and the arrays can be
+        memory-mapped when loading.
+        
+        **Example**
+        
+        ::
+        
+            s.save('water.chem')
+            s = System.load('water.chem', mmap_mode='r')
+        
+        """
+        exp_dict = self.to_dict()
+        exp_dict['version'] = 1
+        data_to_directory(exp_dict, directory)
+    
     def copy(self):
-        """Create a copy of this ChemicalEntity
+        """Create a copy of this ChemicalEntity. 
+        
+        The arrays are copied lazily: the copy shares the data with
+        this entity until an array is read from one of them (for
+        example ``s.r_array``), which keeps the data while the other
+        one takes a copy. Arrays that were already read before the
+        copy are copied right away, arrays that are reassigned are
+        never copied.
         
         """
-        inst = super(type(self), type(self)).empty(**self.dimensions)
+        inst = type(self).__new__(type(self))
         
         # Need to copy all attributes, fields, relations
         inst.__attributes__ = {k: v.copy() for k, v in self.__attributes__.items()}
@@ -226,11 +301,11 @@ class ChemicalEntity(object):
             # Concatenate fields in new, independent, attributes
             child_attr = [e.get_attribute(attr.name) for e in entities]
             if attr.dim == newdim:
-                self.__attributes__[name] = concatenate_fields(child_attr, newdim)
+                new_attr = concatenate_fields(child_attr, newdim)
             else:
                 # Concatenate sub-attributes
-                child_attr = [e.get_attribute(attr.name) for e in entities]
-                self.__attributes__[name] = concatenate_attributes(child_attr)
+                new_attr = concatenate_attributes(child_attr)
+            self.__attributes__[name] = as_kind(attr, new_attr)
 
         # Concatenate relations
         for name, attr in self.__relations__.items():
@@ -247,6 +322,45 @@ class ChemicalEntity(object):
             self.maps[from_, to_] = concatenate_relations(child_rel)
         
         
+    def _from_template(self, tpl, n, newdim):
+        # Equivalent to self._from_entities([tpl] * n, newdim), but
+        # all the arrays are tiled at once
+        if n == 0:
+            return # Nothing to be done here
+        
+        # Populate dimensions
+        self.dimensions[newdim] = n
+        for dim in self.dimensions:
+            if dim in tpl.dimensions:
+                subattr_map = InstanceRelation('map', map=newdim, 
+                                                dim=dim, 
+                                                index=range(n))
+                subattr_map.value = np.repeat(np.arange(n), tpl.dimensions[dim])
+                self.maps[dim, newdim] = subattr_map
+                
+                self.dimensions[dim] = n * tpl.dimensions[dim]
+        
+        for name, attr in self.__attributes__.items():
+            # Copy only existing fields or attributes
+            if not tpl.has_attribute(name):
+                continue
+            
+            child_attr = tpl.get_attribute(attr.name)
+            if attr.dim == newdim:
+                new_attr = tile_fields(child_attr, n, newdim)
+            else:
+                new_attr = tile_attributes(child_attr, n)
+            self.__attributes__[name] = as_kind(attr, new_attr)
+        
+        for name, attr in self.__relations__.items():
+            if newdim in attr.map:
+                self.__relations__[name].index = range(n)
+            else:
+                self.__relations__[name] = tile_relations(tpl.get_attribute(attr.name), n)
+        
+        for (from_, to_), attr in tpl.maps.items():
+            self.maps[from_, to_] = tile_relations(attr, n)
+    
     @classmethod
     def _attr_by_dimension(cls, dim):
         return [name for name, attr in merge_dicts(cls.__attributes__, cls.__relations__).items() if attr.dim == dim]
@@ -360,10 +474,12 @@ class ChemicalEntity(object):
                 if self.dimensions[attr.dim] == 0:
                     continue
 
-                # Else, we generate a subattribute
-                mapped_index = self.maps[attr.dim, dim].value == index
+                # Else, we generate a subattribute. The elements are
+                # looked up in the (cached) groups of the map, which
+                # doesn't require a scan of the whole map.
+                mapped_index = self.maps[attr.dim, dim].members([index])
                 entity.__attributes__[name] = attr.sub(mapped_index)
-                entity.dimensions[attr.dim] = np.count_nonzero(mapped_index)
+                entity.dimensions[attr.dim] = len(mapped_index)
 
         for name, rel in self.__relations__.items():
             if rel.map == dim:
@@ -374,32 +490,35 @@ class ChemicalEntity(object):
                 # Special case, we don't need to do anything
                 if self.dimensions[rel.dim] == 0:
                     continue
-                mapped_index = self.maps[rel.dim, dim].value == index
-                entity.__relations__[name] = rel.sub(mapped_index)
-                entity.dimensions[rel.dim] = np.count_nonzero(mapped_index)
+                mapped_index = self.maps[rel.dim, dim].members([index])
+                convert_index = self.maps[rel.map, dim].members([index])
                 
-                # We need to remap values
-                convert_index = self.maps[rel.map, dim].value == index
-                entity.__relations__[name].remap(convert_index.nonzero()[0],
-                                                 range(entity.dimensions[rel.map]))
+                # The values are remapped to the elements of the entity
+                entity.__relations__[name] = rel.view(mapped_index, convert_index)
+                entity.__relations__[name].materialize()
+                entity.dimensions[rel.dim] = len(mapped_index)
         
         return entity
 
 
     def _propagate_dim(self, index, dimension, propagate=True):
         index = normalize_index(index)
+        mask = index_to_mask(index, self.dimensions[dimension])
         
+        masks = self._propagate_mask(mask, dimension, propagate)
+        return {k: m.nonzero()[0] for k, m in masks.items()}
+    
+    def _propagate_mask(self, mask, dimension, propagate=True):
+        """Same as _propagate_dim, taking and returning boolean masks."""
         # Initialize
-        result = defaultdict(set)
-        for dim in self.dimensions:
-            result[dim] |= set(range(self.dimensions[dim]))
-        
-        result[dimension] &= set(index)
+        result = {dim: np.ones(n, dtype='bool') for dim, n in self.dimensions.items()}
+        result[dimension] &= mask
+        mask = result[dimension]
         
         # Propagate for relations
-        for rel in self.__relations__.values():            
-            if rel.map == dimension:
-                result[rel.dim] &= set(rel.argfilter(index))
+        for rel in self.__relations__.values():
+            if rel.map == dimension and rel.size > 0:
+                result[rel.dim] &= rel.mask_within(mask)
         
         # Propagate for the attribute maps
         for (a, b), rel in self.maps.items():
@@ -407,19 +526,24 @@ class ChemicalEntity(object):
             if not propagate: continue
             
             if a == dimension:
-                result[b] &= set(np.unique(rel.sub(index).value))                
+                result[b] &= index_to_mask(rel._data[mask], len(result[b]))
                 # We need to propagate for the attributes that changed
-                prop = self._propagate_dim(np.array(sorted(result[b]), 'int'), b)
+                prop = self._propagate_mask(result[b], b)
                 for r in result:
-                    result[r] &= set(prop[r])
+                    result[r] &= prop[r]
             
             if b == dimension:
-                result[rel.dim] &= set(rel.argfilter(index))
-
-
-        return {k: np.array(sorted(v), 'int') for k, v in result.items()}
+                members = rel.members(mask.nonzero()[0])
+                result[a] &= index_to_mask(members, len(result[a]))
+        
+        return result
     
-    def subindex(self, filter_, inplace=False):
+    def subindex(self, filter_, inplace=False, view=False):
+        if view:
+            if inplace:
+                raise ValueError('A view can not be created inplace')
+            return self._subindex_view(filter_)
+        
         if not inplace:
             inst = self.copy()
         else:
@@ -441,15 +565,45 @@ class ChemicalEntity(object):
             inst.maps[a, b].reindex()
         
         return inst
-            
     
-    def sub_dimension(self, index, dimension, propagate=True, inplace=False):
+    def _subindex_view(self, filter_):
+        filter_ = {k: normalize_index(f) for k, f in filter_.items()}
+        
+        inst = type(self).__new__(type(self))
+        inst.dimensions = {k: len(f) for k, f in filter_.items()}
+        inst.__attributes__ = {name: attr.view(filter_[attr.dim]) 
+                               for name, attr in self.__attributes__.items()}
+        inst.__relations__ = {name: rel.view(filter_[rel.dim], filter_[rel.map])
+                              for name, rel in self.__relations__.items()}
+        inst.__fields__ = {k: v.copy() for k, v in self.__fields__.items()}
+        inst.maps = {(a, b): rel.view(filter_[a], filter_[b]) 
+                     for (a, b), rel in self.maps.items()}
+        return inst
+    
+    def materialize(self):
+        """Make the attributes, relations and maps of a view
+        independent from the entity they were taken from, and writable.
+        
+        """
+        for prop in merge_dicts(self.__attributes__, self.__relations__).values():
+            prop.materialize()
+        
+        for rel in self.maps.values():
+            rel.materialize()
+        
+        return self
+    
+    def sub_dimension(self, index, dimension, propagate=True, inplace=False,
+                      view=False):
         """Return a ChemicalEntity sliced through a dimension.
         
         If other dimensions depend on this one those are updated accordingly.
+        
+        If *view* is True, the returned entity refers to the data of
+        this one instead of copying it (see :meth:`sub`).
         """
         filter_ = self._propagate_dim(index, dimension, propagate)
-        return self.subindex(filter_, inplace)
+        return self.subindex(filter_, inplace, view)
     
     def shrink_dimension(self, newdim, dimension):
         return self.sub_dimension(range(newdim),
@@ -464,9 +618,7 @@ class ChemicalEntity(object):
         
         for name, attr in self.__attributes__.items():
             if attr.dim == dimension:
-                newattr = attr.copy()
-                newattr.empty(newdim - attr.size)
-                self.__attributes__[name] = concatenate_attributes([attr, newattr])
+                attr.append(attr.empty(newdim - attr.size, inplace=False))
 
         for name, rel in self.__relations__.items():
             if dimension == rel.dim:
@@ -504,42 +656,52 @@ class ChemicalEntity(object):
         return self
         
     def _propagate_reorder(self, order, dimension):
-        if len(set(order)) != self.dimensions[dimension]:
+        if not is_permutation(order, self.dimensions[dimension]):
             raise ValueError('order must contain all distinct elements in dimension %s' % dimension)
-        order = np.asarray(order)
-        # Initialize
-        result = { k: range(v) for k, v in self.dimensions.items() }
+        order = np.asarray(order, dtype='int')
         
-        # The actual dimension gets reordered normally
+        # The actual dimension gets reordered normally, the other
+        # dimensions are left untouched (None) unless they belong to
+        # it
+        result = dict.fromkeys(self.dimensions)
         result[dimension] = order
         
         # Propagate for attribute maps
+        inverse = inverse_permutation(order)
         for (a, b), rel in self.maps.items():
-            if rel.map == dimension:
-                rel_new = rel.remap(order, rel.index, inplace=False)
+            if rel.map == dimension and rel._data is not None:
                 # We can't use quicksort because it is not a stable sort
-                result[a] = np.argsort(rel_new.value, kind='mergesort')
-        
-        return {k: np.array(v, dtype='int') for k,v in result.items()}
-
+                result[a] = np.argsort(inverse.take(rel._data), kind='mergesort')
         
+        return result
+    
     def reorder_dimension(self, order, dimension):
+        """Reorder the elements of *dimension* according to *order*,
+        such that the new element i is the old element order[i]. The
+        elements of the dimensions that belong to it (for example the
+        atoms of the molecules) are moved together.
+        
+        The arrays are reordered in a single pass, in place when
+        possible.
+        
+        """
         reorder = self._propagate_reorder(order, dimension)
+        inverse = {k: inverse_permutation(v) for k, v in reorder.items() if v is not None}
+        scratch = ScratchBuffer()
         
         # Attributes get reordered normally
         for name, attr in self.__attributes__.items():
-            attr.reorder(reorder[attr.dim])
-        
-        # Relations get reordered and remapped
-        for name, rel in self.__relations__.items():
-            rel.reorder(reorder[rel.dim])
-            rel.remap(reorder[rel.map], rel.index)
-        
-        # Maps get reordered too
-        for name, rel in self.maps.items():
-            rel.remap(rel.index, reorder[rel.map])
-            rel.reorder(reorder[rel.dim])
-        
+            if reorder[attr.dim] is not None:
+                attr._permute(reorder[attr.dim], scratch=scratch)
+        
+        # Relations and maps get reordered, and their values remapped
+        for rel in chain(self.__relations__.values(), self.maps.values()):
+            table = inverse.get(rel.map)
+            if table is not None:
+                # The values refer to the elements of the index
+                table = np.asarray(rel.index, dtype='int').take(table)
+            if reorder[rel.dim] is not None or table is not None:
+                rel._permute(reorder[rel.dim], table, scratch=scratch)
         
     def concat(self, other, inplace=False):
         '''Concatenate two ChemicalEntity of the same kind'''
@@ -572,6 +734,87 @@ class ChemicalEntity(object):
         
         return obj
     
+    @classmethod
+    def concatenate(cls, entities):
+        '''Concatenate a list of ChemicalEntity of the same kind in a
+        new one. This is equivalent to calling :meth:`concat`
+        repeatedly, but the final dimensions are computed up front and
+        each array is allocated only once. The fields are taken from
+        the first entity.
+        
+        **Example**
+        
+        ::
+        
+            fragments = [System.load(name) for name in names]
+            membrane = System.concatenate(fragments)
+        
+        '''
+        entities = list(entities)
+        if len(entities) == 0:
+            return cls.empty()
+        
+        tpl = entities[0]
+        obj = tpl.copy()
+        parts = [e for e in entities if not e.is_empty()]
+        if len(parts) == 0:
+            return obj
+        
+        obj.dimensions = {d: sum(e.dimensions[d] for e in parts) 
+                          for d in parts[0].dimensions}
+        
+        for name, attr in obj.__attributes__.items():
+            arrays = [e.__attributes__[name] for e in parts]
+            if any(a.size > 0 for a in arrays):
+                # Uninitialized parts are filled with the default value
+                arrays = [a if a.size > 0 or e.dimensions[a.dim] == 0 
+                          else a.empty(e.dimensions[a.dim], inplace=False)
+                          for a, e in zip(arrays, parts)]
+            new = concatenate_attributes(arrays)
+            new.alias = attr.alias
+            obj.__attributes__[name] = new
+        
+        for name, rel in obj.__relations__.items():
+            arrays = [e.__relations__[name] for e in parts]
+            # The index of uninitialized relations may be out of date
+            arrays = [r if r.size > 0 or len(r.index) == e.dimensions[r.map]
+                      else InstanceRelation(r.name, map=r.map, dim=r.dim, shape=r.shape,
+                                            index=range(e.dimensions[r.map]))
+                      for r, e in zip(arrays, parts)]
+            new = concatenate_relations(arrays)
+            new.alias = rel.alias
+            obj.__relations__[name] = new
+        
+        keys = set(k for e in parts for k in e.maps)
+        maps = {}
+        for a, b in keys:
+            arrays = []
+            for e in parts:
+                if (a, b) in e.maps:
+                    arrays.append(e.maps[a, b])
+                elif e.dimensions[a] == 0:
+                    arrays.append(InstanceRelation('map', map=b, dim=a, 
+                                                   index=range(e.dimensions[b])))
+                else:
+                    raise ValueError('Map for {}->{} is missing'.format(a, b))
+            maps[a, b] = concatenate_relations(arrays)
+        obj.maps = maps
+        
+        return obj
+    
+    def shrink_to_fit(self):
+        """Release the memory reserved to append new elements (for example
+        by :meth:`add_entity` or :meth:`concat`).
+        
+        """
+        for prop in merge_dicts(self.__attributes__, self.__relations__).values():
+            prop.shrink_to_fit()
+        
+        for rel in self.maps.values():
+            rel.shrink_to_fit()
+        
+        return self
+    
     def where(self, inplace=False, **kwargs):
         """Return indices over every dimension that met the conditions. 
         
@@ -599,18 +842,14 @@ class ChemicalEntity(object):
         atom_index = 0
         atom_index = [0, 1]
         
+        For string attributes (such as type_array or molecule_name)
+        the values are looked up in an index that is built on the
+        first query, and kept until the attribute is reassigned (see
+        :meth:`InstanceAttribute.inverted_index`).
         
         """
         masks = {k: np.ones(v, dtype='bool') for k,v in self.dimensions.items()} 
         
-        def index_to_mask(index, n):
-            val = np.zeros(n, dtype='bool')
-            val[index] = True
-            return val
-        
-        def masks_and(dict1, dict2):
-            return {k: dict1[k] & index_to_mask(dict2[k], len(dict1[k])) for k in dict1 }
-        
         for key in kwargs:
             value = kwargs[key]
             if key.endswith('_index'):
@@ -618,25 +857,47 @@ class ChemicalEntity(object):
                     value = [value]
                 
                 dim = key[:-len('_index')]
-                m = self._propagate_dim(value, dim)
-                masks = masks_and(masks, m)
+                mask = index_to_mask(normalize_index(value), self.dimensions[dim])
             else:
                 attribute = self.get_attribute(key)
+                dim = attribute.dim
                 
-                if isinstance(value, list):
-                    mask = reduce(operator.or_, [attribute.value == m for m in value])
+                values = value if isinstance(value, list) else [value]
+                if (is_string_attribute(attribute) and 
+                    all(isinstance(v, string_types) for v in values)):
+                    # Look up the values in the inverted index
+                    mask = attribute.mask_of(values)
+                elif isinstance(value, list):
+                    mask = reduce(operator.or_, [attribute._peek() == m for m in value])
                 else:
-                    mask = attribute.value == value
+                    mask = attribute._peek() == value
             
-                m = self._propagate_dim(mask, attribute.dim)
-                masks = masks_and(masks, m)
+            m = self._propagate_mask(mask, dim)
+            masks = {k: masks[k] & m[k] for k in masks}
         
         return masks
     
-    def sub(self, inplace=False, **kwargs):
-        """Return a entity where the conditions are met"""
+    def sub(self, inplace=False, view=False, **kwargs):
+        """Return a entity where the conditions are met.
+        
+        The conditions are the same accepted by :meth:`where`.
+        
+        If *view* is True, the attributes of the returned entity are
+        not copied, but they refer to the data of this entity. Their
+        values are gathered only when they are first accessed, and
+        contiguous selections (for example whole molecules) don't
+        require any copy at all. The values of a view are read-only
+        until they are either reassigned or :meth:`materialize` is called.
+        
+        **Example**
+        ::
+        
+            water = s.sub(molecule_name='SOL', view=True)
+            water.r_array # Only the coordinates are gathered
+        
+        """
         filter_ = self.where(**kwargs)
-        return self.subindex(filter_, inplace)
+        return self.subindex(filter_, inplace, view)
         
     def is_empty(self):
         return sum(self.dimensions.values()) == 0
@@ -667,33 +928,101 @@ class ChemicalEntity(object):
     _empty = empty
 
 
+_PROPERTY_DICTS = ('__attributes__', '__relations__', '__fields__')
+
+class PropertyDict(dict):
+    '''Dictionary holding the attributes, relations or fields of a
+    ChemicalEntity. Every change to its content invalidates the
+    property lookup table of the entity.
+    
+    '''
+    def __init__(self, owner, *args, **kwargs):
+        super(PropertyDict, self).__init__(*args, **kwargs)
+        self._owner = weakref.ref(owner)
+    
+    def _changed(self):
+        owner = self._owner()
+        if owner is not None:
+            owner._invalidate_lookup()
+    
+    def __setitem__(self, key, value):
+        super(PropertyDict, self).__setitem__(key, value)
+        self._changed()
+
+    def __delitem__(self, key):
+        super(PropertyDict, self).__delitem__(key)
+        self._changed()
+    
+    def update(self, *args, **kwargs):
+        super(PropertyDict, self).update(*args, **kwargs)
+        self._changed()
+    
+    def setdefault(self, key, default=None):
+        result = super(PropertyDict, self).setdefault(key, default)
+        self._changed()
+        return result
+    
+    def pop(self, *args):
+        result = super(PropertyDict, self).pop(*args)
+        self._changed()
+        return result
+    
+    def popitem(self):
+        result = super(PropertyDict, self).popitem()
+        self._changed()
+        return result
+    
+    def clear(self):
+        super(PropertyDict, self).clear()
+        self._changed()
+    
+    def __reduce__(self):
+        return dict, (dict(self),)
+
 class Query(object):
     
     def select(self):
         pass
 
 def concatenate_relations(relations):
+    '''Concatenate InstanceRelation to return a bigger one. The
+    values of each relation are shifted to refer to its part of the
+    new index.'''
     tpl = relations[0]
     
     rel = tpl.copy()
     rel.alias = None
-    rel.index = range(sum(len(r.index) for r in relations)) 
+    sizes = [len(r.index) for r in relations]
+    rel.index = range(sum(sizes))
     
     arrays = []
-    iterindex = iter(rel.index)
-    for r in relations:
+    shifts = []
+    offset = 0
+    for r, size in zip(relations, sizes):
         # For a molecule e.index['atom'] = [0, 1, 2]
-        from_map = r.index
         # we remap this to [3, 4, 5]
-        to_map = consume(iterindex, len(r.index))
-        if r.size == 0:
-            continue            
-        arrays.append(r.remap(from_map, to_map, inplace=False).value)
+        if r.size > 0:
+            index = np.asarray(r.index)
+            if (index[-1] - index[0] == size - 1 and 
+                (size < 2 or (np.diff(index) == 1).all())):
+                # The index is contiguous, the values are just shifted
+                arrays.append(r._data)
+                shifts.append(offset - index[0])
+            else:
+                to_map = range(offset, offset + size)
+                arrays.append(r.remap(index, to_map, inplace=False)._data)
+                shifts.append(0)
+        offset += size
     
     if len(arrays) == 0:
-        rel.value = None
+        # Keep empty arrays, as opposed to uninitialized ones
+        empty = [r._data for r in relations if r._data is not None]
+        rel.value = empty[0] if empty else None
     else:
-        rel.value = np.concatenate(arrays, axis=0)
+        value = np.concatenate(arrays, axis=0)
+        shifts = np.repeat(shifts, [len(a) for a in arrays])
+        value += shifts.reshape((-1,) + (1,) * (value.ndim - 1))
+        rel.value = value
     
     return rel
 
@@ -701,14 +1030,42 @@ def concatenate_attributes(attributes):
     '''Concatenate InstanceAttribute to return a bigger one.'''
     # We get a template/
     tpl = attributes[0]
-    attr = InstanceAttribute(tpl.name, tpl.shape, 
-                             tpl.dtype, tpl.dim, alias=None)
+    categorical = all(isinstance(a, InstanceCategoricalAttribute) for a in attributes)
+    if categorical:
+        attr = InstanceCategoricalAttribute(tpl.name, tpl.shape, 
+                                            tpl.dtype, tpl.dim, alias=None)
+    else:
+        attr = InstanceAttribute(tpl.name, tpl.shape, 
+                                 tpl.dtype, tpl.dim, alias=None)
     
     # Special case, not a single array has size bigger than 0
-    if all(a.size == 0 for a in attributes):
+    attributes = [a for a in attributes if a.size > 0]
+    if len(attributes) == 0:
+        return attr
+    elif categorical:
+        # Merge the categories and translate the codes (the values
+        # that were read are encoded again). Copies share the same
+        # categories, so they are merged only once.
+        encoded = [a.encoded() for a in attributes]
+        tables = {}
+        for cats, _ in encoded:
+            tables.setdefault(id(cats), cats)
+        tables = list(tables.values())
+        starts = np.cumsum([0] + [len(t) for t in tables])
+        start_of = {id(t): start for t, start in zip(tables, starts)}
+        
+        categories, table = encode_categories(encoded[0][0], np.concatenate(tables))
+        # The offsets into the merged tables may not fit in the type
+        # of the codes, only the result of the lookup does
+        codes = np.concatenate([c for _, c in encoded]).astype(np.intp)
+        codes += np.repeat(np.array([start_of[id(cats)] for cats, _ in encoded], dtype=np.intp), 
+                           [a.size for a in attributes])
+        
+        attr.categories = categories
+        attr._store(table.take(codes))
         return attr
     else: 
-        attr.value = np.concatenate([a.value for a in attributes if a.size > 0], axis=0)
+        attr.value = np.concatenate([a._peek() for a in attributes], axis=0)
         return attr
 
 def concatenate_fields(fields, dim):
@@ -726,6 +1083,67 @@ def concatenate_fields(fields, dim):
     return attr
 
 
+def tile_relations(relation, n):
+    '''Concatenate *n* copies of an InstanceRelation, equivalent to
+    ``concatenate_relations([relation] * n)``.'''
+    rel = relation.copy()
+    rel.alias = None
+    size = len(relation.index)
+    rel.index = range(size * n)
+    
+    if relation.size == 0:
+        rel.value = relation._data
+        return rel
+    
+    # Position of each value in the index, shifted for each copy
+    index = np.asarray(relation.index)
+    order = np.argsort(index, kind='mergesort')
+    value = order[np.searchsorted(index, relation._data, sorter=order)]
+    offsets = np.arange(n) * size
+    value = value[np.newaxis] + offsets.reshape((n,) + (1,) * value.ndim)
+    rel.value = value.reshape((-1,) + value.shape[2:])
+    return rel
+
+def tile_attributes(attribute, n):
+    '''Concatenate *n* copies of an InstanceAttribute, equivalent to
+    ``concatenate_attributes([attribute] * n)``.'''
+    attr = attribute._shallow_copy()
+    attr.alias = None
+    
+    if attribute.size > 0 and n > 0:
+        # For categorical attributes this tiles the codes 
+        value = attribute._data
+        attr._store(np.tile(value, (n,) + (1,) * (value.ndim - 1)))
+    else:
+        attr._store(None)
+    return attr
+
+def tile_fields(field, n, dim):
+    '''Create an InstanceAttribute made of *n* copies of an
+    InstanceField, equivalent to ``concatenate_fields([field] * n, dim)``.'''
+    attr = InstanceAttribute(field.name, shape=field.shape, dtype=field.dtype, 
+                             dim=dim, alias=None)
+    attr.value = np.array([field.value] * n, dtype=field.dtype)
+    return attr
+
+def as_kind(attribute, new):
+    '''Return the InstanceAttribute *new* as the same kind
+    (plain or categorical) of *attribute*.'''
+    if type(new) is type(attribute):
+        return new
+    
+    attr = type(attribute)(new.name, new.shape, attribute.dtype, new.dim, alias=None)
+    attr.value = new._peek()
+    return attr
+
+def is_string_attribute(attribute):
+    '''Check if *attribute* is an InstanceAttribute containing strings.'''
+    if isinstance(attribute, InstanceCategoricalAttribute):
+        return attribute._data is not None
+    return (isinstance(attribute, InstanceAttribute) and 
+            attribute._data is not None and 
+            attribute._data.dtype.kind in 'US')
+
 #TODO: move the utilities
 def merge_dicts(*dict_args):
     '''
@@ -742,6 +1160,12 @@ def consume(iterator, n):
     return list(islice(iterator, 0, n))
 
 
+def index_to_mask(index, n):
+    """Convert an index array to a boolean mask of size *n*"""
+    val = np.zeros(n, dtype='bool')
+    val[index] = True
+    return val
+
 def normalize_index(index):
     """normalize numpy index"""
     index = np.asarray(index)
@@ -4,28 +4,26 @@ from collections import Counter
 from copy import copy
 
 from .base import ChemicalEntity
-from .attributes import Attribute, Relation, Field
+from .attributes import Attribute, CategoricalAttribute, Relation, Field
 
 from ..utils.formula import make_formula
 from ..db import ChemlabDB
-from ..libs.ckdtree import cKDTree
+from ..utils.neighbors import neighbor_pairs
 cdb = ChemlabDB()
 
-masses = cdb.get("data", "massdict")
-
 class Molecule(ChemicalEntity):
     __dimension__ = 'molecule'
     
     __attributes__ = {
         'r_array' : Attribute(shape=(3,), dtype='float', dim='atom', alias="coords"),
-        'type_array' : Attribute(dtype='unicode', dim='atom'),
+        'type_array' : CategoricalAttribute(dim='atom'),
         'charge_array' : Attribute(dim='atom'),
         'atom_export' : Attribute(dtype=object, dim='atom'),
-        'atom_name' : Attribute(dtype='unicode', dim='atom'),
+        'atom_name' : CategoricalAttribute(dim='atom'),
         
         'bond_orders' : Attribute(dtype='int', dim='bond'),
         
-        'residue_name' : Attribute(dtype='unicode', dim='residue'),
+        'residue_name' : CategoricalAttribute(dim='residue'),
         'residue_id' : Attribute(dtype='uint32', dim='residue'),
         
         'secondary_structure' : Attribute(dtype='unicode', dim='residue'),
@@ -78,38 +76,38 @@ class Molecule(ChemicalEntity):
         self.r_array += dx
 
 
-def guess_bonds(r_array, type_array, threshold=0.1, maxradius=0.3, radii_dict=None):
+def guess_bonds(r_array, type_array, threshold=0.1, maxradius=0.3, radii_dict=None,
+                box_vectors=None):
     '''Detect bonds given the coordinates (r_array) and types of the 
     atoms involved (type_array), based on their covalent radii.
     
     To fine-tune the detection, it is possible to set a **threshold** and a 
     maximum search radius **maxradius**, and the radii lookup **radii_dict**.
+    
+    If **box_vectors** is not None, the bonds are searched considering
+    periodic boundary conditions (the box can be triclinic).
     '''
     if radii_dict is None:
         covalent_radii = cdb.get('data', 'covalentdict')
     else:
         covalent_radii = radii_dict
     
+    if len(r_array) == 0:
+        return np.zeros((0, 2), dtype='int')
+    
+    # The radii are looked up once for each type
+    types, codes = np.unique(type_array, return_inverse=True)
+    radii = np.array([covalent_radii[t] for t in types])
+    
     # Find all the pairs
-    ck = cKDTree(r_array)
-    pairs = ck.query_pairs(maxradius)
+    cutoff = min(maxradius, 2 * radii.max() + threshold)
+    pairs, dist = neighbor_pairs(r_array, cutoff, box_vectors)
     
-    bonds = []
-    for i,j in pairs:
-        a, b = covalent_radii[type_array[i]], covalent_radii[type_array[j]]
-        rval = a + b
-        
-        thr_a = rval - threshold
-        thr_b = rval + threshold 
-        
-        thr_a2 = thr_a**2
-        thr_b2 = thr_b**2
-        
-        dr2  = ((r_array[i] - r_array[j])**2).sum()
-        # print(thr_a, dr2**0.5, thr_b)
-        if thr_a2 < dr2 < thr_b2:
-            bonds.append((i, j))
-    return np.array(bonds)
+    rval = radii[codes[pairs[:, 0]]] + radii[codes[pairs[:, 1]]]
+    thr_a2 = (rval - threshold)**2
+    thr_b2 = (rval + threshold)**2
+    dr2 = dist**2
+    return pairs[(thr_a2 < dr2) & (dr2 < thr_b2)]
     
 def make_formula(elements):
     c = Counter(elements)
@@ -2,8 +2,10 @@
 from __future__ import print_function
 import numpy as np
 from .system import System
-from ..utils._covertree import cCoverTree as CoverTree
 from ..table import vdw_radius
+from ..utils.geometry import quaternion_matrices, random_quaternions
+from ..utils.neighbors import neighbor_pairs, _cell_spacing
+from ..utils.celllinkedlist import CellLinkedList
 
 def meshgrid2(*arrs):
     arrs = tuple(arrs)  #edit
@@ -91,80 +93,313 @@ def random_lattice_box(mol_list, mol_number, size,
     
     # Initialize a system
     s = System.empty()
-    with s.batch() as b:
-        mol_list = [m.copy() for m in mol_list]
-        # Add the molecules
-        pi = 0
-        for i, mol in enumerate(mol_list):
-            for j in range(mol_number[i]):
-                mol.move_to(positions[pi])
-                b.append(mol.copy())
-                pi += 1
-            
+    # Add the molecules, the first atom of each copy is placed on the
+    # lattice point (as Molecule.move_to does)
+    pi = 0
+    for mol, nmol in zip(mol_list, mol_number):
+        if nmol == 0:
+            continue
+        offsets = positions[pi:pi + nmol] - mol.r_array[0]
+        s.concat(System.from_template(mol, nmol, offsets), inplace=True)
+        pi += nmol
+    
     return s
 
 
 
-def random_box(molecules, total=None, proportions=None, size=[1.,1.,1.], maxtries=100):
-    '''Create a System made of a series of random molecules.
-    
-    Parameters:
-    
-    total:
-    molecules:
-    proportions:
+# Offsets of a cell and its 26 neighbors
+# The overlapping atoms are pushed a bit farther than the contact distance
+_MARGIN = 1.05
+
+
+def _contacts(points, radii, atoms, atom_radii, size, spacing,
+              labels=None, atom_labels=None):
+    # The contacts between the *points* and the *atoms* closer than
+    # the sum of their radii, as a tuple (i, j, delta, distances),
+    # where *delta* is the minimum image vector from the point i to
+    # the atom j. Points and atoms with the same label are not in
+    # contact. The cells are at least *spacing* wide.
+    if len(points) == 0 or len(atoms) == 0:
+        return (np.zeros(0, dtype='int'), np.zeros(0, dtype='int'),
+                np.zeros((0, 3)), np.zeros(0))
+    cells = CellLinkedList(points, spacing, size)
+    i, j, distances = cells.query_pairs(radii.max() + atom_radii.max(),
+                                        CellLinkedList(atoms, spacing, size))
+    hit = distances < radii.take(i) + atom_radii.take(j)
+    if labels is not None:
+        hit &= labels.take(i) != atom_labels.take(j)
+    i, j, distances = i[hit], j[hit], distances[hit]
+    delta = atoms.take(j, axis=0) - points.take(i, axis=0)
+    delta -= size * np.rint(delta / size)
+    return i, j, delta, distances
+
+
+def _overlapping_pairs(coordinates, molecule_index, radii, box_vectors):
+    # Pairs of atoms of different molecules closer than their radii
+    if len(coordinates) == 0:
+        return np.zeros((0, 2), dtype='int'), np.zeros(0)
+    pairs, distances = neighbor_pairs(coordinates, 2 * radii.max(), box_vectors)
+    i, j = pairs.T
+    mask = ((molecule_index[i] != molecule_index[j]) &
+            (distances < radii[i] + radii[j]))
+    return pairs[mask], distances[mask]
+
+
+def _atoms_of(molecules, first, n_atoms):
+    # Indices of the atoms of the molecules, stored contiguously
+    counts = n_atoms[molecules]
+    starts = first[molecules] - np.cumsum(counts) + counts
+    return np.repeat(starts, counts) + np.arange(counts.sum())
+
+
+def _rotation_matrices(vectors):
+    # Rotations of an angle |v| around the axis v (Rodrigues' formula)
+    angles = np.linalg.norm(vectors, axis=1)
+    axes = vectors / np.maximum(angles, 1e-12)[:, np.newaxis]
+    x, y, z = axes.T
+    zero = np.zeros_like(x)
+    K = np.stack([np.stack([zero, -z, y], axis=-1),
+                  np.stack([z, zero, -x], axis=-1),
+                  np.stack([-y, x, zero], axis=-1)], axis=1)
+    s = np.sin(angles)[:, np.newaxis, np.newaxis]
+    c = np.cos(angles)[:, np.newaxis, np.newaxis]
+    return np.identity(3) + s * K + (1 - c) * np.einsum('mij,mjk->mik', K, K)
+
+
+def _relax(centers, rotations, local, molecule_index, radii, active,
+           size, passes, rng):
+    # Push the overlapping molecules apart, as rigid bodies, until
+    # there are no overlaps left. Overlaps can only appear around
+    # the molecules that moved, so each pass looks only at those,
+    # starting from the *active* ones. Returns True on success.
+    n_mol = len(centers)
+    n_atoms = np.bincount(molecule_index, minlength=n_mol)
+    first = np.cumsum(n_atoms) - n_atoms
+    arm = np.einsum('aij,aj->ai', rotations[molecule_index], local)
+    inertia = np.bincount(molecule_index, (arm ** 2).sum(axis=1), minlength=n_mol)
+
+    points = arm + centers[molecule_index]
+    spacing = _cell_spacing(size, 2 * radii.max(), len(points))
+
+    active = np.nonzero(active)[0]
+    is_active = np.zeros(n_mol, dtype='bool')
+    for p in range(passes):
+        is_active[:] = False
+        is_active[active] = True
+        atoms = _atoms_of(active, first, n_atoms)
+        i, j, delta, distances = _contacts(points[atoms], radii[atoms], points, radii,
+                                           size, spacing, molecule_index[atoms],
+                                           molecule_index)
+        i = atoms[i]
+        # The contacts between two active molecules are found twice
+        keep = ~is_active[molecule_index[j]] | (i < j)
+        i, j, delta, distances = i[keep], j[keep], delta[keep], distances[keep]
+        if len(i) == 0:
+            return True
+
+        # Coincident atoms are pushed in a random direction
+        coincident = distances == 0
+        delta[coincident] = rng.normal(size=(coincident.sum(), 3))
+        delta /= np.linalg.norm(delta, axis=1)[:, np.newaxis]
+        # Each atom moves by half of the overlap
+        depth = 0.5 * (_MARGIN * (radii[i] + radii[j]) - distances)
+        push = np.concatenate([-delta, delta]) * np.tile(depth, 2)[:, np.newaxis]
+
+        involved, inverse = np.unique(np.concatenate([i, j]), return_inverse=True)
+        force = np.zeros((len(involved), 3))
+        for k in range(3):
+            force[:, k] = np.bincount(inverse, push[:, k], minlength=len(involved))
+
+        # Rigid body displacement of each molecule
+        active, inverse = np.unique(molecule_index[involved], return_inverse=True)
+        arm = points[involved] - centers[molecule_index[involved]]
+        torque_arm = np.cross(arm, force)
+        translation = np.zeros((len(active), 3))
+        torque = np.zeros((len(active), 3))
+        for k in range(3):
+            translation[:, k] = np.bincount(inverse, force[:, k], minlength=len(active))
+            torque[:, k] = np.bincount(inverse, torque_arm[:, k], minlength=len(active))
+
+        centers[active] += translation / n_atoms[active, np.newaxis]
+        centers[active] %= size
+        angle = torque / np.maximum(inertia[active], 1e-12)[:, np.newaxis]
+        angle *= np.minimum(1.0, 0.5 / np.maximum(np.linalg.norm(angle, axis=1), 1e-12))[:, np.newaxis]
+        rotations[active] = np.einsum('mij,mjk->mik', _rotation_matrices(angle),
+                                      rotations[active])
+
+        moved = _atoms_of(active, first, n_atoms)
+        mi = molecule_index[moved]
+        points[moved] = np.einsum('aij,aj->ai', rotations[mi], local[moved]) + centers[mi]
+
+    return False
+
+
+def random_box(molecules, total=None, proportions=None, size=[1.,1.,1.],
+               maxtries=100, tolerance=None, rotate=True, relax=0,
+               batch_size=4096, seed=None, progress=None):
+    '''Create a System made of molecules placed randomly, without
+    overlaps, in a periodic box.
+
+    The molecules are placed in batches of random positions (and
+    orientations), the candidates overlapping with the molecules
+    already placed are found with a cell list and tried again,
+    up to *maxtries* times each. This makes it possible to build
+    dense boxes of millions of atoms.
+
+    If *relax* is greater than zero, the molecules that still overlap
+    after *maxtries* attempts are placed anyway, and then all the
+    molecules are pushed apart in at most *relax* relaxation passes,
+    similarly to what Packmol does.
+
+    **Parameters**
+
+    molecules: list of Molecule instances
+       The template of each kind of molecule.
+    total: int
+       Total number of molecules.
+    proportions: list of float or None
+       The fraction of molecules of each kind, by default all the
+       kinds have the same proportion.
+    size: np.ndarray((3,), float)
+       The box size in nm.
+    maxtries: int
+       Number of attempts at placing each molecule.
+    tolerance: float or None
+       Minimum distance between atoms of different molecules. If None
+       two atoms overlap when they are closer than the sum of their
+       van der Waals radii.
+    rotate: bool
+       Give a random orientation to each molecule.
+    relax: int
+       Maximum number of relaxation passes.
+    batch_size: int
+       Number of molecules that are tried at the same time.
+    seed: int or None
+       Seed of the random number generator, for reproducible boxes.
+    progress: callable or None
+       Function called as ``progress(placed, total)`` after each batch.
+
+    **Returns**
+
+    A System instance, with the molecules of each kind next to each
+    other, in the same order of *molecules*.
+
+    **Example**
+
+    A box of 10000 water molecules at about 1 g/cm^3, with at least
+    0.2 nm between the atoms of different molecules::
+
+      water = ChemlabDB().get('molecule', 'example.water')
+      s = random_box([water], total=10000, size=[6.7, 6.7, 6.7],
+                     tolerance=0.2, maxtries=10, relax=1000, seed=42)
+
     '''
-    
     # Setup proportions to be right
     if proportions is None:
         proportions = np.ones(len(molecules)) / len(molecules)
     else:
         proportions = np.array(proportions)
-    
-    size = np.array(size)
-    
-    tree = CoverTree(metric="periodic", metric_args={'cell_lengths': size})
-    
-    type_array = []
-    result = []
-    vdw_radii = []
-    max_vdw = max(vdw_radius(np.concatenate([m.type_array for m in molecules])))
-    
-    first = True
-    for l, n in enumerate((proportions * total).astype(int)):
-        
-        # We try to insert each molecule    
-        for i in range(n):
-            
-            # Attempts
-            for k in range(maxtries):
-                template = molecules[l].copy()
-                reference = np.random.uniform(0, 1, 3) * size
-                r_array = template.r_array + reference
-
-                # Find all collision candidates
-                pts_list, distances_list = tree.query_ball_many(r_array, vdw_radius(template.type_array) + max_vdw)
-                # print pts_list, distances_list
-                # Check if there is any collision
-                ok = True
-                for i, (dist, pts) in enumerate(zip(distances_list, pts_list)):
-                    if len(dist) == 0:
-                        break
-
-                    found_vdw = np.array([vdw_radii[p] for p in pts])
-                    ok &= all(dist > found_vdw + vdw_radius(template.type_array[i]))
-
-                if ok:
-                    tree.insert_many(r_array)
-                    template.r_array = r_array
-                    result.append(template)
-                    vdw_radii.extend(vdw_radius(template.type_array))
-                    break
-            if not ok:
-                raise Exception("Trials exceeded")
-    
-    system = System(result)
-    system.box_vectors[0, 0] = size[0]
-    system.box_vectors[1, 1] = size[1]
-    system.box_vectors[2, 2] = size[2]
+
+    size = np.array(size, dtype='float')
+    rng = np.random.RandomState(seed)
+    counts = (proportions * total).astype(int)
+
+    # Templates centered in the origin, to rotate them
+    templates = []
+    radii = []
+    for mol in molecules:
+        template = mol.copy()
+        template.r_array = mol.r_array - mol.r_array.mean(axis=0)
+        templates.append(template)
+        if tolerance is None:
+            radii.append(vdw_radius(mol.type_array))
+        else:
+            radii.append(np.full(mol.n_atoms, tolerance / 2.0))
+
+    spacing = 2 * max(r.max() for r in radii)
+    if spacing > size.min() / 2:
+        raise ValueError('The box is too small for the molecules')
+
+    n_total = counts.sum()
+    # The atoms placed so far
+    n_atoms = sum(n * t.n_atoms for n, t in zip(counts, templates))
+    spacing = _cell_spacing(size, spacing, n_atoms)
+    atoms_placed = np.empty((n_atoms, 3))
+    radii_placed = np.empty(n_atoms)
+    n_placed = 0
+    placed = 0
+    centers = []
+    rotations = []
+    stuck = []
+    for template, r, n in zip(templates, radii, counts):
+        centers.append(np.empty((n, 3)))
+        rotations.append(np.empty((n, 3, 3)))
+        stuck.append(np.zeros(n, dtype='bool'))
+        tries = np.zeros(n, dtype='int')
+        pending = np.arange(n)
+
+        while len(pending):
+            batch, pending = pending[:batch_size], pending[batch_size:]
+            m = len(batch)
+            c = rng.uniform(0, 1, (m, 3)) * size
+            if rotate:
+                R = quaternion_matrices(random_quaternions(rng.uniform(0, 1, (m, 3))))
+            else:
+                R = np.tile(np.identity(3), (m, 1, 1))
+
+            coordinates = np.einsum('mij,aj->mai', R, template.r_array) + c[:, np.newaxis]
+            batch_radii = np.tile(r, m)
+            i = _contacts(coordinates.reshape(-1, 3), batch_radii, atoms_placed[:n_placed],
+                          radii_placed[:n_placed], size, spacing)[0]
+            ok = np.bincount(i // template.n_atoms, minlength=m) == 0
+
+            # Overlaps between molecules of the same batch, the
+            # first one of each pair gets in
+            accepted = np.nonzero(ok)[0]
+            atoms = coordinates[accepted].reshape(-1, 3)
+            molecule_index = np.repeat(accepted, template.n_atoms)
+            pairs, _ = _overlapping_pairs(atoms, molecule_index,
+                                          batch_radii[:len(atoms)], np.diag(size))
+            ok[molecule_index[pairs].max(axis=1)] = False
+
+            tries[batch[~ok]] += 1
+            exceeded = ~ok & (tries[batch] >= maxtries)
+            if exceeded.any():
+                if not relax:
+                    raise Exception("Trials exceeded")
+                # Those will be fixed by the relaxation
+                ok |= exceeded
+                stuck[-1][batch[exceeded]] = True
+
+            centers[-1][batch[ok]] = c[ok]
+            rotations[-1][batch[ok]] = R[ok]
+            n_new = ok.sum() * template.n_atoms
+            atoms_placed[n_placed:n_placed + n_new] = coordinates[ok].reshape(-1, 3)
+            radii_placed[n_placed:n_placed + n_new] = batch_radii[:n_new]
+            n_placed += n_new
+            pending = np.concatenate([batch[~ok], pending])
+
+            placed += ok.sum()
+            if progress is not None:
+                progress(placed, n_total)
+
+    stuck = np.concatenate(stuck)
+    if stuck.any():
+        split = np.cumsum(counts)[:-1]
+        all_centers = np.concatenate(centers)
+        all_rotations = np.concatenate(rotations)
+        local = np.concatenate([np.tile(t.r_array, (n, 1))
+                                for t, n in zip(templates, counts)])
+        molecule_index = np.repeat(np.arange(n_total),
+                                   np.repeat([t.n_atoms for t in templates], counts))
+        all_radii = np.concatenate([np.tile(r, n) for r, n in zip(radii, counts)])
+        if not _relax(all_centers, all_rotations, local, molecule_index,
+                      all_radii, stuck, size, relax, rng):
+            raise Exception("Overlaps left after {} relaxation passes".format(relax))
+        centers = np.split(all_centers, split)
+        rotations = np.split(all_rotations, split)
+
+    system = System.concatenate([System.from_template(t, n, c, R)
+                                 for t, n, c, R in zip(templates, counts, centers, rotations)])
+    system.box_vectors = np.diag(size)
     return system
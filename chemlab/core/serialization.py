@@ -1,6 +1,7 @@
 from __future__ import division, print_function
 
 import json
+import os
 from collections import Iterable, OrderedDict, namedtuple
 
 import numpy as np
@@ -14,28 +15,32 @@ def isnamedtuple(obj):
            and hasattr(obj, "_asdict") \
            and callable(obj._asdict)
 
-def serialize(data):
+def serialize(data, array_hook=None):
     if data is None or isinstance(data, (bool, int, float, str, string_types)):
         return data
     if isinstance(data, list):
-        return [serialize(val) for val in data]
+        return [serialize(val, array_hook) for val in data]
     if isinstance(data, OrderedDict):
         return {"py/collections.OrderedDict":
-                [[serialize(k), serialize(v)] for k, v in data.items()]}
+                [[serialize(k, array_hook), serialize(v, array_hook)] for k, v in data.items()]}
     if isnamedtuple(data):
         return {"py/collections.namedtuple": {
             "type":   type(data).__name__,
             "fields": list(data._fields),
-            "values": [serialize(getattr(data, f)) for f in data._fields]}}
+            "values": [serialize(getattr(data, f), array_hook) for f in data._fields]}}
     if isinstance(data, dict):
         if all(isinstance(k, str) for k in data):
-            return {k: serialize(v) for k, v in data.items()}
-        return {"py/dict": [[serialize(k), serialize(v)] for k, v in data.items()]}
+            return {k: serialize(v, array_hook) for k, v in data.items()}
+        return {"py/dict": [[serialize(k, array_hook), serialize(v, array_hook)] for k, v in data.items()]}
     if isinstance(data, tuple):
-        return {"py/tuple": [serialize(val) for val in data]}
+        return {"py/tuple": [serialize(val, array_hook) for val in data]}
     if isinstance(data, set):
-        return {"py/set": [serialize(val) for val in data]}
+        return {"py/set": [serialize(val, array_hook) for val in data]}
+    if isinstance(data, np.generic):
+        return data.item()
     if isinstance(data, np.ndarray):
+        if array_hook is not None and data.dtype != object:
+            return array_hook(data)
         return {"py/numpy.ndarray": {
             "values": data.tolist(),
             "dtype":  str(data.dtype)}}
@@ -63,3 +68,40 @@ def data_to_json(data):
 
 def json_to_data(s):
     return json.loads(s, object_hook=restore)
+
+def data_to_directory(data, directory):
+    """Store *data* in *directory*, numeric and string arrays are saved
+    as .npy files while everything else goes in a json header
+    (header.json).
+
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    
+    filenames = []
+    def save_array(array):
+        filename = "array{}.npy".format(len(filenames))
+        np.save(os.path.join(directory, filename), array, allow_pickle=False)
+        filenames.append(filename)
+        return {"py/numpy.npy": filename}
+    
+    header = json.dumps(serialize(data, save_array))
+    # The header is written last, so that an interrupted store
+    # can't be read back
+    with open(os.path.join(directory, "header.json"), "w") as fd:
+        fd.write(header)
+
+def directory_to_data(directory, mmap_mode=None):
+    """Read the data stored by *data_to_directory*. When *mmap_mode*
+    is specified (see :py:func:`numpy.load`) the arrays are memory
+    mapped instead of read in memory.
+
+    """
+    def restore_array(dct):
+        if "py/numpy.npy" in dct:
+            return np.load(os.path.join(directory, dct["py/numpy.npy"]),
+                           mmap_mode=mmap_mode, allow_pickle=False)
+        return restore(dct)
+    
+    with open(os.path.join(directory, "header.json")) as fd:
+        return json.load(fd, object_hook=restore_array)
@@ -16,6 +16,7 @@ from collections import Counter
 
 from .spacegroup import Spacegroup
 from ..system import System
+from ..attributes import inverse_permutation
 from .cell import cellpar_to_cell
 
 
@@ -52,24 +53,34 @@ def crystal(positions, molecules, group,
     '''
     sp = Spacegroup(group)
     sites, kind = sp.equivalent_sites(positions)
+    kind = np.asarray(kind, dtype='int')
 
     nx, ny, nz = repetitions
-    reptot = nx*ny*nz
     
     # Unit cell parameters
-    a,b,c = cellpar_to_cell(cellpar)
+    cell = cellpar_to_cell(cellpar)
+    a, b, c = cell
+    
+    # Origin of every molecule, the unit cells are in the same order
+    # of the nested loops over x, y and z
+    translations = np.indices((nx, ny, nz)).reshape(3, -1).T
+    origins = (translations[:, np.newaxis, :] + sites).reshape(-1, 3).dot(cell)
+    kinds = np.tile(kind, len(translations))
+    
+    # The molecules of each kind are replicated at once, with their
+    # first atom placed on the site
+    parts = []
+    for ki, tpl in enumerate(molecules):
+        where = kinds == ki
+        parts.append(System.from_template(tpl, where.sum(), 
+                                          origins[where] - tpl.r_array[0]))
+    cry = System.concatenate(parts)
+    
+    if len(molecules) > 1:
+        # Restore the order of the sites
+        cry.reorder_dimension(inverse_permutation(np.argsort(kinds, kind='mergesort')), 
+                              'molecule')
     
-    cry = System()
-    i = 0
-    with cry.batch() as batch:
-        for x in range(nx):
-            for y in range(ny):
-                for z in range(nz):
-                    for s, ki in zip(sites, kind):
-                        tpl = molecules[ki]
-                        tpl.move_to(s[0]*a +s[1]*b + s[2]*c + a*x + b*y + c*z)
-                        batch.append(tpl.copy())
-
     # Computing the box_vectors
     cry.box_vectors = np.array([a*nx, b*ny, c*nz])
     
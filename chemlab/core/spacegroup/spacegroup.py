@@ -3,7 +3,8 @@
 
 """Definition of the Spacegroup class.
 
-This module only depends on NumPy and the space group database.
+This module only depends on NumPy, the space group database and the
+neighbor search in chemlab.utils.
 """
 
 import os
@@ -11,6 +12,8 @@ import warnings
 
 import numpy as np
 
+from ...utils.neighbors import neighbor_pairs
+
 __all__ = ['Spacegroup']
 
 
@@ -349,42 +352,48 @@ class Spacegroup(object):
         >>> kinds
         [0, 0, 0, 0, 1, 1, 1, 1]
         """
-        kinds = []
-        sites = []
-        symprec2 = symprec**2
-        scaled = np.array(scaled_positions, ndmin=2)
-        for kind, pos in enumerate(scaled):
-            for rot, trans in self.get_symop():
-                site = np.mod(np.dot(rot, pos) + trans, 1.)
-                if not sites:
-                    sites.append(site)
-                    kinds.append(kind)
-                    continue
-                t = site - sites
-                mask = np.sum(t*t, 1) < symprec2
-                if np.any(mask):
-                    ind = np.argwhere(mask)[0][0]
-                    if kinds[ind] == kind:
-                        pass
-                    elif ondublicates == 'keep':
-                        pass
-                    elif ondublicates == 'replace':
-                        kinds[ind] = kind
-                    elif ondublicates == 'warn':
-                        warnings.warn('scaled_positions %d and %d '
-                                      'are equivalent'%(kinds[ind], kind))
-                    elif ondublicates == 'error':
-                        raise SpacegroupValueError(
-                            'scaled_positions %d and %d are equivalent'%(
-                                kinds[ind], kind))
-                    else:
-                        raise SpacegroupValueError(
-                            'Argument "ondublicates" must be one of: '
-                            '"keep", "replace", "warn" or "error".')
-                else:
-                    sites.append(site)
-                    kinds.append(kind)
-        return np.array(sites), kinds
+        if ondublicates not in ('keep', 'replace', 'warn', 'error'):
+            raise SpacegroupValueError(
+                'Argument "ondublicates" must be one of: '
+                '"keep", "replace", "warn" or "error".')
+        
+        # All the operations are applied to all the positions at once
+        scaled = np.array(scaled_positions, ndmin=2, dtype=float)
+        symop = self.get_symop()
+        rot = np.array([r for r, t in symop])
+        trans = np.array([t for r, t in symop])
+        sites = np.mod(np.einsum('oij,kj->koi', rot, scaled) + trans, 1.)
+        sites = sites.reshape(-1, 3)
+        kinds = np.repeat(np.arange(len(scaled)), len(symop))
+        
+        # Pairs of equivalent sites, the periodic images are
+        # considered too (0.0 and 0.9999 are the same site)
+        pairs = neighbor_pairs(sites, symprec, box_vectors=np.eye(3))[0]
+        duplicate = np.zeros(len(sites), dtype='bool')
+        duplicate[pairs[:, 1]] = True
+        
+        # Each duplicate is attributed to the first site it is
+        # equivalent to
+        pairs = pairs[~duplicate[pairs[:, 0]]]
+        pairs = pairs[np.lexsort((pairs[:, 0], pairs[:, 1]))]
+        first = np.unique(pairs[:, 1], return_index=True)[1]
+        pairs = pairs[first]
+        
+        conflicts = pairs[kinds[pairs[:, 0]] != kinds[pairs[:, 1]]]
+        if len(conflicts) > 0:
+            if ondublicates == 'replace':
+                kinds[conflicts[:, 0]] = kinds[conflicts[:, 1]]
+            elif ondublicates == 'warn':
+                for i, j in conflicts:
+                    warnings.warn('scaled_positions %d and %d '
+                                  'are equivalent'%(kinds[i], kinds[j]))
+            elif ondublicates == 'error':
+                i, j = conflicts[0]
+                raise SpacegroupValueError(
+                    'scaled_positions %d and %d are equivalent'%(
+                        kinds[i], kinds[j]))
+        
+        return sites[~duplicate], kinds[~duplicate].tolist()
 
     def symmetry_normalised_sites(self, scaled_positions):
         """Returns an array of same size as *scaled_positions*,
@@ -6,28 +6,32 @@ import operator
 from functools import reduce
 from collections import Counter
 
-from .base import ChemicalEntity, Field, Attribute, Relation, InstanceRelation
+from .base import (ChemicalEntity, Field, Attribute, Relation, InstanceRelation,
+                   CategoricalAttribute,
+                   index_to_mask)
 from .atom import Atom
 from .molecule import Molecule
+from ..utils.formula import make_formula
 from .serialization import json_to_data, data_to_json
 
 from ..utils.pbc import periodic_distance, minimum_image
-from ..libs.ckdtree import cKDTree
-from ..graphics import Scene
+from ..utils.geometry import quaternion_matrices
+from ..utils.neighbors import neighbor_pairs
+from ..table import atomic_weight
 
 class System(ChemicalEntity):
     __dimension__ = 'system'
     __attributes__ = {
         'r_array' : Attribute(shape=(3,), dtype='float', dim='atom', alias="coords"),
-        'type_array' : Attribute(dtype='unicode', dim='atom'),
+        'type_array' : CategoricalAttribute(dim='atom'),
         'charge_array' : Attribute(dim='atom'),
-        'molecule_name' : Attribute(dtype='unicode', dim='molecule'),
+        'molecule_name' : CategoricalAttribute(dim='molecule'),
         'bond_orders' : Attribute(dtype='int', dim='bond'),
         'atom_export' : Attribute(dtype=object, dim='atom'),
         'molecule_export' : Attribute(dtype=object, dim='molecule'),
-        'atom_name' : Attribute(dtype='unicode', dim='atom'),
+        'atom_name' : CategoricalAttribute(dim='atom'),
         
-        'residue_name' : Attribute(dtype='unicode', dim='residue'),
+        'residue_name' : CategoricalAttribute(dim='residue'),
         'residue_id' : Attribute(dtype='uint32', dim='residue'),
         
         'secondary_structure' : Attribute(dtype='unicode', dim='residue'),
@@ -187,6 +191,173 @@ class System(ChemicalEntity):
         
         return super(System, cls).from_arrays(**kwargs)
 
+    @classmethod
+    def from_template(cls, template, n, positions=None, rotations=None,
+                      box_vectors=None):
+        '''Initialize a System made of *n* copies of the Molecule
+        *template*. The arrays of the template (including bonds and
+        maps) are replicated all at once, which is much faster than
+        adding copies of the molecule one by one.
+        
+        **Parameters**
+        
+        template: Molecule
+           The molecule to replicate.
+        n: int
+           Number of copies.
+        positions: np.ndarray((n, 3), float) or None
+           Translation applied to each copy.
+        rotations: np.ndarray((n, 3, 3)) or np.ndarray((n, 4)) or None
+           Rotation applied to each copy, before the translation,
+           either as rotation matrices or as quaternions (w, x, y,
+           z). The rotation is around the origin, you may want to
+           center the template first.
+        box_vectors: np.ndarray((3, 3), float) or None
+           The box vectors of the System.
+        
+        **Example**
+        
+        A box of 1000 randomly oriented water molecules on a lattice::
+        
+            from chemlab.utils.geometry import random_quaternion
+            
+            water = ChemlabDB().get('molecule', 'example.water')
+            positions = spaced_lattice([4.0, 4.0, 4.0], [0.3, 0.3, 0.3])[:1000]
+            rotations = [random_quaternion() for i in range(1000)]
+            s = System.from_template(water, 1000, positions, rotations)
+        
+        '''
+        s = cls.empty()
+        s._from_template(template, n, 'molecule')
+        
+        if box_vectors is not None:
+            s.box_vectors = box_vectors
+        
+        if n == 0 or template.r_array is None:
+            return s
+        
+        r = template.r_array
+        if rotations is not None:
+            rotations = np.asarray(rotations, dtype='float')
+            if rotations.shape[1:] == (4,):
+                rotations = quaternion_matrices(rotations)
+            if rotations.shape != (n, 3, 3):
+                raise ValueError('rotations should have shape ({0}, 3, 3) or ({0}, 4)'.format(n))
+            coords = np.matmul(r, rotations.transpose(0, 2, 1))
+        else:
+            coords = np.broadcast_to(r, (n,) + r.shape)
+        
+        if positions is not None:
+            positions = np.asarray(positions, dtype='float')
+            if positions.shape != (n, 3):
+                raise ValueError('positions should have shape ({}, 3)'.format(n))
+            coords = coords + positions[:, np.newaxis, :]
+        
+        s.r_array = coords.reshape(-1, 3)
+        return s
+    
+    def molecule_reduce(self, func_name, r_array=None):
+        '''Compute a quantity for each molecule of the system, without
+        iterating over the molecules. The atomic quantities are summed
+        with :py:func:`numpy.add.reduceat` over the atom to molecule
+        map.
+        
+        **Parameters**
+        
+        func_name: str
+           One of 'geometric_center', 'center_of_mass',
+           'dipole_moment', 'radius_of_gyration', 'mass', 'charge' or
+           'formula'.
+        r_array: np.ndarray((n_atoms, 3)) or np.ndarray((n_frames, n_atoms, 3))
+           The coordinates to use, by default the ones of the
+           system. Passing the coordinates of a whole trajectory
+           reduces every frame at once.
+        
+        **Returns**
+        
+        An array of shape (n_mol, ...) or, for a block of frames,
+        (n_frames, n_mol, ...).
+        
+        **Example**
+        
+        The center of mass of each molecule in every frame::
+        
+            coords = datafile('traj.xtc').read('trajectory')
+            com = s.molecule_reduce('center_of_mass', coords)
+        
+        '''
+        if func_name == 'formula':
+            return self._molecule_formulas()
+        if func_name == 'mass':
+            return self._molecule_sum(self._atom_masses())
+        if func_name == 'charge':
+            return self._molecule_sum(self.charge_array)
+        
+        r_array = self.r_array if r_array is None else np.asarray(r_array)
+        axis = r_array.ndim - 2
+        
+        if func_name == 'geometric_center':
+            weights = np.ones(self.n_atoms)
+        elif func_name in ('center_of_mass', 'radius_of_gyration'):
+            weights = self._atom_masses()
+        elif func_name == 'dipole_moment':
+            return self._molecule_sum(r_array * self.charge_array[:, np.newaxis], axis)
+        else:
+            raise ValueError('Unknown function {}'.format(func_name))
+        
+        total = self._molecule_sum(weights)[:, np.newaxis]
+        center = self._molecule_sum(r_array * weights[:, np.newaxis], axis) / total
+        if func_name == 'radius_of_gyration':
+            # Distance of each atom from the center of its molecule
+            atom_center = center.take(self.maps['atom', 'molecule'].value, axis=axis)
+            sq = ((r_array - atom_center) ** 2).sum(axis=-1)
+            return np.sqrt(self._molecule_sum(sq * weights, axis) / total[:, 0])
+        return center
+    
+    def _molecule_sum(self, values, axis=0):
+        # Sum atomic values (along *axis*) for each molecule
+        values = np.asarray(values)
+        order, offsets = self.maps['atom', 'molecule'].groups()
+        if order is not None:
+            values = values.take(order, axis=axis)
+        
+        shape = list(values.shape)
+        shape[axis] = self.n_mol
+        if values.shape[axis] == 0:
+            return np.zeros(shape, dtype=values.dtype)
+        
+        # reduceat doesn't handle empty segments, the others are
+        # summed and the empty ones are left at 0
+        empty = offsets[1:] == offsets[:-1]
+        if not empty.any():
+            return np.add.reduceat(values, offsets[:-1], axis=axis)
+        
+        result = np.zeros(shape, dtype=values.dtype)
+        result[(slice(None),) * axis + (~empty,)] = np.add.reduceat(
+            values, offsets[:-1][~empty], axis=axis)
+        return result
+    
+    def _atom_masses(self):
+        # Only the categories actually used are looked up
+        categories, codes = self.get_attribute('type_array').encoded()
+        used = np.bincount(codes, minlength=len(categories)) > 0
+        weights = np.zeros(len(categories))
+        weights[used] = atomic_weight(categories[used])
+        return weights.take(codes)
+    
+    def _molecule_formulas(self):
+        # Count the atoms of each type in each molecule, molecules with
+        # the same composition share the same formula
+        keys, codes = np.unique(self.type_array, return_inverse=True)
+        atom_mol = self.maps['atom', 'molecule'].value
+        counts = np.bincount(atom_mol * len(keys) + codes, 
+                             minlength=self.n_mol * len(keys))
+        counts = counts.reshape(self.n_mol, len(keys))
+        
+        compositions, inverse = np.unique(counts, axis=0, return_inverse=True)
+        formulas = [make_formula(np.repeat(keys, c)) for c in compositions]
+        return np.array(formulas, dtype='unicode')[inverse]
+    
     def get_molecule(self, index):
         return self.subentity(Molecule, index)
     
@@ -230,7 +401,7 @@ class System(ChemicalEntity):
 
         """
         mol_indices = self.atom_to_molecule_indices(indices)
-        self.copy_from(self.sub(molecule_index=mol_indices))
+        self.sub(molecule_index=mol_indices, inplace=True)
 
     def atom_to_molecule_indices(self, selection):
         '''Given the indices over atoms, return the indices over
@@ -247,20 +418,14 @@ class System(ChemicalEntity):
         np.ndarray((N,), dtype=int) an array of molecular indices.
 
         '''
-        return np.unique(self.maps['atom', 'molecule'].value[selection])
+        touched = index_to_mask(self.maps['atom', 'molecule'].value[selection],
+                                self.n_mol)
+        return touched.nonzero()[0]
 
     def where(self, within_of=None, inplace=False, **kwargs):
         """Return indices that met the conditions"""
         masks = super(System, self).where(inplace=inplace, **kwargs)
         
-        def index_to_mask(index, n):
-            val = np.zeros(n, dtype='bool')
-            val[index] = True
-            return val
-        
-        def masks_and(dict1, dict2):
-            return {k: dict1[k] & index_to_mask(dict2[k], len(dict1[k])) for k in dict1 }
-        
         if within_of is not None:
             if self.box_vectors is None:
                 raise Exception('Only periodic distance supported')
@@ -278,8 +443,8 @@ class System(ChemicalEntity):
                                      periodic=self.box_vectors.diagonal())
             
             atoms = (dist <= thr).sum(axis=0, dtype='bool')
-            m = self._propagate_dim(atoms, 'atom')
-            masks = masks_and(masks, m)
+            m = self._propagate_mask(atoms, 'atom')
+            masks = {k: masks[k] & m[k] for k in masks}
         
         return masks
 
@@ -305,6 +470,7 @@ class System(ChemicalEntity):
     
     def scene(self):
         from chemview.utils import get_atom_color
+        from ..graphics import Scene
         scene = Scene()
         scene.add_representation('points', {'coordinates' : self.r_array,
                                             'sizes': [1] * self.n_atoms,
@@ -331,6 +497,13 @@ class MoleculeGenerator(object):
 
         if isinstance(key, int):
             return self.system.get_molecule(key)
+    
+    def __len__(self):
+        return self.system.n_mol
+    
+    def __iter__(self):
+        for i in range(self.system.n_mol):
+            yield self.system.get_molecule(i)
 
 
 class AtomGenerator(object):
@@ -418,12 +591,34 @@ def subsystem_from_atoms(orig, selection):
     '''
     return orig.sub(atom_index=selection, inplace=True)
 
+def _periodic_box(box_vectors):
+    # The box vectors, or None for a non periodic system
+    if box_vectors is None or not np.any(box_vectors):
+        return None
+    return box_vectors
+
+def _overlapping_molecules(sysa, sysb, cutoff, box_vectors=None):
+    # Mask of the molecules of *sysa* that have atoms closer than
+    # *cutoff* to the atoms of *sysb*
+    overlap = np.zeros(sysa.n_mol, dtype='bool')
+    if sysa.n_atoms == 0 or sysb.n_atoms == 0:
+        return overlap
+    
+    pairs, _ = neighbor_pairs(np.concatenate([sysa.r_array, sysb.r_array]),
+                              cutoff, _periodic_box(box_vectors))
+    # In each pair the first index is the smallest one
+    cross = (pairs[:, 0] < sysa.n_atoms) & (pairs[:, 1] >= sysa.n_atoms)
+    overlap[sysa.maps['atom', 'molecule'].value[pairs[cross, 0]]] = True
+    return overlap
+
 def merge_systems(sysa, sysb, bounding=0.2):
     '''Generate a system by merging *sysa* and *sysb*.
 
     Overlapping molecules are removed by cutting the molecules of
     *sysa* that have atoms near the atoms of *sysb*. The cutoff distance
-    is defined by the *bounding* parameter.
+    is defined by the *bounding* parameter. The overlaps are found
+    with a cell list, considering the periodic box of *sysa*, and
+    the result is assembled in a single concatenation.
 
     **Parameters**
 
@@ -435,74 +630,125 @@ def merge_systems(sysa, sysb, bounding=0.2):
        Extra space used when cutting molecules in *sysa* to make space
        for *sysb*. If it is False, no overlap handling will be performed.
 
-    '''
+    **Returns**
 
-    if bounding is not False:
-        # Delete overlaps.
-        if sysa.box_vectors is not None:
-            periodicity = sysa.box_vectors.diagonal()
-        else:
-            periodicity = False
+    A System containing the remaining molecules of *sysa*, followed by
+    the molecules of *sysb*, with the box vectors of *sysa*.
 
-        p = overlapping_points(sysb.r_array, sysa.r_array,
-                               cutoff=bounding, periodic=periodicity)
-
-        sel = np.ones(len(sysa.r_array), dtype=np.bool)
-        sel[p] = False
+    '''
+    if bounding is not False:
+        overlap = _overlapping_molecules(sysa, sysb, bounding, sysa.box_vectors)
+        if overlap.any():
+            sysa = sysa.sub(molecule_index=np.nonzero(~overlap)[0])
+    
+    return System.concatenate([sysa, sysb])
 
-        # Rebuild sysa without water molecules
-        sysa = subsystem_from_atoms(sysa, sel)
+def solvate(solute, solvent_box, box_vectors=None, bounding=0.2):
+    '''Put the *solute* in a box filled with copies of *solvent_box*.
     
-    sysres = System.empty(sysa.n_mol + sysb.n_mol, sysa.n_atoms + sysb.n_atoms)
+    The solvent box is repeated along its box vectors to cover the
+    target box, and the solvent molecules whose geometric center
+    falls outside of the target box are dropped. Then the solvent
+    molecules that have atoms closer than *bounding* to the solute
+    (with periodic boundary conditions) are removed, as a whole.
+    
+    **Parameters**
     
-    # Assign the attributes
-    for attr in type(sysa).attributes:
-        attr.assign(sysres,
-                    attr.concatenate(sysa, sysb))
+    solute: System
+       The system to solvate, for example a protein.
+    solvent_box: System
+       An (equilibrated) box of solvent, it has to have its box
+       vectors.
+    box_vectors: np.ndarray((3, 3), float) or None
+       The box of the result, by default the box of the solute.
+    bounding: float
+       Minimum distance between the atoms of the solute and the
+       solvent.
     
-    # edit the mol_indices and n_mol
-    offset = sysa.mol_indices[-1] + sysa.mol_n_atoms[-1]
-    sysres.mol_indices[0:sysa.n_mol] = sysa.mol_indices.copy()
-    sysres.mol_indices[sysa.n_mol:] = sysb.mol_indices.copy() + offset
-    sysres.mol_n_atoms = np.concatenate([sysa.mol_n_atoms, sysb.mol_n_atoms])
+    **Returns**
     
-    sysres.box_vectors = sysa.box_vectors
+    A System made of the solute molecules followed by the solvent
+    molecules.
     
-    return sysres
+    **Example**
+    
+    Solvate a protein in a cubic box of 10 nm with SPC water::
+    
+        protein = datafile('protein.pdb').read('system')
+        water = datafile('spc216.gro').read('system')
+        s = solvate(protein, water, np.diag([10.0, 10.0, 10.0]))
+    
+    '''
+    if box_vectors is None:
+        box_vectors = _periodic_box(solute.box_vectors)
+        if box_vectors is None:
+            raise ValueError('The solute has no box, pass the box_vectors')
+    box_vectors = np.asarray(box_vectors, dtype='float')
+    
+    cell = _periodic_box(solvent_box.box_vectors)
+    if cell is None:
+        raise ValueError('The solvent box has no box vectors')
+    
+    # Put the center of each solvent molecule in the cell
+    centers = solvent_box.molecule_reduce('geometric_center')
+    image = np.floor(centers.dot(np.linalg.inv(cell))).dot(cell)
+    centers -= image
+    
+    # Repetitions of the cell that cover the corners of the box
+    corners = np.array(np.meshgrid([0, 1], [0, 1], [0, 1])).reshape(3, -1).T
+    corners = corners.dot(box_vectors).dot(np.linalg.inv(cell))
+    ranges = [np.arange(lo, hi) for lo, hi in zip(np.floor(corners.min(axis=0)).astype('int'),
+                                                  np.ceil(corners.max(axis=0)).astype('int'))]
+    shifts = np.array(np.meshgrid(*ranges, indexing='ij')).reshape(3, -1).T.dot(cell)
+    
+    inverse_box = np.linalg.inv(box_vectors)
+    molecule_index = solvent_box.maps['atom', 'molecule'].value
+    parts = []
+    offsets = []
+    for shift in shifts:
+        fractional = (centers + shift).dot(inverse_box)
+        inside = np.all((fractional >= 0) & (fractional < 1), axis=1)
+        if inside.all():
+            parts.append(solvent_box)
+        elif inside.any():
+            parts.append(solvent_box.sub(molecule_index=np.nonzero(inside)[0]))
+        else:
+            continue
+        offsets.append(shift - image[molecule_index if inside.all() else
+                                     molecule_index[inside[molecule_index]]])
+    
+    solvent = System.concatenate(parts)
+    if len(parts):
+        solvent.r_array = solvent.r_array + np.concatenate(offsets)
+    
+    overlap = _overlapping_molecules(solvent, solute, bounding, box_vectors)
+    if overlap.any():
+        solvent = solvent.sub(molecule_index=np.nonzero(~overlap)[0])
+    
+    result = System.concatenate([solute, solvent])
+    result.box_vectors = box_vectors
+    return result
 
 from ..db import ChemlabDB
 cdb = ChemlabDB()
 
-masses = cdb.get("data", "massdict")
-
 # Those functions have a separate life
-def guess_bonds(r_array, type_array, threshold=0.01):
+def guess_bonds(r_array, type_array, threshold=0.01, box_vectors=None):
     covalent_radii = cdb.get('data', 'covalentdict')
     MAXRADIUS = 0.5
     
+    if len(r_array) == 0:
+        return np.zeros((0, 2), dtype='int')
+    
+    types, codes = np.unique(type_array, return_inverse=True)
+    radii = np.array([covalent_radii[t] for t in types])
+    
     # Find all the pairs
-    ck = cKDTree(r_array)
-    pairs = ck.query_pairs(MAXRADIUS)
+    cutoff = min(MAXRADIUS, 2 * radii.max() + threshold)
+    pairs, dist = neighbor_pairs(r_array, cutoff, box_vectors)
     
-    bonds = []
-    for i,j in pairs:
-        a, b = covalent_radii[type_array[i]], covalent_radii[type_array[j]]
-        rval = a + b
-        
-        # print(rval)
-        
-        thr_a = rval - threshold
-        thr_b = rval + threshold 
-        
-        #thr_a2 = thr_a * thr_a
-        thr_b2 = thr_b * thr_b
-        dr2  = ((r_array[i] - r_array[j])**2).sum()
-        
-        # print(dr2)
-        
-        if dr2 < thr_b2:
-            bonds.append((i, j))
-    return np.array(bonds)
+    rval = radii[codes[pairs[:, 0]]] + radii[codes[pairs[:, 1]]]
+    return pairs[dist < rval + threshold]
 
 if __name__ == '__main__':
     test_empty() 
@@ -1,31 +1,225 @@
 """Trajectory class for chemlab"""
+from __future__ import division
+
+import collections
+import functools
+import itertools
+
 import numpy as np
 
+# The attributes that are read from the frames of a reader
+_FRAME_ATTRIBUTES = {'coords': 'coords', 't': 'time', 'boxes': 'box'}
+
+
 class Trajectory(object):
-    
-    def __init__(self, coords, t=None, boxes=None):
+    '''A sequence of frames, each one made of some attributes (the
+    coordinates *coords*, the time *t*, the box vectors *boxes*, and
+    any other attribute set with ``traj[name] = values``).
+
+    The values of each attribute can be anything that can be indexed
+    and sliced by frame, such as a list of arrays, a numpy array, a
+    memory map or an h5py dataset. They are read *chunk_size* frames
+    at a time, so a trajectory stored on disk is never loaded in
+    memory all at once. Trajectories that can only be read
+    sequentially, such as XTC files, can be wrapped with
+    :meth:`from_reader`.
+
+    **Parameters**
+
+    coords: sequence of np.ndarray((n_atoms, 3))
+       The coordinates of each frame.
+    t: sequence of float or None
+       The time of each frame.
+    boxes: sequence of np.ndarray((3, 3)) or None
+       The box vectors of each frame.
+    chunk_size: int
+       Number of frames read at once by :meth:`chunks`, :meth:`map`
+       and :meth:`reduce`.
+
+    '''
+    def __init__(self, coords, t=None, boxes=None, chunk_size=100):
         self._data = {}
+        self._reader = None
+        self.chunk_size = chunk_size
         self.nframes = len(coords)
         self._ignored = set(['_ignored']) | set(self.__dict__.keys())
-         
+
         self.coords = coords
-        self.t = t if t is not None else np.arange(0, self.nframes) 
+        self.t = t if t is not None else np.arange(0, self.nframes)
         self.boxes = boxes if boxes is not None else [None] * self.nframes
 
+    @classmethod
+    def from_reader(cls, reader, nframes=None, chunk_size=100):
+        '''Make a Trajectory that reads its frames sequentially from
+        *reader*, a function returning a fresh iterator over the
+        frames every time it is called. The frames can be arrays of
+        coordinates or objects with the attributes *coords*, *time*
+        and *box* (as the frames of
+        :class:`chemlab.libs.pyxdr.XTCReader`).
+
+        **Example**
+
+        ::
+
+            traj = Trajectory.from_reader(lambda: XTCReader('traj.xtc'))
+            rmsd = list(traj.map(compute_rmsd, 'coords', workers=4))
+
+        '''
+        traj = cls([], chunk_size=chunk_size)
+        traj._reader = reader
+        traj.nframes = nframes
+        for name in _FRAME_ATTRIBUTES:
+            delattr(traj, name)
+        return traj
+
     def __setitem__(self, name, value):
         setattr(self, name, value)
-    
+
     def __getitem__(self, name):
         return getattr(self, name)
-        
+
+    def _names(self, attributes=None):
+        if attributes is None:
+            names = set(self.__dict__.keys()) - self._ignored
+            if self._reader is not None:
+                names |= set(_FRAME_ATTRIBUTES)
+            return sorted(names)
+        if isinstance(attributes, str):
+            return [attributes]
+        return list(attributes)
+
     def at(self, frame, attributes=None):
-        return {k: self[k][frame] for k in set(self.__dict__.keys()) - self._ignored}
-    
-    def map(self, func, attributes=None):
-        for i in range(self.nframes):
-            if attributes is None:
-                yield func({k: self[k][i] for k in set(self.__dict__.keys()) - self._ignored})
-            if isinstance(attributes, str):
-                yield func(self[attributes][i])
-            if isinstance(attributes, list):
-                yield func({a: self[a][i] for a in attrbutes})
+        '''Return the attributes of the frame *frame* as a dictionary.'''
+        if self._reader is None:
+            return {k: self[k][frame] for k in self._names(attributes)}
+
+        block = next(self.chunks(1, attributes, start=frame))
+        return {k: v[0] for k, v in block.items()}
+
+    def chunks(self, chunk_size=None, attributes=None, start=0):
+        '''Iterate over the trajectory in blocks of *chunk_size*
+        frames. Each block is a dictionary of arrays, containing the
+        values of the *attributes* (by default all of them) for those
+        frames.
+
+        '''
+        chunk_size = chunk_size or self.chunk_size
+        names = self._names(attributes)
+
+        if self._reader is None:
+            for begin in range(start, self.nframes, chunk_size):
+                end = min(begin + chunk_size, self.nframes)
+                yield {k: np.asarray(self[k][begin:end]) for k in names}
+            return
+
+        frames = itertools.islice(self._reader(), start, None)
+        begin = start
+        while True:
+            block = list(itertools.islice(frames, chunk_size))
+            if len(block) == 0:
+                return
+            end = begin + len(block)
+
+            result = {}
+            for k in names:
+                if k in _FRAME_ATTRIBUTES:
+                    if isinstance(block[0], np.ndarray):
+                        if k != 'coords':
+                            raise ValueError('The frames only contain the coordinates')
+                        result[k] = np.array(block)
+                    else:
+                        result[k] = np.array([getattr(f, _FRAME_ATTRIBUTES[k]) for f in block])
+                else:
+                    result[k] = np.asarray(self[k][begin:end])
+            yield result
+            begin = end
+
+    def _tasks(self, task, attributes, chunk_size, workers, pool):
+        # Run *task* on each chunk, returning the results in order
+        # with at most 2 * workers chunks in memory at once
+        blocks = self.chunks(chunk_size, attributes)
+        if workers is None or workers <= 1:
+            for block in blocks:
+                yield task(block)
+            return
+
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+        Executor = {'thread': ThreadPoolExecutor,
+                    'process': ProcessPoolExecutor}[pool]
+        with Executor(workers) as executor:
+            pending = collections.deque()
+            for block in blocks:
+                pending.append(executor.submit(task, block))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def map(self, func, attributes=None, chunk_size=None, workers=None,
+            pool='thread'):
+        '''Apply *func* to each frame, and iterate over the results in
+        order.
+
+        **Parameters**
+
+        func: callable
+           The function to apply. If *attributes* is a string, it is
+           called with the value of that attribute for the frame,
+           otherwise with a dictionary of the attribute values.
+        attributes: str, list of str or None
+           The attributes passed to *func*, by default all of them.
+        chunk_size: int or None
+           Number of frames read and processed at once, by default
+           the *chunk_size* of the trajectory.
+        workers: int or None
+           Number of workers processing the chunks in parallel. If
+           None, the frames are processed in the current thread.
+        pool: 'thread' or 'process'
+           Use a pool of threads (good for functions that release the
+           GIL, such as most numpy functions) or of processes (then
+           *func* has to be picklable).
+
+        **Example**
+
+        The radius of gyration of each frame, with 4 threads::
+
+            rg = np.array(list(traj.map(radius_of_gyration, 'coords', workers=4)))
+
+        '''
+        task = functools.partial(_map_chunk, func, attributes)
+        for results in self._tasks(task, attributes, chunk_size, workers, pool):
+            for result in results:
+                yield result
+
+    def reduce(self, func, combine, attributes=None, chunk_size=None,
+               workers=None, pool='thread'):
+        '''Apply *func* to each frame (as :meth:`map`) and combine the
+        results in order with the binary function *combine*, that
+        has to be associative. Each chunk is reduced by the worker
+        that processed it, so only one value per chunk is collected.
+
+        **Example**
+
+        The average coordinates::
+
+            total = traj.reduce(np.copy, np.add, 'coords', workers=4)
+            average = total / traj.nframes
+
+        '''
+        task = functools.partial(_reduce_chunk, func, combine, attributes)
+        return functools.reduce(combine, self._tasks(task, attributes, chunk_size,
+                                                     workers, pool))
+
+
+def _frames(block, attributes):
+    # The arguments of the function for each frame of a block
+    n = len(next(iter(block.values())))
+    if isinstance(attributes, str):
+        return block[attributes]
+    return ({k: v[i] for k, v in block.items()} for i in range(n))
+
+def _map_chunk(func, attributes, block):
+    return [func(frame) for frame in _frames(block, attributes)]
+
+def _reduce_chunk(func, combine, attributes, block):
+    return functools.reduce(combine, (func(frame) for frame in _frames(block, attributes)))
@@ -2,6 +2,8 @@ from .base import AbstractDB
 from .local import LocalDB
 import os
 
+import numpy as np
+
 class ChemlabDB(AbstractDB):
     """Chemlab default database.
     
@@ -24,6 +26,8 @@ class ChemlabDB(AbstractDB):
     
         Retrieve atomic data. The available data is:
 
+        - elements: The whole table, as a numpy structured array
+          with one row per atomic number.
         - symbols: Atomic symbols in a list.
         - vdwdict: Dictionary with per-element Van Der Waals radii.
         - massdict: Dictionary of masses.
@@ -46,60 +50,54 @@ class ChemlabDB(AbstractDB):
             return self.ldb.get(feature, key)
         
         if feature == 'data':
-            fd = open(os.path.join(self.directory,
-                                   "data", "element.txt"))
-
-            lines = fd.readlines()
-            lines = [l for l in lines if not l.startswith('#')]
-            fields = [l.split() for l in lines]
-
-            if key == 'vdwdict':
-                vdw_tuples = [(f[1], float(f[5])/10) for f in fields]
-                vdw_dict = dict(vdw_tuples)
-                fd.close()
-                return vdw_dict
-
-            if key == 'massdict':
-                mass_tuples = [(f[1], float(f[7])) for f in fields]
-                mass_dict = dict(mass_tuples)
-                fd.close()
-                return mass_dict
+            table = element_table()
+            symbols = table['symbol'].tolist()
+            
+            if key == 'elements':
+                return table
+            
+            if key == 'symbols':
+                return symbols
+            
+            column = _DATA_KEYS.get(key)
+            if column is not None:
+                return dict(zip(symbols, table[column].tolist()))
 
-            if key == 'covalentdict':
-                covalent_tuples = [(f[1], float(f[3])/10) for f in fields]
-                covalent_dict = dict(covalent_tuples)
-                fd.close()
-                return covalent_dict
 
-            if key == 'paulingenegdict':
-                paulingeneg_tuples = [(f[1], float(f[8])) for f in fields]
-                paulingeneg_dict = dict(paulingeneg_tuples)
-                fd.close()
-                return paulingeneg_dict
+# Columns of element.txt, the radii are converted to nm
+_ELEMENT_DTYPE = [('number', 'int'), ('symbol', 'U3'), ('areneg', 'float'),
+                  ('covalent', 'float'), ('bo_radius', 'float'), ('vdw', 'float'),
+                  ('maxbond', 'int'), ('mass', 'float'), ('paulingeneg', 'float'),
+                  ('ionpot', 'float'), ('eaff', 'float'), ('color', 'float', (3,)),
+                  ('name', 'U16')]
 
-            if key == 'areneg':
-                areneg_tuples = [(f[1], float(f[2])) for f in fields]
-                areneg_dict = dict(areneg_tuples)
-                fd.close()
-                return areneg_dict
+# The dictionaries of the 'data' feature, and their column
+_DATA_KEYS = {'vdwdict': 'vdw', 'massdict': 'mass', 'covalentdict': 'covalent',
+              'paulingenegdict': 'paulingeneg', 'areneg': 'areneg',
+              'maxbonddict': 'maxbond', 'ionpotdict': 'ionpot', 'eaffdict': 'eaff'}
 
-            if key == 'maxbonddict':
-                maxbond_tuples = [(f[1], int(f[6])) for f in fields]
-                maxbond_dict = dict(maxbond_tuples)
-                fd.close()
-                return maxbond_dict
+_element_table = None
 
-            if key == 'ionpotdict':
-                ionpot_tuples = [(f[1], float(f[9])) for f in fields]
-                ionpot_dict = dict(ionpot_tuples)
-                fd.close()
-                return ionpot_dict
+def element_table():
+    """Return the table of the elements as a numpy structured array,
+    with one row per atomic number. The file is parsed only once.
 
-            if key == 'eaffdict':
-                eaff_tuples = [(f[1], float(f[10])) for f in fields]
-                eaff_dict = dict(eaff_tuples)
-                fd.close()
-                return eaff_dict
-                
-            if key == 'symbols':
-                return [f[1] for f in fields]
+    """
+    global _element_table
+    if _element_table is None:
+        path = os.path.join(os.path.dirname(__file__), 'localdb', 'data', 'element.txt')
+        with open(path) as fd:
+            fields = [l.split() for l in fd if not l.startswith('#')]
+        
+        table = np.zeros(len(fields), dtype=_ELEMENT_DTYPE)
+        for name in table.dtype.names:
+            if name not in ('color', 'name'):
+                column = table.dtype.names.index(name)
+                table[name] = [f[column] for f in fields]
+        table['color'] = [f[11:14] for f in fields]
+        table['name'] = [f[14] for f in fields]
+        for name in ('covalent', 'bo_radius', 'vdw'):
+            table[name] /= 10
+        table.flags.writeable = False
+        _element_table = table
+    return _element_table
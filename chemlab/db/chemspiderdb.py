@@ -5,7 +5,6 @@ import sys
 from io import BytesIO
 
 from .base import EntryNotFound, AbstractDB
-from ..libs import chemspipy
 try:
     import configparser
 except:
@@ -88,6 +87,7 @@ class ChemSpiderDB(AbstractDB):
 
     """
     def __init__(self, token=None):
+        from ..libs import chemspipy
         if not token:
             config = configparser.ConfigParser()
             userconfig = os.path.expanduser('~/.chemlabrc')
@@ -118,6 +118,7 @@ class ChemSpiderDB(AbstractDB):
     
     def get(self, feature, key):
         from ..io.handlers import MolIO
+        from ..libs import chemspipy
         result = chemspipy.find_one(key)
         if not result:
             raise EntryNotFound()
@@ -2,7 +2,6 @@
 
 '''
 from .base import EntryNotFound, AbstractDB
-from ..libs import cirpy
 
 from io import BytesIO
 
@@ -26,6 +25,7 @@ class CirDB(AbstractDB):
 
     def get(self, feature, key):
         from ..io.handlers import MolIO
+        from ..libs import cirpy
         
         if feature == "molecule":
             result = cirpy.resolve(key, "sdf", get3d=True)
@@ -2,6 +2,7 @@
 '''
 import numpy as np
 import os
+import shutil
 from .base import EntryNotFound, AbstractDB
 
 class LocalDB(AbstractDB):
@@ -13,56 +14,57 @@ class LocalDB(AbstractDB):
 
        Directory where the database is located.
     
-    .. method:: get(self, 'molecule', key)
+    .. method:: get(self, 'molecule', key, mmap_mode=None)
 
        Get an entry from the database. Key is the filename without
        extension of the serialized molecule. Molecules are stored in
        the subdirectory.
     
-    .. method:: get(self, 'system', key)
+    .. method:: get(self, 'system', key, mmap_mode=None)
 
        Get an entry from the database. Key is the filename without
-       extension of the serialized system.
+       extension of the serialized system. Entries stored in the
+       binary format can be memory-mapped by passing *mmap_mode*
+       (see :py:meth:`chemlab.core.System.load`).
 
-    .. method:: store(self, 'molecule', key, value)
+    .. method:: store(self, 'molecule', key, value, format='json')
     
-    .. method:: store(self, 'system', key, value)
+    .. method:: store(self, 'system', key, value, format='json')
 
        Store a Molecule or a System passed as *value* in the directory
-       structure. The objects are dumped to disk after being
-       serialized to json.
+       structure. With *format* 'json' the objects are dumped to disk
+       after being serialized to json, with *format* 'binary' they
+       are saved with :py:meth:`chemlab.core.System.save` in a
+       directory with the .chem extension.
 
     '''
     
     def __init__(self, directory):
         self.directory = directory
         
-    def get(self, feature, key, *args, **kwargs):
+    def get(self, feature, key, mmap_mode=None, *args, **kwargs):
         from ..core import Molecule, System
         
         if feature == "molecule":
-            try:
-                fd = open(os.path.join(self.directory, 
-                                       "molecule", key+'.json'))
-                
-            except IOError:
-                raise EntryNotFound(key + ' Not found')
-                
-            return Molecule.from_json(fd.read())
-
+            cls = Molecule
         elif feature == "system":
-            try:
-                fd = open(os.path.join(self.directory, 
-                                       "system", key+'.json'))
-                
-            except IOError:
-                raise EntryNotFound(key + ' Not found')
-                
-            return System.from_json(fd.read())
+            cls = System
         else:
             raise Exception("Data type not present")
+        
+        path = os.path.join(self.directory, feature, key)
+        if os.path.isdir(path + '.chem'):
+            return cls.load(path + '.chem', mmap_mode=mmap_mode)
+        
+        try:
+            fd = open(path + '.json')
+        except IOError:
+            raise EntryNotFound(key + ' Not found')
+        
+        with fd:
+            return cls.from_json(fd.read())
             
-    def store(self, feature, key, value, nowarn=False):
+    def store(self, feature, key, value, nowarn=False, format='json'):
         if feature == "molecule":
             destdir = "molecule"
         elif feature == "system":
@@ -70,14 +72,31 @@ class LocalDB(AbstractDB):
         else:
             raise Exception("Data type not present")
         
+        if format == 'json':
+            ext = '.json'
+        elif format == 'binary':
+            ext = '.chem'
+        else:
+            raise ValueError("Format {} not supported".format(format))
+        
         if not os.path.exists(os.path.join(self.directory, 
                                            destdir)):
             os.makedirs(os.path.join(self.directory, destdir))
-        towrite = os.path.join(self.directory, destdir, key+'.json')
+        
+        path = os.path.join(self.directory, destdir, key)
+        towrite = path + ext
         if nowarn is not True:
-            if os.path.exists(towrite):
+            if os.path.exists(path + '.json') or os.path.exists(path + '.chem'):
                 raise IOError("Database file {} exists".format(towrite))
-                
-        fd = open(towrite, 'w')
         
-        fd.write(value.to_json())
+        # Replace any previous version of the entry
+        if os.path.isdir(path + '.chem'):
+            shutil.rmtree(path + '.chem')
+        if os.path.exists(path + '.json'):
+            os.remove(path + '.json')
+        
+        if format == 'json':
+            with open(towrite, 'w') as fd:
+                fd.write(value.to_json())
+        else:
+            value.save(towrite)
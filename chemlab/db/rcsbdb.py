@@ -3,15 +3,6 @@ from io import BytesIO
 from .base import AbstractDB, EntryNotFound
 
 
-# Python 2-3 compatibility
-try:
-    from urllib.parse import quote_plus
-    from urllib.request import urlopen
-except ImportError:
-    from urllib import quote_plus
-    from urllib2 import urlopen
-
-
 class RcsbDB(AbstractDB):
     """Access to the `RCSB <http://www.rcsb.org/>`_ database for
     proteins.
@@ -31,6 +22,12 @@ class RcsbDB(AbstractDB):
 
     def get(self, feature, key):
         from ..io.handlers import PdbIO # Here to avoid circular import
+
+        # Python 2-3 compatibility
+        try:
+            from urllib.request import urlopen
+        except ImportError:
+            from urllib2 import urlopen
         
         if feature == 'molecule':
             url = 'http://www.rcsb.org/pdb/files/%s.pdb' % key
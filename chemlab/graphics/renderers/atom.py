@@ -1,6 +1,7 @@
 import numpy as np
 from .. import colors
 from ...db import ChemlabDB
+from ...core.attributes import as_categories
 from .base import AbstractRenderer
 from .sphere import SphereRenderer
 from .sphere_imp import SphereImpostorRenderer
@@ -45,16 +46,15 @@ class AtomRenderer(AbstractRenderer):
                  color_scheme=colors.default_atom_map,
                  radii_map=vdw_dict,
                  shading='phong'):
-        radii = []
-        colorlist = []
-        natoms = len(r_array)
-
-        for i in range(natoms):
-            radii.append(radii_map[type_array[i]])
-            colorlist.append(color_scheme.get(type_array[i],
-                                        color_scheme['Xx']))
+        # Look up each distinct type once
+        categories, codes = as_categories(type_array)
+        radii = np.array([radii_map[t] for t in categories],
+                         dtype='float').take(codes)
+        colorlist = np.array([color_scheme.get(t, color_scheme['Xx'])
+                              for t in categories],
+                             dtype='uint8').reshape(-1, 4).take(codes, axis=0)
         self.radii = radii        
-        self.colors = np.array(colorlist, dtype='uint8')
+        self.colors = colorlist
         if backend == 'polygons':
             self.sr = SphereRenderer(widget, r_array, radii, colorlist,
                                      shading = shading)
@@ -2,6 +2,7 @@ from .base import AbstractRenderer
 from . import CylinderRenderer, LineRenderer, CylinderImpostorRenderer
 import numpy as np
 from chemlab.graphics.colors import default_atom_map
+from chemlab.core.attributes import as_categories
 
 class BondRenderer(AbstractRenderer):
     '''
@@ -33,20 +34,17 @@ class BondRenderer(AbstractRenderer):
     
         radii = [radius] * len(bounds_a)
 
-        colors_a = []
-        colors_b = []
-
-        for i, j in bonds:
-            colors_a.append(
-                default_atom_map.get(type_array[i],
-                                 default_atom_map['Xx']))
-            colors_b.append(
-                default_atom_map.get(type_array[j],
-                                 default_atom_map['Xx']))
+        # Look up each distinct type once
+        categories, codes = as_categories(type_array)
+        colors = np.array([default_atom_map.get(t, default_atom_map['Xx'])
+                           for t in categories], 'uint8').reshape(-1, 4)
+        bonds = np.asarray(bonds, dtype='int').reshape(-1, 2)
+        colors_a = colors.take(codes.take(bonds[:, 0]), axis=0)
+        colors_b = colors.take(codes.take(bonds[:, 1]), axis=0)
 
         self.radii = radii
-        self.colors_a = np.array(colors_a, 'uint8')
-        self.colors_b = np.array(colors_b, 'uint8')
+        self.colors_a = colors_a
+        self.colors_b = colors_b
         
         if style == 'cylinders':
             self.cr1 = CylinderRenderer(widget, bounds_a, radii, colors_a)
@@ -1,10 +1,8 @@
 import os
 import difflib
 try:
-    from urllib.request import urlopen
     from urllib.parse import urlparse
 except ImportError: # python 2
-    from urllib2 import urlopen
     from urlparse import urlparse
 
 from .handlers.base import make_ionotavailable
@@ -69,16 +67,21 @@ def add_default_handler(ioclass, format, extension=None):
 for h in _default_handlers:
     add_default_handler(*h)
 
-# We add also the cclib handlers
-load_cclib = False
-try:
-    import cclib
-    load_cclib = True
-except ImportError:
-    print('cclib not found. Install cclib for more handlers.')
+# The cclib handlers are registered the first time an unknown format
+# is requested, as importing cclib is slow
+_cclib_loaded = False
+
+def _load_cclib_handlers():
+    global _cclib_loaded
+    if _cclib_loaded:
+        return
+    _cclib_loaded = True
+
+    try:
+        from .handlers._cclib import _cclib_handlers
+    except ImportError:
+        return
 
-if load_cclib:
-    from .handlers._cclib import _cclib_handlers
     for hclass, format in _cclib_handlers:
         add_default_handler(hclass, format)
 
@@ -90,6 +93,9 @@ def get_handler_class(ext):
     else:
         raise ValueError("Unknown format for %s extension." % ext)
 
+    if format not in _handler_map:
+        _load_cclib_handlers()
+
     if format in _handler_map:
         hc = _handler_map[format]
         return hc
@@ -130,6 +136,8 @@ def datafile(filename, mode="rb", format=None):
     if format is None:
         hc = get_handler_class(ext)
     else:
+        if format not in _handler_map:
+            _load_cclib_handlers()
         hc = _handler_map.get(format)
         if hc is None:
             raise ValueError('Format {} not supported.'.format(format))
@@ -157,10 +165,17 @@ def remotefile(url, format=None):
 
         hc = get_handler_class(ext)
     else:
+        if format not in _handler_map:
+            _load_cclib_handlers()
         hc = _handler_map.get(format)
         if hc is None:
             raise ValueError('Format {} not supported.'.format(format))
 
+    try:
+        from urllib.request import urlopen
+    except ImportError: # python 2
+        from urllib2 import urlopen
+
     fd = urlopen(url)
     handler = hc(fd)
     return handler
@@ -26,7 +26,6 @@ _types = { 'gamess' : GAMESS,
          }
 
 cdb = ChemlabDB()
-symbols = cdb.get('data', 'symbols')
 
 def _create_cclib_handler(type):
     if type not in _types:
@@ -45,6 +44,7 @@ def _create_cclib_handler(type):
                 basis_functions = self.data.gbasis
             if feature == 'molecule':
                 # Angstrom to nanometers
+                symbols = cdb.get('data', 'symbols')
                 return Molecule.from_arrays(r_array=self.data.atomcoords[0]/10, 
                                             type_array=np.array([symbols[a] for a in self.data.atomnos]))
             else:
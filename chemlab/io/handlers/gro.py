@@ -8,11 +8,6 @@ from .gro_map import gro_to_cl
 from ...core import System
 
 from ...utils.formula import make_formula
-from ...db import ChemlabDB
-
-
-symbol_list = ChemlabDB().get('data', 'symbols')
-symbol_list = [s.lower() for s in symbol_list]
 
 
 class GromacsIO(IOHandler):
@@ -135,7 +130,8 @@ def parse_gro_lines(lines):
     
     # We need to parse the gromacs type in some way...
     # grotype_array = [re.sub('[0-9+-]+$', '', g) for g in grotype_array]
-    type_array = np.array([gro_to_cl.get(re.sub('[0-9+-]+$','', g), "Unknown") for g in grotype_array])
+    type_map = dict(gro_to_cl)
+    type_array = np.array([type_map.get(re.sub('[0-9+-]+$','', g), "Unknown") for g in grotype_array])
 
     # Molecular Formula Arrays
     mol_formula = []
@@ -1,8 +1,11 @@
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
 from ...db import ChemlabDB
 cdb = ChemlabDB()
 
-symbols = cdb.get("data", "symbols")
-
 oplsaa_map = {'Ar': 'Ar',
  'BA': 'Ba',
  'BR': 'Br',
@@ -123,6 +126,28 @@ oplsaa_map = {'Ar': 'Ar',
  'SR': 'Sr',
  'ZN': 'Zn'}
 
-gro_to_cl = {}
-gro_to_cl.update(oplsaa_map)
-gro_to_cl.update({s : s for s in symbols})
+class _TypeMap(Mapping):
+    '''The map from the gromacs atom types to the element symbols.
+    It is built on first use, to load the database only when needed.
+
+    '''
+    _map = None
+
+    def _data(self):
+        if self._map is None:
+            data = {}
+            data.update(oplsaa_map)
+            data.update({s : s for s in cdb.get("data", "symbols")})
+            self._map = data
+        return self._map
+
+    def __getitem__(self, key):
+        return self._data()[key]
+
+    def __iter__(self):
+        return iter(self._data())
+
+    def __len__(self):
+        return len(self._data())
+
+gro_to_cl = _TypeMap()
@@ -1,13 +1,6 @@
 from __future__ import division, print_function
 from .base import IOHandler
 
-try:
-    import tables as tb
-    tables_available = True
-except:
-    print("HDF backend is not available because pytables is not installed")
-    tables_available = False
-
 
 class HdfIO(IOHandler):
     '''Reader for MDtraj HDF trajectory format.
@@ -33,7 +26,9 @@ class HdfIO(IOHandler):
     can_write = []
 
     def read(self, feature, **kwargs):
-        if not tables_available:
+        try:
+            import tables as tb
+        except ImportError:
             raise Exception("HDF backend is not available because pytables is not installed")
 
         trjfile = tb.open_file(self.fd.name)
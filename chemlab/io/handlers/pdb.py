@@ -10,8 +10,14 @@ import re
 
 cdb = ChemlabDB()
 
-symbols = cdb.get("data", "symbols")
-u_symbols = [s.upper() for s in symbols]
+_upper_symbols = None
+
+def _element_symbol(atom_type):
+    # The element symbol matching *atom_type*, regardless of case
+    global _upper_symbols
+    if _upper_symbols is None:
+        _upper_symbols = {s.upper(): s for s in cdb.get("data", "symbols")}
+    return _upper_symbols[atom_type.upper()]
 
 class PdbIO(IOHandler):
     '''Starting implementation of a PDB file parser.
@@ -105,7 +111,7 @@ class PdbIO(IOHandler):
 
         # Normalized type                
         atom_type = line[76:78].lstrip()
-        atom_type = symbols[u_symbols.index(atom_type.upper())]
+        atom_type = _element_symbol(atom_type)
         
         # The res_id could be scrambled up
         res_id = int(line[22:26])
@@ -6,7 +6,6 @@ import os
 import shutil
 import time
 
-import h5py
 import numpy as np
 
 from ...core import Trajectory
@@ -29,6 +28,13 @@ class XtcIO(IOHandler):
 
        positions is a *list* of ``np.ndarray(n_atoms, 3)``.
     
+       If the option ``lazy=True`` is passed, the frames are not
+       loaded, but read from the file (in chunks) every time the
+       trajectory is iterated, see :meth:`chemlab.core.Trajectory.from_reader`::
+
+           >>> traj = datafile('traj.xtc').read('trajectory', lazy=True)
+           >>> rg = list(traj.map(radius_of_gyration, 'coords', workers=4))
+
     .. method:: read("boxes")
     
        After reading the "trajectory" feature you can call
@@ -50,9 +56,15 @@ class XtcIO(IOHandler):
                 p = os.path
                 rootdir = p.join(p.dirname(p.abspath(self.fd.name)), rootdir)
             
+            if kwargs.get("lazy", False):
+                name = self.fd.name
+                return Trajectory.from_reader(
+                    lambda: itertools.islice(XTCReader(name), 0, None, skipframes or 1))
+            
             xtcreader = XTCReader(self.fd.name)
             
             if rootdir is not None and os.path.exists(rootdir):
+                import h5py
                 f = h5py.File(rootdir, mode='r')
                 if f.attrs["timestamp"] >= os.path.getmtime(self.fd.name):
                     return Trajectory(f['coords'], f['times'], f['boxes'])
@@ -106,6 +118,7 @@ class _NumpyFrameHandler:
 class _HDF5FrameHandler:
     
     def __init__(self, rootdir, timestamp):
+        import h5py
         self.f = h5py.File(rootdir, 'w')
         self.f.attrs['timestamp'] = timestamp
         self.rootdir = rootdir
@@ -138,6 +151,7 @@ class _HDF5FrameHandler:
         self.boxes = self.f.create_dataset("boxes", data=self.boxes)
         self.times = self.f.create_dataset("times", data=self.times)
         self.f.close()
+        import h5py
         self.f = h5py.File(self.rootdir, 'r')
         
         self.frames = self.f['coords']
@@ -392,3 +392,195 @@ class PeriodicCKDTree(cKDTree):
         
     def sparse_distance_matrix(self, other, max_distance, p=2.):
         raise NotImplementedError()
+
+
+class TriclinicCKDTree(cKDTree):
+    """
+    Cython kd-tree for quick nearest-neighbor lookup in a periodic box
+    that can be triclinic
+
+    The data points are wrapped into the unit cell in fractional
+    coordinates, and an ordinary kd-tree is built with them. Each query
+    point is also wrapped, and searched together with its images in
+    the neighboring cells, if any, that are closer than the search
+    distance: an image across a face of the cell is needed only when
+    the point is within the search distance of that face.
+
+    To find each data point at most once the search distance is
+    restricted to half the smallest distance between opposite faces of
+    the box, as in PeriodicCKDTree.
+    """
+
+    def __init__(self, box_vectors, data, leafsize=10):
+        """Construct a kd-tree.
+
+        Parameters
+        ----------
+        box_vectors : array_like, shape (3, 3)
+            The box vectors, one per row.
+        data : array-like, shape (n, 3)
+            The n data points to be indexed.
+        leafsize : positive integer
+            The number of points at which the algorithm switches over to
+            brute-force.
+        """
+        self.box_vectors = np.asarray(box_vectors, dtype=np.float64)
+        self.inverse = np.linalg.inv(self.box_vectors)
+        self.real_data = np.asarray(data, dtype=np.float64)
+
+        # The columns of the inverse are the reciprocal vectors, the
+        # distance between two opposite faces is one over their length
+        self.widths = 1.0 / np.linalg.norm(self.inverse, axis=0)
+        self.max_distance_upper_bound = 0.5 * self.widths.min()
+
+        super(TriclinicCKDTree, self).__init__(self._wrap(self.real_data), leafsize)
+
+    def _wrap(self, x):
+        fractional = x.dot(self.inverse)
+        fractional -= np.floor(fractional)
+        return fractional.dot(self.box_vectors)
+
+    def _images(self, x, r, center=True):
+        # Iterate over the images needed to search the points x within
+        # a distance r, as (indices of the points, images of the points).
+        # If not *center*, the points in the cell are left out.
+        fractional = x.dot(self.inverse)
+        fractional -= np.floor(fractional)
+        margin = r / self.widths
+
+        # Which points need the image across each face of the cell
+        needed = {-1: fractional > 1.0 - margin, 0: np.ones_like(fractional, dtype=bool),
+                  1: fractional < margin}
+        for shift in itertools.product((-1, 0, 1), repeat=3):
+            if not center and shift == (0, 0, 0):
+                continue
+            mask = needed[shift[0]][:, 0] & needed[shift[1]][:, 1] & needed[shift[2]][:, 2]
+            index = np.nonzero(mask)[0]
+            if len(index) > 0:
+                yield index, (fractional[index] + shift).dot(self.box_vectors)
+
+    def _check_points(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        if x.shape[-1] != self.m:
+            raise ValueError("Searching for a %d-dimensional point in a " \
+                             "%d-dimensional KDTree" % (x.shape[-1], self.m))
+        return x
+
+    def query(self, x, k=1, eps=0, p=2, distance_upper_bound=np.inf):
+        """
+        Query the kd-tree for the k nearest neighbors of the point(s) x,
+        with the same conventions of cKDTree.query. Neighbors further
+        than half the smallest width of the box are reported as
+        missing (infinite distance and index self.n).
+        """
+        x = self._check_points(x)
+        single = x.ndim == 1
+        x = np.atleast_2d(x)
+
+        distance_upper_bound = min(distance_upper_bound,
+                                   self.max_distance_upper_bound)
+
+        # Collect the hits of all the images, then keep the k nearest
+        distances = [np.full((len(x), 0), np.inf)]
+        indices = [np.full((len(x), 0), self.n, dtype='intp')]
+        for index, images in self._images(x, distance_upper_bound):
+            d, i = super(TriclinicCKDTree, self).query(images, k, eps, p,
+                                                       distance_upper_bound)
+            d_all = np.full((len(x), k), np.inf)
+            i_all = np.full((len(x), k), self.n, dtype='intp')
+            d_all[index] = d.reshape(-1, k)
+            i_all[index] = i.reshape(-1, k)
+            distances.append(d_all)
+            indices.append(i_all)
+
+        distances = np.concatenate(distances, axis=1)
+        indices = np.concatenate(indices, axis=1)
+        order = np.argsort(distances, axis=1, kind='mergesort')[:, :k]
+        rows = np.arange(len(x))[:, np.newaxis]
+        distances, indices = distances[rows, order], indices[rows, order]
+
+        if k == 1:
+            distances, indices = distances[:, 0], indices[:, 0]
+        if single:
+            distances, indices = distances[0], indices[0]
+        return distances, indices
+
+    def query_ball_point(self, x, r, p=2., eps=0):
+        """
+        Find all points within distance r of point(s) x, with the same
+        conventions of cKDTree.query_ball_point. The indices of each
+        point are sorted.
+        """
+        x = self._check_points(x)
+        if r > self.max_distance_upper_bound:
+            raise ValueError("r (%s) should not be bigger than half the box width (%s)"
+                             % (r, self.max_distance_upper_bound))
+
+        single = x.ndim == 1
+        x = np.atleast_2d(x)
+
+        results = [[] for i in range(len(x))]
+        for index, images in self._images(x, r):
+            hits = super(TriclinicCKDTree, self).query_ball_point(images, r, p, eps)
+            for i, h in zip(index, hits):
+                results[i].extend(h)
+
+        if single:
+            return sorted(results[0])
+
+        result = np.empty(len(x), dtype=object)
+        for i, h in enumerate(results):
+            result[i] = sorted(h)
+        return result
+
+    def count_ball_point(self, x, r, p=2., eps=0):
+        """
+        Count the points within distance r of point(s) x.
+        """
+        x = self._check_points(x)
+        if r > self.max_distance_upper_bound:
+            raise ValueError("r (%s) should not be bigger than half the box width (%s)"
+                             % (r, self.max_distance_upper_bound))
+
+        single = x.ndim == 1
+        x = np.atleast_2d(x)
+
+        counts = np.zeros(len(x), dtype='int')
+        for index, images in self._images(x, r):
+            hits = super(TriclinicCKDTree, self).query_ball_point(images, r, p, eps)
+            counts[index] += [len(h) for h in hits]
+        return counts[0] if single else counts
+
+    def query_ball_tree(self, other, r, p=2., eps=0):
+        raise NotImplementedError()
+
+    def query_pairs(self, r, p=2., eps=0):
+        """
+        Find all the pairs of data points closer than r. Unlike
+        cKDTree.query_pairs, and as CellLinkedList.query_pairs, return
+        the arrays (i, j, dist) with i < j, where dist are the minimum
+        image distances.
+        """
+        if r > self.max_distance_upper_bound:
+            raise ValueError("r (%s) should not be bigger than half the box width (%s)"
+                             % (r, self.max_distance_upper_bound))
+
+        # The pairs within the cell
+        pairs = super(TriclinicCKDTree, self).query_pairs(r, p, eps, output_type='ndarray')
+        i, j = pairs[:, 0], pairs[:, 1]
+        result = [(i, j, np.linalg.norm(self.data[j] - self.data[i], ord=p, axis=1))]
+
+        # The pairs across a face, found from the images of both points
+        for index, images in self._images(self.real_data, r, center=False):
+            found = cKDTree(images).sparse_distance_matrix(self, r, p, output_type='ndarray')
+            i = index[found['i']]
+            keep = i < found['j']
+            result.append((i[keep], found['j'][keep], found['v'][keep]))
+
+        return tuple(np.concatenate(a) for a in zip(*result))
+
+    def count_neighbors(self, other, r, p=2.):
+        raise NotImplementedError()
+
+    def sparse_distance_matrix(self, other, max_distance, p=2.):
+        raise NotImplementedError()
@@ -3,10 +3,10 @@ import numpy as np
 import time
 from scipy.spatial import distance
 from chemlab.utils.celllinkedlist import CellLinkedList
-from chemlab.utils import distances_within
+from chemlab.utils.cdist import distance_histogram
 
 def rdf(coords_a, coords_b, binsize=0.002,
-        cutoff=1.5, periodic=None, normalize=True):
+        cutoff=1.5, periodic=None, normalize=True, n_threads=1):
     """Calculate the radial distribution function of *coords_a* against
     *coords_b*.
 
@@ -21,20 +21,23 @@ def rdf(coords_a, coords_b, binsize=0.002,
         gromacs-like normalization
     - cutoff: 
         where to cutoff the RDF
+    - n_threads: int
+        number of threads computing the histogram
     
     """
     
     period = periodic[0, 0], periodic[1,1], periodic[2,2]
-    distances = distances_within(coords_a, coords_b, cutoff,
-                                 np.array(period, dtype=np.double))
     
     n_a = len(coords_a)
     n_b = len(coords_b)
 
     volume = periodic[0, 0] * periodic[1, 1] * periodic[2, 2]
 
-    int_distances = np.rint(distances/binsize).astype(int)
-    hist = np.bincount(int_distances)
+    # The distances are histogrammed without storing them
+    width = int(cutoff/binsize) + 1
+    hist = distance_histogram(coords_a, coords_b, cutoff, binsize,
+                              np.array(period, dtype=np.double),
+                              n_threads).astype(float)
     
     bin_edges = np.arange(len(hist)+1) * binsize
         
@@ -53,7 +56,6 @@ def rdf(coords_a, coords_b, binsize=0.002,
 
     # Cutting up to rmax value
         
-    width = cutoff/binsize + 1
     return bin_edges[0:width], hist[0:width]
 
 def running_coordination_number(coordinates_a, coordinates_b, periodic, 
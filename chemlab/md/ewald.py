@@ -3,7 +3,7 @@ import numpy as np
 import math
 import numba as nb
 from numpy.linalg import norm
-from .interactions import _dist, _str_dict_to_htable, vectorized_hash, F
+from .interactions import _dist, _str_dict_to_htable, hash_types, F
 from .energy import  tosi_fumi
 
 @nb.jit
@@ -149,8 +149,8 @@ class Ewald(object):
             box = np.array(box, dtype='float64')
 
         # We basically hash the values
-        types1_int = vectorized_hash(np.array(types1, dtype=np.str_))
-        types2_int = vectorized_hash(np.array(types2, dtype=np.str_))
+        types1_int = hash_types(types1)
+        types2_int = hash_types(types2)
 
         charges1 = self._table.map(types1_int)
         charges2 = self._table.map(types2_int)
@@ -171,7 +171,7 @@ class Ewald(object):
         return self.real(coords2, types2, coords2, types2, box) + self.reciprocal(coords1, types1, coords2, types2, box)
 
     def dipole_correction(self, coords1, types1, box):
-        types1_int = vectorized_hash(np.array(types1, np.str_))
+        types1_int = hash_types(types1)
         charges1 = self._table.map(types1_int)
         
         dipole = (coords1 * charges1[:, np.newaxis]).sum(axis=0)
@@ -3,6 +3,7 @@ import numba as nb
 import numpy as np
 
 from ..utils.numbaz import Int32HashTable
+from ..core.attributes import as_categories
 from .energy import lorentz_berthelot, F, tosi_fumi, tosi_fumi_B, tosi_fumi_beta
 
 
@@ -29,6 +30,17 @@ def vectorized_hash(array):
     return modified_cantor_pair.reduce(tuplez, 1)
 
 
+def hash_types(types):
+    """Hash the strings *types* with :func:`vectorized_hash`. Only the
+    distinct types are hashed. *types* can also be a categorical
+    attribute, such as ``s.get_attribute('type_array')``, whose codes
+    are used without decoding them.
+
+    """
+    categories, codes = as_categories(types)
+    return vectorized_hash(np.array(categories, dtype=np.str_)).take(codes)
+
+
 def _str_dict_to_htable(strdict):
     ht = Int32HashTable(64)
 
@@ -75,8 +87,8 @@ class Coulomb(object):
         coords2 = np.array(coords2, dtype='float64')
 
         # We basically hash the values
-        types1_int = vectorized_hash(np.array(types1))
-        types2_int = vectorized_hash(np.array(types2))
+        types1_int = hash_types(types1)
+        types2_int = hash_types(types2)
 
         charges1 = self._table.map(types1_int)
         charges2 = self._table.map(types2_int)
@@ -160,8 +172,8 @@ class LennardJones(object):
         coords2 = np.array(coords2, dtype='float64')
 
         # We basically hash the values
-        types1_int = vectorized_hash(np.array(types1, dtype=np.str_))
-        types2_int = vectorized_hash(np.array(types2, dtype=np.str_))
+        types1_int = hash_types(types1)
+        types2_int = hash_types(types2)
 
         return _lennardjones_interaction(coords1, types1_int, coords2, types2_int, self._sigma_table, self._eps_table)
 
@@ -226,8 +238,8 @@ class TosiFumi(object):
         coords2 = np.array(coords2, dtype='float64')
 
         # We basically hash the values
-        types1_int = vectorized_hash(np.array(types1, dtype=np.str_))
-        types2_int = vectorized_hash(np.array(types2, dtype=np.str_))
+        types1_int = hash_types(types1)
+        types2_int = hash_types(types2)
 
         return _tosifumi_interaction(coords1, types1_int, coords2, types2_int,
                                      self._B_table, self._C_table, self._D_table, self._alpha_table)
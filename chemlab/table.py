@@ -1,28 +1,69 @@
-'''Periodic table data'''
+'''Periodic table data
+
+The lookup functions accept either a single symbol or a list/array
+of symbols. Arrays are mapped to the rows of the element table with
+a single gather, after looking up only their distinct symbols. The
+table is read from the database on the first lookup.
+
+'''
 import numpy as np
 
 from .db import ChemlabDB
 
 db = ChemlabDB()
 
-_symbols = db.get('data', 'symbols')
-_weight = db.get('data', 'massdict')
-_vdw = db.get('data', 'vdwdict')
+_index = None
 
-def atomic_no(atom):
-    if isinstance(atom, (list, np.ndarray)):
-        return np.array([atomic_no(a) for a in atom])
+def _symbol_index():
+    global _index
+    if _index is None:
+        symbols = db.get('data', 'symbols')
+        # A repeated symbol refers to its first row
+        _index = {}
+        for i, s in enumerate(symbols):
+            _index.setdefault(s, i)
+    return _index
+
+def element_index(atom):
+    '''Return the row of the element table (that is, the atomic
+    number) of the symbol *atom*, or an array of rows for an array of
+    symbols.
+
+    **Example**
+
+    The masses of the atoms of a System, looking up only its
+    categories::
+
+        categories, codes = s.get_attribute('type_array').encoded()
+        masses = atomic_weight(categories)[codes]
+
+    '''
+    if isinstance(atom, (list, tuple, np.ndarray)):
+        atom = np.asarray(atom)
+        if atom.size == 0:
+            return np.zeros(atom.shape, dtype='int')
+        keys, codes = np.unique(atom, return_inverse=True)
+        index = _symbol_index()
+        rows = np.array([index[k] for k in keys.tolist()])
+        return rows[codes].reshape(atom.shape)
     else:
-        return _symbols.index(atom)
+        return _symbol_index()[atom]
+
+def _lookup(column, atom):
+    rows = element_index(atom)
+    table = db.get('data', 'elements')
+    if isinstance(rows, np.ndarray):
+        return table[column].take(rows)
+    return table[column][rows].item()
+
+def atomic_no(atom):
+    return _lookup('number', atom)
 
 def atomic_weight(atom):
-    if isinstance(atom, (list, np.ndarray)):
-        return np.array([atomic_weight(a) for a in atom])
-    else:
-        return _weight[atom]
+    return _lookup('mass', atom)
 
 def vdw_radius(atom):
-    if isinstance(atom, (list, np.ndarray)):
-        return np.array([vdw_radius(a) for a in atom])
-    else:
-        return _vdw[atom]
+    return _lookup('vdw', atom)
+
+def covalent_radius(atom):
+    return _lookup('covalent', atom)
@@ -4,6 +4,7 @@ import numpy as np
 from .distances import distances_within
 from .distances import distance_matrix
 from .distances import overlapping_points
+from .distances import iter_distances_within
 from .pbc import minimum_image
 
 def fequal(a, b, tol):
@@ -5,31 +5,35 @@
 import numpy as np
 cimport numpy as np
 cimport cython
-from scipy.sparse import dok_matrix
+from cython.parallel cimport prange, threadid
 
-from libc.math cimport sqrt, floor
+from libc.math cimport sqrt, floor, fabs
 
 @cython.boundscheck(False)
-def distance_array(arr_a, arr_b, double[:] period, double cutoff):
-    cdef int i, j
-    cdef int na = len(arr_a), nb = len(arr_b)
-    cdef int size
-    cdef double dist
-    
-    cdef double[:] distbuf
-    
-    cdef double[:,:] bufa = arr_a.astype(np.double)
-    cdef double[:,:] bufb = arr_b.astype(np.double)
-    
-    distmat = np.zeros((na, nb), np.double)
-    cdef double[:,:] d_mat = distmat
-    
-    for i in range(na):
-        for j in range(nb):
-            dist = minimum_image_distance(bufa[i], bufb[j], period)
-            if dist <= cutoff:
-                d_mat[i,j] = dist
-    
+@cython.wraparound(False)
+def distance_array(arr_a, arr_b, period, double cutoff, int n_threads=1):
+    '''The matrix of the distances between the points of *arr_a* and
+    those of *arr_b*, considering the minimum image in the orthogonal
+    box *period* if it is not None. The distances bigger than
+    *cutoff* are set to 0. The rows are computed by *n_threads*
+    threads.
+
+    '''
+    cdef bint periodic = period is not None
+    cdef double[:, :] a, b
+    cdef double box[3]
+    a, b = _wrap(arr_a, arr_b, period, box)
+
+    cdef Py_ssize_t i
+    cdef double cutoff2 = cutoff * cutoff
+    cdef int threads = _check_threads(n_threads)
+
+    distmat = np.zeros((a.shape[0], b.shape[0]), np.double)
+    cdef double[:, :] d_mat = distmat
+
+    for i in prange(a.shape[0], nogil=True, num_threads=threads):
+        _distance_row(a, i, b, box, periodic, cutoff2, d_mat)
+
     return distmat
         
 
@@ -47,3 +51,174 @@ cdef inline double minimum_image_distance(double[:] a,double[:] b, double[:] per
         d[i] = d[i] - periodic[i] * rint(d[i]/periodic[i])
     
     return sqrt(d[0]*d[0] + d[1]*d[1] + d[2]*d[2])
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef inline double _distance2(double[:, :] a, Py_ssize_t i, double[:, :] b, Py_ssize_t j,
+                              double* period, bint periodic) nogil:
+    # The points have to be wrapped in the box, so that a single
+    # shift gives the minimum image
+    cdef double d, d2 = 0.0
+    cdef int k
+
+    for k in range(3):
+        d = b[j, k] - a[i, k]
+        if periodic:
+            d = fabs(d)
+            d = d if d < period[k] - d else period[k] - d
+        d2 += d * d
+    return d2
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _distance_row(double[:, :] a, Py_ssize_t i, double[:, :] b, double* period,
+                        bint periodic, double cutoff2, double[:, :] out) nogil:
+    cdef Py_ssize_t j
+    cdef double d2
+
+    for j in range(b.shape[0]):
+        d2 = _distance2(a, i, b, j, period, periodic)
+        if d2 <= cutoff2:
+            out[i, j] = sqrt(d2)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef Py_ssize_t _count_row(double[:, :] a, Py_ssize_t i, double[:, :] b, double* period,
+                           bint periodic, double cutoff2) nogil:
+    cdef Py_ssize_t j, n = 0
+
+    for j in range(b.shape[0]):
+        if _distance2(a, i, b, j, period, periodic) <= cutoff2:
+            n += 1
+    return n
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _fill_row(double[:, :] a, Py_ssize_t i, double[:, :] b, double* period,
+                    bint periodic, double cutoff2, Py_ssize_t n,
+                    Py_ssize_t[:] out_i, Py_ssize_t[:] out_j, double[:] out_d) nogil:
+    # Store the pairs of the row i starting from the position n
+    cdef Py_ssize_t j
+    cdef double d2
+
+    for j in range(b.shape[0]):
+        d2 = _distance2(a, i, b, j, period, periodic)
+        if d2 <= cutoff2:
+            out_i[n] = i
+            out_j[n] = j
+            out_d[n] = sqrt(d2)
+            n += 1
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _histogram_row(double[:, :] a, Py_ssize_t i, double[:, :] b, double* period,
+                         bint periodic, double cutoff2, double binsize,
+                         np.intp_t* hist) nogil:
+    cdef Py_ssize_t j
+    cdef double d2
+
+    for j in range(b.shape[0]):
+        d2 = _distance2(a, i, b, j, period, periodic)
+        # Coincident points are not counted
+        if 0.0 < d2 <= cutoff2:
+            hist[<Py_ssize_t> rint(sqrt(d2) / binsize)] += 1
+
+def _check_threads(n_threads):
+    if n_threads < 1:
+        raise ValueError('n_threads should be at least 1, not {}'.format(n_threads))
+    return n_threads
+
+cdef tuple _wrap(arr_a, arr_b, period, double* box):
+    # The coordinates as contiguous arrays, wrapped in the box if
+    # period is not None. The box is copied in *box*.
+    cdef int k
+    arr_a = np.asarray(arr_a, dtype=np.double)
+    arr_b = np.asarray(arr_b, dtype=np.double)
+    if period is not None:
+        period = np.asarray(period, dtype=np.double)
+        arr_a = arr_a - np.floor(arr_a / period) * period
+        arr_b = arr_b - np.floor(arr_b / period) * period
+    else:
+        period = np.ones(3)
+
+    for k in range(3):
+        box[k] = period[k]
+    return np.ascontiguousarray(arr_a), np.ascontiguousarray(arr_b)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def distance_pairs(arr_a, arr_b, double cutoff, period=None, int n_threads=1):
+    '''Find the pairs made of a point of *arr_a* and one of *arr_b*
+    closer than *cutoff*, considering the minimum image in the
+    orthogonal box *period* if it is not None. The pairs are first
+    counted and then stored, so no dense matrix is allocated. The
+    rows are split among *n_threads* threads.
+
+    **Returns**
+
+    The arrays (i, j, dist), sorted by i and j.
+
+    '''
+    cdef bint periodic = period is not None
+    cdef double[:, :] a, b
+    cdef double box[3]
+    a, b = _wrap(arr_a, arr_b, period, box)
+
+    cdef Py_ssize_t na = a.shape[0], i
+    cdef double cutoff2 = cutoff * cutoff
+    cdef int threads = _check_threads(n_threads)
+
+    # Number of pairs before each row of a
+    offsets_array = np.zeros(na + 1, dtype=np.intp)
+    cdef Py_ssize_t[:] offsets = offsets_array
+    for i in prange(na, nogil=True, num_threads=threads):
+        offsets[i + 1] = _count_row(a, i, b, box, periodic, cutoff2)
+    np.cumsum(offsets_array, out=offsets_array)
+
+    i_array = np.empty(offsets[na], dtype=np.intp)
+    j_array = np.empty(offsets[na], dtype=np.intp)
+    d_array = np.empty(offsets[na], dtype=np.double)
+    cdef Py_ssize_t[:] out_i = i_array
+    cdef Py_ssize_t[:] out_j = j_array
+    cdef double[:] out_d = d_array
+
+    for i in prange(na, nogil=True, num_threads=threads):
+        _fill_row(a, i, b, box, periodic, cutoff2, offsets[i], out_i, out_j, out_d)
+
+    return i_array, j_array, d_array
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def distance_histogram(arr_a, arr_b, double cutoff, double binsize, period=None,
+                       int n_threads=1):
+    '''Histogram of the distances between a point of *arr_a* and one
+    of *arr_b* closer than *cutoff*, excluding coincident points. The
+    distance d is counted in the bin ``rint(d/binsize)``. Each one of
+    the *n_threads* threads fills its own histogram, and they are
+    summed at the end.
+
+    **Returns**
+
+    The counts, as an array of ``rint(cutoff/binsize) + 1`` elements.
+
+    '''
+    cdef bint periodic = period is not None
+    cdef double[:, :] a, b
+    cdef double box[3]
+    a, b = _wrap(arr_a, arr_b, period, box)
+
+    cdef Py_ssize_t i, n_bins = <Py_ssize_t> rint(cutoff / binsize) + 1
+    cdef double cutoff2 = cutoff * cutoff
+    cdef int threads = _check_threads(n_threads)
+
+    hist_array = np.zeros((threads, n_bins), dtype=np.intp)
+    cdef np.intp_t* hist = <np.intp_t*> np.PyArray_DATA(hist_array)
+
+    for i in prange(a.shape[0], nogil=True, num_threads=threads):
+        _histogram_row(a, i, b, box, periodic, cutoff2, binsize,
+                       hist + threadid() * n_bins)
+
+    return hist_array.sum(axis=0)
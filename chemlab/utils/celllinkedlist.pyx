@@ -2,57 +2,82 @@ from __future__ import division
 import numpy as np
 cimport numpy as np
 cimport cython
+from cython.parallel cimport prange, threadid
+from libc.stdlib cimport calloc, realloc, free
+from libc.string cimport memcpy
 
-from scipy.sparse import dok_matrix
-
-from cdist cimport minimum_image_distance, sqrt
+from cdist cimport sqrt, rint
 
 cdef int EMPTY = -1
 
+cdef struct Grid:
+    # The cells of a CellLinkedList, for the nogil kernels
+    int divisions[3]
+    double period[3]
+    bint periodic
+    int* heads
+    int* linked_list
+    double* points
+
+cdef struct PairBuffer:
+    # Pairs found by a thread
+    Py_ssize_t n
+    Py_ssize_t capacity
+    Py_ssize_t* i
+    Py_ssize_t* j
+    double* d
+
 cdef class CellLinkedList:
     '''Generic cell linked list data structure
     Reference at http://cacs.usc.edu/education/cs596/01-1LinkedListCell.pdf
-    
+
     **Parameters**
     points: np.ndarray((N, 3))
        Array of 3d coordinates. Each coordinate should be > 0.
     periodic: np.ndarray((3, 3)) or None
-       Whether or not include periodic images in the 
+       Whether or not include periodic images in the
        calculation
     spacing: float
        Approximate spacing between cells, the spacing will be
        recalculated to divide the space in equal cells.
-    
+    extent: np.ndarray(3) or None
+       Size of the space divided in cells, when it is not
+       periodic. By default the maximum of the coordinates. Two
+       lists can be queried against each other only if they have
+       the same cells.
+
     '''
     cdef readonly np.ndarray points
     cdef readonly np.ndarray periodic
-    cdef int[:] point_linked_list
+    cdef np.ndarray point_linked_list
     cdef np.ndarray cell_heads
     cdef int n_points
     cdef int n_cells
     cdef int[3] divisions
+    cdef double[3] spacing
     cdef int do_periodic
-    
-    def __init__(CellLinkedList self, points, spacing, periodic=False):
+
+    def __init__(CellLinkedList self, points, spacing, periodic=False, extent=None):
         if periodic is not False:
             self.do_periodic = True
         else:
             self.do_periodic = False
-        
-        self.points = points.astype(np.double)
-        
+
+        self.points = np.ascontiguousarray(points, dtype=np.double)
+
         if self.do_periodic:
-            self.periodic = periodic.astype(np.double)
-            
+            self.periodic = np.asarray(periodic, dtype=np.double)
+
         self.n_points = len(points)
-        
+
         # First of all determine the divisions
         if self.do_periodic:
             a, b, c = periodic[0], periodic[1], periodic[2]
-            
+        elif extent is not None:
+            a, b, c = extent[0], extent[1], extent[2]
         else:
             assert np.all(self.points >= 0.0), "All points should be >= 0.0"
-            a = self.points[:, 0].max() 
+            a = self.points[:, 0].max()
             b = self.points[:, 1].max()
             c = self.points[:, 2].max()
 
@@ -61,140 +86,327 @@ cdef class CellLinkedList:
         self.divisions[2] = int(c/spacing) or 1
 
         self.n_cells = self.divisions[0]*self.divisions[1]*self.divisions[2]
-        
+
         # True spacing required to make the boxes like squares
         rc = np.array([a/self.divisions[0], b/self.divisions[1], c/self.divisions[2]])
-        # For a flat box, let's fix it
-        rc[rc < 1e-8] = 0.1
-        
+        # When the points span less than a cell (or a flat box)
+        # there is a single cell, as big as the spacing
+        if not self.do_periodic:
+            rc = np.maximum(rc, spacing)
+        for k in range(3):
+            self.spacing[k] = rc[k]
+
         # Build the CellLinkedList
-        
+
         # The i-th elemen hold the atom index linked to the i-th point
         self.point_linked_list = np.zeros(self.n_points, dtype='i4')
         self.point_linked_list[:] = EMPTY
-        
+
         # Contain the first atom in a cell
         self.cell_heads = np.zeros((self.divisions[0]+1,
                                     self.divisions[1]+1,
                                     self.divisions[2]+1), dtype='i4')
         self.cell_heads[:] = EMPTY
-        
-        for i in xrange(self.n_points):
-            # Cell index to which the atom belongs
-            ind = (self.points[i]/rc).astype(int) 
-            
-            if self.do_periodic:
-                ind = ind % (self.divisions[0], self.divisions[1], self.divisions[2])
-            
+
+        # Cell index to which each atom belongs
+        divisions = np.array([self.divisions[0], self.divisions[1], self.divisions[2]])
+        cells = np.floor(self.points / rc).astype('i4')
+        if self.do_periodic:
+            cells %= divisions
+        else:
+            np.clip(cells, 0, divisions, out=cells)
+
+        self._link(cells)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef _link(self, int[:, :] cells):
+        cdef int i
+        cdef int[:, :, :] cell_heads = self.cell_heads
+        cdef int[:] point_linked_list = self.point_linked_list
+
+        for i in range(self.n_points):
             # Copy the previous head to the linked_list
-            self.point_linked_list[i] = self.cell_heads[tuple(ind)]
-            
+            point_linked_list[i] = cell_heads[cells[i, 0], cells[i, 1], cells[i, 2]]
+
             # Last goes to head
-            self.cell_heads[tuple(ind)] = i
+            cell_heads[cells[i, 0], cells[i, 1], cells[i, 2]] = i
+
+    cdef _check_other(self, CellLinkedList other, double dr):
+        for k in range(3):
+            if (self.divisions[k] != other.divisions[k] or
+                abs(self.spacing[k] - other.spacing[k]) > 1e-8 * self.spacing[k]):
+                raise ValueError('The two cell lists should have the same cells')
+            if dr > self.spacing[k]:
+                raise ValueError('dr ({}) should not be bigger than the cell spacing ({})'
+                                 .format(dr, self.spacing[k]))
+        if self.do_periodic != other.do_periodic:
+            raise ValueError('The two cell lists should be both periodic or not')
+
+    cdef Grid _grid(self):
+        cdef Grid grid
+        cdef int k
+        for k in range(3):
+            grid.divisions[k] = self.divisions[k]
+            grid.period[k] = self.periodic[k] if self.do_periodic else 0.0
+        grid.periodic = self.do_periodic
+        grid.heads = <int*> np.PyArray_DATA(self.cell_heads)
+        grid.linked_list = <int*> np.PyArray_DATA(self.point_linked_list)
+        grid.points = <double*> np.PyArray_DATA(self.points)
+        return grid
+
+    cdef _scan(self, CellLinkedList other, double dr, bint half, bint store, int n_threads):
+        # Visit the pairs of points closer than dr, in neighboring
+        # cells. If *store*, return the arrays (i, j, dist), otherwise
+        # the number of neighbors of each point of self. If *half*
+        # (other is self), only the pairs with i < j are visited.
+        #
+        # The cells are split among the threads. Each thread stores
+        # its pairs in its own buffer, while the counts of a point
+        # are only updated by the thread scanning its cell.
+        cdef Grid grid = self._grid(), other_grid = other._grid()
+        cdef double dr2 = dr * dr
+        cdef Py_ssize_t k, t, n = 0, n_cells
+        cdef int cell_end, ny, nz, failed = 0
+        cdef np.intp_t* counts = NULL
+        cdef PairBuffer* buffers
+
+        if n_threads < 1:
+            raise ValueError('n_threads should be at least 1, not {}'.format(n_threads))
+
+        # Without periodic boundaries, the points on the upper
+        # boundary are in an extra layer of cells
+        cell_end = 0 if self.do_periodic else 1
+        ny = self.divisions[1] + cell_end
+        nz = self.divisions[2] + cell_end
+        n_cells = (self.divisions[0] + cell_end) * ny * nz
+
+        if not store:
+            count_array = np.zeros(self.n_points, dtype=np.intp)
+            counts = <np.intp_t*> np.PyArray_DATA(count_array)
+
+        buffers = <PairBuffer*> calloc(n_threads, sizeof(PairBuffer))
+        if buffers == NULL:
+            raise MemoryError()
+
+        try:
+            for k in prange(n_cells, nogil=True, num_threads=n_threads, schedule='dynamic'):
+                failed += _scan_cell(&grid, &other_grid, k // (ny * nz), (k // nz) % ny, k % nz,
+                                     dr2, half, counts, &buffers[threadid()])
+            if failed:
+                raise MemoryError()
+
+            if not store:
+                return count_array
+
+            for t in range(n_threads):
+                n += buffers[t].n
+            i_array = np.empty(n, dtype=np.intp)
+            j_array = np.empty(n, dtype=np.intp)
+            d_array = np.empty(n, dtype=np.double)
+
+            n = 0
+            for t in range(n_threads):
+                _copy(buffers[t].i, i_array, n, buffers[t].n)
+                _copy(buffers[t].j, j_array, n, buffers[t].n)
+                _copy(buffers[t].d, d_array, n, buffers[t].n)
+                n += buffers[t].n
+            return i_array, j_array, d_array
+        finally:
+            for t in range(n_threads):
+                free(buffers[t].i)
+                free(buffers[t].j)
+                free(buffers[t].d)
+            free(buffers)
+
+    def query_pairs(self, double dr, CellLinkedList other=None, int n_threads=1):
+        '''Find the pairs of points closer than *dr*. If *other* is
+        None, the pairs of points of this list (with ``i < j``),
+        otherwise the pairs between a point of this list and one of
+        *other*, that should have the same cells. The cells are
+        scanned by *n_threads* threads, and the order of the pairs
+        depends on the number of threads.
+
+        **Returns**
+
+        The arrays (i, j, dist), where *i* are indices in this list,
+        *j* in the other one.
+
+        '''
+        if other is None:
+            self._check_other(self, dr)
+            return self._scan(self, dr, True, True, n_threads)
+
+        self._check_other(other, dr)
+        return self._scan(other, dr, False, True, n_threads)
+
+    def query_ball(self, CellLinkedList other, double dr, int n_threads=1):
+        '''Find the points of *other* closer than *dr* to each point
+        of this list, as a scipy.sparse.csr_matrix of distances of
+        shape (N, N_other). Coincident points are stored as explicit
+        zeros.
+
+        '''
+        from scipy.sparse import csr_matrix
+
+        i, j, dist = self.query_pairs(dr, other, n_threads)
+        indptr, order = _group_rows(i, self.n_points)
+        return csr_matrix((dist.take(order), j.take(order), indptr),
+                          shape=(self.n_points, other.n_points))
+
+    def count_within(self, CellLinkedList other, double dr, int n_threads=1):
+        '''Count the points of *other* closer than *dr* to each point
+        of this list, without storing the pairs.
+
+        '''
+        self._check_other(other, dr)
+        return self._scan(other, dr, False, False, n_threads)
 
-    @cython.boundscheck(False)
     def query_distances_other(self, CellLinkedList other, double dr):
-        # Other must have the same number of cells...
-        
-        cdef int i, j, k, ii
-        cdef int ni, nj, nk
-        cdef int da, db, dc
-        cdef int i_point, j_point
-        cdef double [:] shift = np.zeros(3, dtype=np.float64)
-        cdef int [:, :, :] cell_heads = self.cell_heads
-        cdef int [:, :, :] other_cell_heads = other.cell_heads
-        cdef double [:] rij, ri, rj
-        cdef double dist
-        cdef int[:] self_linked_list = self.point_linked_list
-        cdef int[:] other_linked_list = other.point_linked_list
-        
-        
-        rij = np.zeros(3, dtype=np.float64)
-        
-        da = self.divisions[0]
-        db = self.divisions[1]
-        dc = self.divisions[2]
-        
-        ret = dok_matrix((self.n_points, other.n_points), dtype=np.double)
-        
-        # We have to iterate over all cells
-        for i in xrange(da+1):
-            for j in xrange(db+1):
-                for k in xrange(dc+1):
-
-                    # Scan over the neighbour cells
-                    if self.do_periodic:
-                        i_s = i - 1
-                        j_s = j - 1
-                        k_s = k - 1
-                    else:
-                        i_s = i - 1
-                        j_s = j - 1
-                        k_s = k - 1
-                        
-                    for ni in xrange(i_s, i+2):
-                        for nj in xrange(j_s, j+2):
-                            for nk in xrange(k_s, k+2):
-
-                                if self.do_periodic:
-                                    # Periodic boundary shift
-                                    if ni < 0:
-                                        shift[0] = - self.periodic[0]
-                                    elif ni >= da:
-                                        shift[0] = self.periodic[0]
-                                    else:
-                                        shift[0] = 0
-
-                                    if nj < 0:
-                                        shift[1] = - self.periodic[1]
-                                    elif nj >= db:
-                                        shift[1] = self.periodic[1]
-                                    else:
-                                        shift[1] = 0
-                                        
-                                    if nk < 0:
-                                        shift[2] = - self.periodic[2]
-                                    elif nk >= dc:
-                                        shift[2] = self.periodic[2]
-                                    else:
-                                        shift[2] = 0
-                                else:
-                                    if ni < 0 or ni > other.divisions[0]:
-                                        # No things out of bounds
-                                        continue
-                                    if nj < 0 or nj > other.divisions[1]:
-                                        continue
-                                    if nk < 0 or nk > other.divisions[2]:
-                                        continue
-                                
-                                # Scan atom i in the central cell
-                                i_point = cell_heads[i, j, k]
-                                
-                                while (i_point != EMPTY):
-                                    # Scan point in the neighbour cell
-                                    if self.do_periodic:
-                                        j_point = other_cell_heads[(ni+da)%da,
-                                                                   (nj+db)%db,
-                                                                   (nk+dc)%dc]
-                                    else:
-                                        j_point = other_cell_heads[ni, nj, nk]
-
-                                    
-                                    # This is taken from the other
-                                    while (j_point != EMPTY):
-                                        ri = self.points[i_point]
-                                        rj = other.points[j_point]
-
-                                        if self.do_periodic:
-                                            dist = minimum_image_distance(ri, rj, self.periodic)
-                                        else:
-                                            for ii in range(3):
-                                                rij[ii] = ri[ii] - rj[ii]
-                                            dist = sqrt(rij[0]*rij[0] + rij[1]*rij[1] + rij[2]*rij[2])
-                                        if (dist*dist < dr**2):
-                                            ret[i_point,j_point] = dist
-
-                                        j_point = other_linked_list[j_point]
-                                    i_point = self_linked_list[i_point]
-        
-        return ret
+        '''The distances between the points of this list and those of
+        *other* closer than *dr*, as a scipy.sparse.dok_matrix.
+        :meth:`query_ball` and :meth:`query_pairs` are much faster.
+
+        '''
+        ret = self.query_ball(other, dr)
+        ret.eliminate_zeros()
+        return ret.todok()
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef int _scan_cell(Grid* grid, Grid* other, int ci, int cj, int ck, double dr2, bint half,
+                    np.intp_t* counts, PairBuffer* buf) nogil:
+    # The pairs between the points in the cell (ci, cj, ck) of grid
+    # and those in the neighboring cells of other. They are counted
+    # in *counts* if it is not NULL, otherwise stored in *buf*.
+    # Returns 1 if the buffer can't be grown.
+    cdef int a, b, c, ii, off, v, u, head, i_point, j_point
+    cdef int s1 = grid.divisions[1] + 1, s2 = grid.divisions[2] + 1
+    cdef int[3] cell
+    cdef int[3] n_neighbors
+    cdef int[3][3] neighbors
+    cdef double d2, rij
+
+    head = grid.heads[(ci * s1 + cj) * s2 + ck]
+    if head == EMPTY:
+        return 0
+
+    # The distinct neighbor cells along each axis (with few divisions
+    # the periodic images coincide)
+    cell[0], cell[1], cell[2] = ci, cj, ck
+    for ii in range(3):
+        n_neighbors[ii] = 0
+        for off in range(-1, 2):
+            v = cell[ii] + off
+            if grid.periodic:
+                v = (v + grid.divisions[ii]) % grid.divisions[ii]
+                for u in range(n_neighbors[ii]):
+                    if neighbors[ii][u] == v:
+                        v = -1
+                        break
+                if v == -1:
+                    continue
+            elif v < 0 or v > grid.divisions[ii]:
+                continue
+            neighbors[ii][n_neighbors[ii]] = v
+            n_neighbors[ii] += 1
+
+    for a in range(n_neighbors[0]):
+        for b in range(n_neighbors[1]):
+            for c in range(n_neighbors[2]):
+
+                # Scan atom i in the central cell
+                i_point = head
+                while i_point != EMPTY:
+
+                    # Scan point in the neighbour cell
+                    j_point = other.heads[(neighbors[0][a] * s1 + neighbors[1][b]) * s2
+                                          + neighbors[2][c]]
+                    while j_point != EMPTY:
+                        if half and j_point <= i_point:
+                            j_point = other.linked_list[j_point]
+                            continue
+
+                        d2 = 0.0
+                        for ii in range(3):
+                            rij = other.points[3 * j_point + ii] - grid.points[3 * i_point + ii]
+                            if grid.periodic:
+                                rij = rij - grid.period[ii] * rint(rij / grid.period[ii])
+                            d2 = d2 + rij * rij
+
+                        if d2 <= dr2:
+                            if counts != NULL:
+                                counts[i_point] += 1
+                            elif _push(buf, i_point, j_point, sqrt(d2)):
+                                return 1
+
+                        j_point = other.linked_list[j_point]
+                    i_point = grid.linked_list[i_point]
+    return 0
+
+cdef inline int _push(PairBuffer* buf, Py_ssize_t i, Py_ssize_t j, double d) nogil:
+    # Append a pair, doubling the buffer when it is full
+    cdef Py_ssize_t capacity
+    if buf.n == buf.capacity:
+        capacity = 2 * buf.capacity if buf.capacity else 1024
+        if _reserve(buf, capacity):
+            return 1
+    buf.i[buf.n] = i
+    buf.j[buf.n] = j
+    buf.d[buf.n] = d
+    buf.n += 1
+    return 0
+
+cdef int _reserve(PairBuffer* buf, Py_ssize_t capacity) nogil:
+    cdef Py_ssize_t* i
+    cdef Py_ssize_t* j
+    cdef double* d
+
+    i = <Py_ssize_t*> realloc(buf.i, capacity * sizeof(Py_ssize_t))
+    if i == NULL:
+        return 1
+    buf.i = i
+    j = <Py_ssize_t*> realloc(buf.j, capacity * sizeof(Py_ssize_t))
+    if j == NULL:
+        return 1
+    buf.j = j
+    d = <double*> realloc(buf.d, capacity * sizeof(double))
+    if d == NULL:
+        return 1
+    buf.d = d
+    buf.capacity = capacity
+    return 0
+
+cdef _copy(void* buf, np.ndarray array, Py_ssize_t start, Py_ssize_t n):
+    # Copy n elements of buf in array, from the index start
+    cdef Py_ssize_t size = array.itemsize
+    if n:
+        memcpy(<char*> np.PyArray_DATA(array) + start * size, buf, n * size)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _group_rows(Py_ssize_t[:] rows, Py_ssize_t n_rows):
+    # Counting sort of the pairs by row, returns the CSR index pointer
+    # and the order of the pairs
+    cdef Py_ssize_t k, r
+    indptr_array = np.zeros(n_rows + 1, dtype=np.intp)
+    order_array = np.empty(len(rows), dtype=np.intp)
+    cdef Py_ssize_t[:] indptr = indptr_array
+    cdef Py_ssize_t[:] order = order_array
+    cdef Py_ssize_t[:] position
+
+    for k in range(len(rows)):
+        indptr[rows[k] + 1] += 1
+    for r in range(n_rows):
+        indptr[r + 1] += indptr[r]
+
+    position_array = indptr_array[:n_rows].copy()
+    position = position_array
+    for k in range(len(rows)):
+        r = rows[k]
+        order[position[r]] = k
+        position[r] += 1
+
+    return indptr_array, order_array
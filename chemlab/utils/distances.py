@@ -1,13 +1,11 @@
 # Utilities for distance searching
 import numpy as np
-from scipy.spatial.distance import cdist, squareform
 
-from ..libs.ckdtree import cKDTree
-from .cdist import distance_array
+from .cdist import distance_array, distance_pairs
 from .celllinkedlist import CellLinkedList
 
 def distances_within(coords_a, coords_b, cutoff,
-                     periodic=False, method="simple"):
+                     periodic=False, method="simple", n_threads=1):
     """Calculate distances between the array of coordinates *coord_a*
     and *coord_b* within a certain cutoff.
     
@@ -31,12 +29,92 @@ def distances_within(coords_a, coords_b, cutoff,
        distance search, *kdtree* uses scipy ``ckdtree`` module
        (periodic not available) and *cell-lists* uses the cell
        linked list method.
+    n_threads: int
+       Number of threads used for the search.
     """
-    mat = distance_matrix(coords_a, coords_b, cutoff, periodic, method)
+    if method == "cell-lists":
+        a, b = _cell_lists(coords_a, coords_b, cutoff, periodic)
+        dist = a.query_pairs(cutoff, b, n_threads)[2]
+        return dist[dist.nonzero()]
+    elif method == "simple":
+        dist = [d for i, j, d in iter_distances_within(coords_a, coords_b, cutoff, periodic,
+                                                       n_threads=n_threads)]
+        dist = np.concatenate(dist) if dist else np.zeros(0)
+        return dist[dist.nonzero()]
+
+    mat = distance_matrix(coords_a, coords_b, cutoff, periodic, method, n_threads)
     return mat[mat.nonzero()]
 
+def iter_distances_within(coords_a, coords_b, cutoff, periodic=False,
+                          block_size=2**22, n_threads=1):
+    """Iterate over the pairs made of a point of *coords_a* and one of
+    *coords_b* closer than *cutoff*, in chunks. The distances are
+    computed for blocks of rows of *coords_a*, about *block_size*
+    distances at a time, and each chunk contains only the pairs
+    within the cutoff, so the memory used is bounded even for very
+    big arrays.
+
+    **Parameters**
+
+    coords_a: np.ndarray((NA, 3), dtype=float)
+       First coordinate array
+    coords_b: np.ndarray((NB, 3), dtype=float)
+       Second coordinate array
+    cutoff: float
+       Maximum distance to search for
+    periodic: False or np.ndarray((3,), dtype=float)
+       If False, don't consider periodic images. Otherwise
+       periodic is an array containing the periodicity in the
+       3 dimensions.
+    block_size: int
+       Approximate number of distances computed for each chunk.
+    n_threads: int
+       Number of threads computing the rows of each block.
+
+    **Returns**
+
+    A generator of tuples (i, j, dist) of arrays, where *i* are
+    indices in *coords_a* and *j* in *coords_b*.
+
+    **Example**
+
+    A histogram of the distances, that are never all in memory::
+
+        hist = np.zeros(n_bins)
+        for i, j, d in iter_distances_within(coords_a, coords_b, cutoff):
+            hist += np.histogram(d, n_bins, (0, cutoff))[0]
+
+    """
+    coords_a = np.asarray(coords_a, dtype='float')
+    coords_b = np.asarray(coords_b, dtype='float')
+    period = None if periodic is False else np.asarray(periodic, dtype='float')
+
+    rows = max(1, block_size // max(len(coords_b), 1))
+    for start in range(0, len(coords_a), rows):
+        i, j, d = distance_pairs(coords_a[start:start + rows], coords_b, cutoff, period,
+                                 n_threads)
+        i += start
+        yield i, j, d
+
+def _cell_lists(coords_a, coords_b, cutoff, periodic):
+    # Two cell linked lists of coords_a and coords_b with the same cells
+    coords_a = np.asarray(coords_a, dtype='float')
+    coords_b = np.asarray(coords_b, dtype='float')
+    if periodic is not False:
+        if np.any(cutoff > periodic/2):
+            raise Exception("Not working with such a big cutoff.")
+
+    # We need all positive elements
+    both = np.concatenate([coords_a, coords_b])
+    origin = both.min(axis=0)
+    extent = both.max(axis=0) - origin
+
+    a = CellLinkedList(coords_a - origin, cutoff, periodic, extent)
+    b = CellLinkedList(coords_b - origin, cutoff, periodic, extent)
+    return a, b
+
 def distance_matrix(coords_a, coords_b, cutoff,
-                    periodic=False, method="simple"):
+                    periodic=False, method="simple", n_threads=1):
     """Calculate distances matrix the array of coordinates *coord_a*
     and *coord_b* within a certain cutoff.
     
@@ -44,7 +122,9 @@ def distance_matrix(coords_a, coords_b, cutoff,
     for distance searches. It return a np.ndarray containing the distances.
     
     Returns a matrix with all the computed distances. When using the
-    "cell-lists" method it returns a scipy.sparse.dok_matrix.
+    "cell-lists" method it returns a scipy.sparse.csr_matrix. For
+    big arrays, :func:`iter_distances_within` doesn't need to allocate
+    the whole matrix.
     
     **Parameters**
 
@@ -62,33 +142,21 @@ def distance_matrix(coords_a, coords_b, cutoff,
        The method to use. *simple* is a brute-force 
        distance search, and *cell-lists* uses the cell
        linked list method.
+    n_threads: int
+       Number of threads used for the search.
 
     """
     coords_a = np.array(coords_a)
     coords_b = np.array(coords_b)
     if method=="simple":
-        if periodic is not False:
-            return distance_array(coords_a, coords_b, cutoff=cutoff,
-                                  period=periodic.astype(np.double))
-        else:
-            dist = cdist(coords_a, coords_b)
-            dist[dist > cutoff] = 0
-            return dist
+        period = None if periodic is False else periodic.astype(np.double)
+        return distance_array(coords_a, coords_b, cutoff=cutoff,
+                              period=period, n_threads=n_threads)
             
     elif method=="cell-lists":
-        if periodic is not False:
-            if np.any(cutoff > periodic/2):
-                raise Exception("Not working with such a big cutoff.")
-            
-        # We need all positive elements
-        mina = coords_a[:, 0].min(), coords_a[:, 1].min(), coords_a[:, 2].min()
-        minb = coords_b[:, 0].min(), coords_b[:, 1].min(), coords_b[:, 2].min()
-        # Find the lowest        
-        origin = np.minimum(mina, minb)
-        
-        a = CellLinkedList(coords_a - origin, cutoff, periodic)
-        b = CellLinkedList(coords_b - origin, cutoff, periodic)
-        dist = a.query_distances_other(b, cutoff)
+        a, b = _cell_lists(coords_a, coords_b, cutoff, periodic)
+        dist = a.query_ball(b, cutoff, n_threads)
+        dist.eliminate_zeros()
         return dist
             
             
@@ -113,7 +181,5 @@ def overlapping_points(coords_a, coords_b, cutoff, periodic=False):
     
     '''
     
-    res = distance_matrix(coords_a, coords_b, periodic=periodic, 
-                          cutoff=cutoff, method="cell-lists")
-    overlaps = res.nonzero()[1]
-    return np.unique(overlaps)
+    a, b = _cell_lists(coords_a, coords_b, cutoff, periodic)
+    return np.unique(a.query_pairs(cutoff, b)[1])
@@ -45,6 +45,25 @@ def random_quaternion(rand=None):
     return np.array([np.cos(t2)*r2, np.sin(t1)*r1,
                      np.cos(t1)*r1, np.sin(t2)*r2])
 
+def random_quaternions(rand):
+    """Return an array of uniform random unit quaternions, shape (n, 4),
+    from the array *rand* of shape (n, 3), containing independent
+    random variables uniformly distributed between 0 and 1.
+
+    >>> q = random_quaternions(np.random.random((10, 3)))
+    >>> np.allclose(1, np.linalg.norm(q, axis=1))
+    True
+
+    """
+    rand = np.asarray(rand, dtype=np.float64).reshape(-1, 3)
+    r1 = np.sqrt(1.0 - rand[:, 0])
+    r2 = np.sqrt(rand[:, 0])
+    pi2 = np.pi * 2.0
+    t1 = pi2 * rand[:, 1]
+    t2 = pi2 * rand[:, 2]
+    return np.stack([np.cos(t2)*r2, np.sin(t1)*r1,
+                     np.cos(t1)*r1, np.sin(t2)*r2], axis=-1)
+
 def quaternion_matrix(quaternion):
     """Return homogeneous rotation matrix from quaternion.
 
@@ -70,6 +89,28 @@ def quaternion_matrix(quaternion):
         [    q[1, 2]+q[3, 0], 1.0-q[1, 1]-q[3, 3],     q[2, 3]-q[1, 0]],
         [    q[1, 3]-q[2, 0],     q[2, 3]+q[1, 0], 1.0-q[1, 1]-q[2, 2]]])
 
+def quaternion_matrices(quaternions):
+    """Return the rotation matrices, shape (n, 3, 3), corresponding to
+    an array of quaternions of shape (n, 4).
+
+    >>> M = quaternion_matrices([[1, 0, 0, 0], [0, 1, 0, 0]])
+    >>> np.allclose(M, [np.identity(3), np.diag([1, -1, -1])])
+    True
+
+    """
+    q = np.array(quaternions, dtype=np.float64, copy=True).reshape(-1, 4)
+    n = (q * q).sum(axis=1)
+    small = n < _EPS
+    q[small] = [1.0, 0.0, 0.0, 0.0]
+    n[small] = 1.0
+    q *= np.sqrt(2.0 / n)[:, np.newaxis]
+    q = q[:, :, np.newaxis] * q[:, np.newaxis, :]
+    return np.stack([
+        np.stack([1.0-q[:, 2, 2]-q[:, 3, 3], q[:, 1, 2]-q[:, 3, 0], q[:, 1, 3]+q[:, 2, 0]], axis=-1),
+        np.stack([q[:, 1, 2]+q[:, 3, 0], 1.0-q[:, 1, 1]-q[:, 3, 3], q[:, 2, 3]-q[:, 1, 0]], axis=-1),
+        np.stack([q[:, 1, 3]-q[:, 2, 0], q[:, 2, 3]+q[:, 1, 0], 1.0-q[:, 1, 1]-q[:, 2, 2]], axis=-1)],
+                    axis=1)
+
 def cartesian_to_spherical(cartesian):
     """Convert cartesian to spherical coordinates passed as (N,3) shaped arrays."""
     xyz = cartesian
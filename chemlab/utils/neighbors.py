@@ -9,7 +9,6 @@ import numpy as np
 import collections
 
 # Our searches use mainly a periodic variant of KDTree
-from ..libs.periodic_kdtree import PeriodicCKDTree
 
 def _check_coordinates(coordinates):
     '''Validate coordinate-like input'''
@@ -20,10 +19,10 @@ def _check_periodic(periodic):
     '''Validate periodic input'''
     periodic = np.array(periodic)
 
-    # If it is a matrix
+    # If it is a matrix of box vectors, they can be triclinic
     if len(periodic.shape) == 2:
         assert periodic.shape[0] == periodic.shape[1], 'periodic shoud be a square matrix or a flat array'
-        return np.diag(periodic)
+        return periodic
     elif len(periodic.shape) == 1:
         return periodic
     else:
@@ -42,14 +41,16 @@ def nearest_neighbors(coordinates_a, coordinates_b, periodic, r=None, n=None):
     '''Nearest neighbor search between two arrays of coordinates. Notice that
     you can control the result by selecting neighbors either by radius *r* or
     by number *n*. The algorithm uses a periodic variant of KDTree to reach a
-    Nlog(N) time complexity.
+    Nlog(N) time complexity. When *periodic* is a matrix of box vectors,
+    the images of the points are searched in fractional coordinates,
+    and the box can be triclinic.
 
     :param np.ndarray coordinates_a: Either an array of coordinates of shape (N,3)
                                      or a single point of shape (3,)
     :param np.ndarray coordinates_b: Same as coordinates_a
-    :param np.ndarray periodic: Either a matrix of box vectors (3, 3) or an
-                                array of box lengths of shape (3,). Only
-                                orthogonal boxes are supported.
+    :param np.ndarray periodic: Either a matrix of box vectors (3, 3), one
+                                per row, or an array of box lengths of
+                                shape (3,).
     :param float r: Radius of neighbor search
     :param int n: Number of nearest neighbors to return
 
@@ -61,7 +62,11 @@ def nearest_neighbors(coordinates_a, coordinates_b, periodic, r=None, n=None):
     coordinates_b = _check_coordinates(coordinates_b)
     periodic = _check_periodic(periodic)
 
-    kdtree = PeriodicCKDTree(periodic, coordinates_b)
+    from ..libs.periodic_kdtree import PeriodicCKDTree, TriclinicCKDTree
+    if periodic.ndim == 2:
+        kdtree = TriclinicCKDTree(periodic, coordinates_b)
+    else:
+        kdtree = PeriodicCKDTree(periodic, coordinates_b)
 
     if r is not None:
         neigh = kdtree.query_ball_point(coordinates_a, r)
@@ -71,7 +76,7 @@ def nearest_neighbors(coordinates_a, coordinates_b, periodic, r=None, n=None):
             return (neigh, coordinates_b.take(neigh, axis=0)) if len(neigh) != 0 else ([], [])
 
     if n is not None:
-        neigh = kdtree.query(coordinates_b, n)
+        neigh = kdtree.query(coordinates_a, n)
         return neigh if len(neigh) != 0 else ([], [])
 
 def count_neighbors(coordinates_a, coordinates_b, periodic, r):
@@ -80,9 +85,9 @@ def count_neighbors(coordinates_a, coordinates_b, periodic, r):
     :param np.ndarray coordinates_a: Either an array of coordinates of shape (N,3)
                                      or a single point of shape (3,)
     :param np.ndarray coordinates_b: Same as coordinates_a
-    :param np.ndarray periodic: Either a matrix of box vectors (3, 3) or an
-                                array of box lengths of shape (3,). Only
-                                orthogonal boxes are supported.
+    :param np.ndarray periodic: Either a matrix of box vectors (3, 3), one
+                                per row, or an array of box lengths of
+                                shape (3,).
     :param float r: Radius of neighbor search
 
     '''
@@ -95,3 +100,232 @@ def count_neighbors(coordinates_a, coordinates_b, periodic, r):
         return [len(ix) for ix in indices]
     else:
         return len(indices)
+
+def _cell_spacing(extent, cutoff, n_points):
+    # The spacing of the cells for a search within *cutoff*: at least
+    # the cutoff, and big enough that there are not many more cells
+    # than points (a dense grid of empty cells is scanned in vain)
+    extent = np.asarray(extent, dtype='float')
+    spacing = cutoff
+    while np.prod(np.maximum(extent // spacing, 1)) > 8 * n_points + 27:
+        spacing *= 2
+    return spacing
+
+def neighbor_pairs(coordinates, cutoff, box_vectors=None, n_threads=1):
+    '''Find all the pairs of points closer than *cutoff*, optionally
+    considering periodic boundary conditions. Without a box, or in an
+    orthorhombic box, the pairs are found with a
+    :class:`chemlab.utils.celllinkedlist.CellLinkedList`, in a triclinic
+    box with a :class:`chemlab.libs.periodic_kdtree.TriclinicCKDTree`.
+    
+    **Parameters**
+    
+    coordinates: np.ndarray((N, 3))
+       Array of coordinates
+    cutoff: float
+       Maximum distance
+    box_vectors: None or np.ndarray((3, 3))
+       If not None, the periodic box (one vector per row), that can
+       be triclinic. The cutoff can't be bigger than half the
+       distance between opposite faces of the box.
+    n_threads: int
+       Number of threads used by the cell list search.
+    
+    **Returns**
+    
+    A tuple (pairs, distances), where *pairs* is a np.ndarray((M, 2))
+    of indices, with ``pairs[:, 0] < pairs[:, 1]``, and distances is a
+    np.ndarray((M,)) containing the (minimum image) distance for each
+    pair.
+    
+    '''
+    from .celllinkedlist import CellLinkedList
+    
+    coordinates = np.asarray(coordinates, dtype='float')
+    if len(coordinates) == 0:
+        return np.zeros((0, 2), dtype='int'), np.zeros(0)
+    
+    if box_vectors is None:
+        origin = coordinates.min(axis=0)
+        extent = coordinates.max(axis=0) - origin
+        spacing = _cell_spacing(extent, cutoff, len(coordinates))
+        cells = CellLinkedList(coordinates - origin, spacing, extent=extent)
+        i, j, d = cells.query_pairs(cutoff, n_threads=n_threads)
+    else:
+        box_vectors = np.asarray(box_vectors, dtype='float')
+        if np.count_nonzero(box_vectors - np.diag(np.diag(box_vectors))) == 0:
+            size = np.diag(box_vectors)
+            if cutoff > size.min() / 2:
+                raise ValueError('cutoff ({}) should not be bigger than half the box width ({})'
+                                 .format(cutoff, size.min() / 2))
+            spacing = _cell_spacing(size, cutoff, len(coordinates))
+            cells = CellLinkedList(coordinates, spacing, size)
+            i, j, d = cells.query_pairs(cutoff, n_threads=n_threads)
+        else:
+            from ..libs.periodic_kdtree import TriclinicCKDTree
+            i, j, d = TriclinicCKDTree(box_vectors, coordinates).query_pairs(cutoff)
+    
+    return np.column_stack([i, j]), d
+
+# Lattice translations to a cell and its 26 neighbors
+_IMAGES = np.array([(i, j, k) for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)])
+
+class NeighborList(object):
+    '''A Verlet neighbor list, that keeps the pairs of points closer
+    than *cutoff* + *skin* and rebuilds them only when a point has
+    moved by more than half the skin, so that it can be reused across
+    the frames of a trajectory.
+
+    In a periodic box the points are followed in fractional
+    coordinates, so that the stored pairs deform with the box. A box
+    that changes at each frame (as in a constant pressure simulation)
+    consumes part of the skin, in proportion to the deformation,
+    instead of causing a rebuild.
+
+    After each call to :meth:`update`, the pairs closer than *cutoff*
+    are available as contiguous arrays in the attributes *i*, *j*
+    (with ``i < j``) and *d*, the (minimum image) distances.
+
+    **Parameters**
+
+    cutoff: float
+       Maximum distance
+    skin: float
+       Additional distance for the stored pairs. A bigger skin means
+       fewer rebuilds, but more pairs checked at each update.
+
+    **Example**
+
+    The coordination number of each atom, in each frame::
+
+        nl = NeighborList(0.35, skin=0.1)
+        for coords, box in zip(traj.coords, traj.boxes):
+            nl.update(coords, box)
+            n = np.bincount(nl.i, minlength=len(coords)) + np.bincount(nl.j, minlength=len(coords))
+
+    '''
+
+    def __init__(self, cutoff, skin=0.1):
+        self.cutoff = cutoff
+        self.skin = skin
+        self.n_builds = 0
+
+        self.i = np.zeros(0, dtype='int')
+        self.j = np.zeros(0, dtype='int')
+        self.d = np.zeros(0)
+
+        self._reference = None
+        self._box = None
+
+    def _positions(self, coordinates, box_vectors):
+        # The coordinates comparable with the reference: in a periodic
+        # box the fractional coordinates, undoing the translations by
+        # box vectors (when the points are wrapped back in the box)
+        # since the last build
+        if box_vectors is None:
+            return coordinates
+        fractional = coordinates.dot(np.linalg.inv(box_vectors))
+        jumps = np.rint(fractional - self._reference)
+        if jumps.any():
+            fractional -= jumps
+        return fractional
+
+    def _needs_build(self, coordinates, box_vectors):
+        if self._reference is None or len(coordinates) != len(self._reference):
+            return True
+        if (box_vectors is None) != (self._box is None):
+            return True
+
+        displacement = self._positions(coordinates, box_vectors) - self._reference
+        margin = self.skin
+        if box_vectors is not None:
+            # Displacements from the reference deformed with the box.
+            # The distances of the pairs beyond cutoff + skin shrink
+            # at most by the smallest singular value of the deformation.
+            displacement = displacement.dot(box_vectors)
+            deformation = self._inverse.dot(box_vectors)
+            shrink = np.linalg.svd(deformation, compute_uv=False).min()
+            margin = shrink * (self.cutoff + self.skin) - self.cutoff
+            if margin <= 0:
+                return True
+
+        moved = np.einsum('ij,ij->i', displacement, displacement)
+        return len(moved) > 0 and moved.max() > (0.5 * margin) ** 2
+
+    def build(self, coordinates, box_vectors=None):
+        '''Find the pairs closer than *cutoff* + *skin*, with a
+        :func:`neighbor_pairs` search.
+
+        '''
+        coordinates = np.array(coordinates, dtype='float')
+        pairs, distances = neighbor_pairs(coordinates, self.cutoff + self.skin, box_vectors)
+        self._pair_i = np.ascontiguousarray(pairs[:, 0])
+        self._pair_j = np.ascontiguousarray(pairs[:, 1])
+
+        if box_vectors is None:
+            self._reference = coordinates
+            self._box = None
+            self._shifts = None
+        else:
+            self._box = np.array(box_vectors, dtype='float')
+            self._inverse = np.linalg.inv(self._box)
+            self._reference = coordinates.dot(self._inverse)
+
+            # The lattice translation that gives the minimum image of
+            # each pair, checking all the neighboring images when the
+            # nearest one in fractional coordinates is not the right one
+            frac = self._reference[self._pair_j] - self._reference[self._pair_i]
+            shifts = -np.rint(frac)
+            delta = (frac + shifts).dot(self._box)
+            wrong = np.nonzero(np.einsum('ij,ij->i', delta, delta) >
+                               distances ** 2 + 1e-8)[0]
+            if len(wrong) > 0:
+                images = (frac[wrong, np.newaxis] + shifts[wrong, np.newaxis] + _IMAGES).dot(self._box)
+                nearest = (images ** 2).sum(axis=-1).argmin(axis=1)
+                shifts[wrong] += _IMAGES[nearest]
+            self._shifts = shifts
+
+        self.n_builds += 1
+
+    def update(self, coordinates, box_vectors=None):
+        '''Compute the pairs closer than *cutoff* for the new
+        *coordinates*, rebuilding the list only if needed. The list is
+        also rebuilt when the number of points changes, or when the box
+        deforms by more than the skin allows.
+
+        **Parameters**
+
+        coordinates: np.ndarray((N, 3))
+           Array of coordinates. When the box is periodic, they can be
+           wrapped in the box or not.
+        box_vectors: None or np.ndarray((3, 3))
+           The periodic box (one vector per row), that can be
+           triclinic. The cutoff plus the skin can't be bigger than half
+           the distance between opposite faces of the box.
+
+        **Returns**
+
+        The arrays (i, j, d), also stored in the attributes of the
+        same name.
+
+        '''
+        coordinates = np.asarray(coordinates, dtype='float')
+        if box_vectors is not None:
+            box_vectors = np.asarray(box_vectors, dtype='float')
+        if self._needs_build(coordinates, box_vectors):
+            self.build(coordinates, box_vectors)
+
+        i, j = self._pair_i, self._pair_j
+        positions = self._positions(coordinates, box_vectors)
+        delta = positions.take(j, axis=0)
+        delta -= positions.take(i, axis=0)
+        if self._shifts is not None:
+            delta += self._shifts
+            delta = delta.dot(box_vectors)
+        distances = np.sqrt(np.einsum('ij,ij->i', delta, delta))
+
+        within = np.nonzero(distances <= self.cutoff)[0]
+        self.i = i.take(within)
+        self.j = j.take(within)
+        self.d = distances.take(within)
+        return self.i, self.j, self.d
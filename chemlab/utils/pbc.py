@@ -1,5 +1,4 @@
 import numpy as np
-import dask.array as da
 from collections import Sequence
 
 
@@ -151,9 +150,23 @@ def cell_coordinates(fractional, box_vectors):
     return box_vectors.T.dot(fractional.T).T
 
 
+# Lattice translations to a cell and its 26 neighbors, in fractional
+# coordinates
+_IMAGES = np.array([(i, j, k) for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)])
+
 def general_periodic_distance(a, b, box_vectors):
-    frac = fractional_coordinates(b - a, box_vectors)
-    delta = np.abs(frac)
-    periodic = 1.0
-    delta = np.where(delta > 0.5 * periodic, periodic - delta, delta)
-    return np.linalg.norm(cell_coordinates(delta, box_vectors))
+    '''Minimum image distance between the points (or arrays of
+    points) *a* and *b* in a periodic box, that can be triclinic.
+    *box_vectors* contains one box vector per row.
+
+    The difference vector is wrapped in fractional coordinates, and
+    all its images in the neighboring cells are compared, so the
+    result is exact unless the box is very skewed.
+
+    '''
+    box_vectors = np.asarray(box_vectors, dtype='float')
+    delta = np.asarray(b, dtype='float') - np.asarray(a, dtype='float')
+    frac = np.dot(delta, np.linalg.inv(box_vectors))
+    frac -= np.rint(frac)
+    images = np.dot(frac[..., np.newaxis, :] + _IMAGES, box_vectors)
+    return np.sqrt((images ** 2).sum(axis=-1)).min(axis=-1)
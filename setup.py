@@ -1,7 +1,55 @@
+import os
+import shutil
+import tempfile
+from distutils.errors import CompileError, LinkError
 from setuptools import setup, find_packages, Extension
 from Cython.Distutils import build_ext
 import numpy as np
 
+# The distance kernels run in parallel with OpenMP, when the compiler
+# supports it
+openmp_modules = ['chemlab.utils.celllinkedlist', 'chemlab.utils.cdist']
+
+class build_ext_openmp(build_ext):
+    '''Compile the modules in openmp_modules with the OpenMP flags of
+    the compiler, or serially when OpenMP is not available.'''
+    
+    def build_extensions(self):
+        flags = self._openmp_flags()
+        if flags is None:
+            print("warning: OpenMP is not available, the distance kernels "
+                  "will run serially")
+        else:
+            for ext in self.extensions:
+                if ext.name in openmp_modules:
+                    ext.extra_compile_args = ext.extra_compile_args + flags[0]
+                    ext.extra_link_args = ext.extra_link_args + flags[1]
+        build_ext.build_extensions(self)
+    
+    def _openmp_flags(self):
+        # (compile, link) flags, or None if they don't work
+        if self.compiler.compiler_type == 'msvc':
+            flags = (['/openmp'], [])
+        else:
+            flags = (['-fopenmp'], ['-fopenmp'])
+        
+        tmpdir = tempfile.mkdtemp()
+        try:
+            source = os.path.join(tmpdir, 'openmp_test.c')
+            with open(source, 'w') as f:
+                f.write('#include <omp.h>\n'
+                        'int main(void) { return omp_get_max_threads() < 1; }\n')
+            objects = self.compiler.compile([source], output_dir=tmpdir,
+                                            extra_postargs=flags[0])
+            self.compiler.link_executable(objects, 
+                                          os.path.join(tmpdir, 'openmp_test'),
+                                          extra_postargs=flags[1])
+        except (CompileError, LinkError):
+            return None
+        finally:
+            shutil.rmtree(tmpdir)
+        return flags
+
 ext_modules = [Extension('chemlab.libs.ckdtree', ['chemlab/libs/ckdtree.pyx']),
                Extension('chemlab.utils._covertree', ['chemlab/utils/_covertree.pyx']),
                Extension('chemlab.utils.celllinkedlist',
@@ -21,7 +69,7 @@ setup(
     name = "chemlab",
     version = "1.1",
     packages = find_packages(),
-    cmdclass = {'build_ext': build_ext},
+    cmdclass = {'build_ext': build_ext_openmp},
     ext_modules = ext_modules,
     include_dirs = [np.get_include()],
     install_requires = ['dask', 'toolz', 'cython', 'six', 
@@ -1,10 +1,12 @@
 from chemlab.core.base import (Attribute, InstanceAttribute, 
+                               CategoricalAttribute, InstanceCategoricalAttribute,
                                Field, InstanceField,
                                Relation, InstanceRelation,
                                ChemicalEntity,
                                concatenate_fields,
                                concatenate_relations,
                                concatenate_attributes) 
+from chemlab.core.attributes import as_categories
 from nose.tools import eq_, ok_, assert_raises
 import numpy as np
 from .testtools import assert_npequal
@@ -47,6 +49,7 @@ def test_instance_attribute():
     # Reordering with wrong input raises ValueError
     assert_raises(ValueError, iattr.reorder, [1, 2])
     assert_raises(ValueError, iattr.reorder, [0, 1, 2, 100])
+    assert_raises(ValueError, iattr.reorder, [0, 1, 1, 2])
     
     # Test Copy
     iattr = InstanceAttribute('type_array', dim='atom', dtype='str')
@@ -70,6 +73,99 @@ def test_instance_attribute():
     iattr1 = iattr.sub([False, True, False]) 
     assert_npequal(iattr1.value, ['H'])
 
+def test_instance_attribute_append():
+    iattr = InstanceAttribute('type_array', dim='atom', dtype='unicode')
+    iattr.value = ['A', 'B']
+    
+    other = InstanceAttribute('type_array', dim='atom', dtype='unicode')
+    other.value = ['Cl']
+    for i in range(10):
+        iattr.append(other)
+    
+    eq_(iattr.size, 12)
+    assert_npequal(iattr.value, ['A', 'B'] + ['Cl'] * 10)
+    
+    # Capacity is reserved in advance
+    ok_(len(iattr._buffer) > iattr.size)
+    iattr.shrink_to_fit()
+    eq_(iattr._buffer, None)
+    assert_npequal(iattr.value, ['A', 'B'] + ['Cl'] * 10)
+    
+    # Appending fields
+    ifield = InstanceField('type_array', dtype='unicode')
+    ifield.value = 'Na'
+    iattr.append(ifield)
+    assert_npequal(iattr.value[-2:], ['Cl', 'Na'])
+
+def test_instance_attribute_inverted_index():
+    iattr = InstanceAttribute('type_array', dim='atom', dtype='unicode')
+    iattr.value = ['O', 'H', 'H', 'Cl', 'H', 'O']
+    
+    keys, order, offsets = iattr.inverted_index()
+    assert_npequal(keys, ['Cl', 'H', 'O'])
+    assert_npequal(order[offsets[1]:offsets[2]], [1, 2, 4])
+    ok_(iattr.inverted_index()[0] is keys)
+    
+    assert_npequal(iattr.indices_of(['O', 'Cl']), [0, 3, 5])
+    assert_npequal(iattr.indices_of(['C']), [])
+    assert_npequal(iattr.mask_of(['H']), [False, True, True, False, True, False])
+    
+    iattr.value = ['C', 'C']
+    assert_npequal(iattr.indices_of(['C']), [0, 1])
+
+def test_instance_categorical_attribute():
+    iattr = CategoricalAttribute(dim='atom').create('type_array')
+    ok_(isinstance(iattr, InstanceCategoricalAttribute))
+    iattr.value = ['O', 'H', 'H', 'Cl', 'H', 'O']
+    
+    assert_npequal(iattr.categories, ['Cl', 'H', 'O'])
+    assert_npequal(iattr.codes, [2, 1, 1, 0, 1, 2])
+    eq_(iattr.codes.dtype, np.int16)
+    eq_(iattr.field(3).value, 'Cl')
+    
+    # The operations that don't read the value work on the codes,
+    # new strings are added to the categories
+    iattr.append(iattr.field(0))
+    field = InstanceField('type_array', dtype='unicode')
+    field.value = 'Na'
+    iattr.append(field)
+    assert_npequal(iattr.codes, [2, 1, 1, 0, 1, 2, 2, 3])
+    assert_npequal(iattr.indices_of(['O', 'Na']), [0, 5, 6, 7])
+    sub = iattr.sub([3, 7])
+    assert_npequal(sub.codes, [0, 3])
+    ok_(sub.categories is iattr.categories)
+    
+    # copy and reorder
+    copy = iattr.copy()
+    copy.reorder([7, 6, 5, 4, 3, 2, 1, 0])
+    eq_(copy.value[0], 'Na')
+    assert_npequal(iattr.codes[:2], [2, 1])
+    
+    # concatenate, the categories are merged
+    other = CategoricalAttribute(dim='atom').create('type_array')
+    other.value = ['C', 'O']
+    newattr = concatenate_attributes([iattr, other])
+    ok_(isinstance(newattr, InstanceCategoricalAttribute))
+    assert_npequal(newattr.value[-3:], ['Na', 'C', 'O'])
+    eq_(len(newattr.categories), 5)
+    
+    # Once read, the strings are stored and they can be modified in
+    # any way
+    value = iattr.value
+    ok_(iattr.value is value)
+    value[0] = 'C'
+    value[1:3][0] = 'N'
+    np.copyto(value[3:4], 'K')
+    assert_npequal(iattr.value[:4], ['C', 'N', 'H', 'K'])
+    assert_npequal(iattr.categories[iattr.codes], value)
+    assert_npequal(as_categories(iattr)[0], ['C', 'H', 'K', 'N', 'Na', 'O'])
+    assert_npequal(iattr.indices_of(['O', 'Na']), [5, 6, 7])
+    assert_npequal(concatenate_attributes([iattr, other]).value[-3:], ['Na', 'C', 'O'])
+    
+    # Assigning a new value stores the codes again
+    iattr.value = ['A', 'B']
+    assert_npequal(iattr.codes, [0, 1])
+
 def test_instance_relation():
     irel = InstanceRelation('bonds', map='atoms', index=range(3), dim='bonds', shape=(2,))
     eq_(irel.size, 0)
@@ -91,6 +187,24 @@ def test_instance_relation():
     irel.remap([0, 1, 2], [2, 0, 1])
     assert_npequal(irel.value, [[2, 1], [2, 0]])
     
+    # filtering
+    assert_npequal(irel.mask_within([True, True, False]), [False, False])
+    assert_npequal(irel.mask_within([True, True, True]), [True, True])
+    
+    # grouping
+    imap = InstanceRelation('map', map='molecule', index=range(3), dim='atom')
+    imap.value = [0, 0, 1, 1, 1, 2]
+    order, offsets = imap.groups()
+    eq_(order, None)
+    assert_npequal(offsets, [0, 2, 5, 6])
+    assert_npequal(imap.members([2, 0]), [5, 0, 1])
+    
+    imap.value = [1, 0, 1, 2, 0, 1]
+    order, offsets = imap.groups()
+    assert_npequal(order, [1, 4, 0, 2, 5, 3])
+    assert_npequal(offsets, [0, 2, 5, 6])
+    assert_npequal(imap.members([1]), [0, 2, 5])
+    
 def test_instance_field():
     ifield = InstanceField('mass')
     eq_(ifield.value, 0.0)
@@ -362,6 +476,24 @@ class TestChemicalEntity(object):
         assert_npequal(b.maps['x', 'a'].value, [0, 1, 1, 0, 1, 2, 2, 2]) # swapped
         assert_npequal(b.maps['y', 'a'].value, [0, 1, 1, 2, 2]) # untouched    
         assert_npequal(b.bonds, [[0, 3], [2, 1], [2, 4], [5, 6], [5, 7]]) # remapped 
+        
+        # A permutation that is not its own inverse
+        b = B.from_arrays(type_array=['A', 'B', 'D', 'E', 'F', 'G', 'H', 'I'],
+                          bonds=[[0, 1], [2, 3], [2, 4], [5, 6], [5, 7]],
+                          maps={('x', 'a'): [0, 0, 1, 1, 1, 2, 2, 2],
+                                ('y', 'a'): [0, 1, 1, 2, 2]})
+        c = b.copy()
+        b.reorder_dimension([1, 2, 0], 'a')
+        assert_npequal(b.type_array, ['D', 'E', 'F', 'G', 'H', 'I', 'A', 'B'])
+        assert_npequal(b.maps['x', 'a'].value, [0, 0, 0, 1, 1, 1, 2, 2])
+        assert_npequal(b.maps['y', 'a'].value, [0, 0, 1, 1, 2])
+        assert_npequal(b.bonds, [[0, 1], [0, 2], [3, 4], [3, 5], [6, 7]])
+        
+        # The copy is not affected
+        assert_npequal(c.type_array, ['A', 'B', 'D', 'E', 'F', 'G', 'H', 'I'])
+        assert_npequal(c.bonds, [[0, 1], [2, 3], [2, 4], [5, 6], [5, 7]])
+        
+        assert_raises(ValueError, b.reorder_dimension, [0, 0, 1], 'a')
     
     def test_copy(self):
         b = B.from_arrays(type_array=['A', 'B', 'D', 'E', 'F', 'G', 'H', 'I'],
@@ -371,6 +503,47 @@ class TestChemicalEntity(object):
         c = b.copy()
         c.type_array[0] = 'D'
         eq_(b.type_array[0], 'A')
+        
+        # Copy-on-write, the arrays are shared until they are read
+        c = b.copy()
+        bonds = b.get_attribute('bonds')._data
+        ok_(c.get_attribute('bonds')._data is bonds)
+        
+        # The one that reads keeps the data, the other takes a copy
+        stale = c.bonds
+        ok_(stale is bonds)
+        b.bonds[0] = [1, 0]
+        assert_npequal(c.bonds[0], [0, 1])
+        c.bonds += 1
+        assert_npequal(c.bonds[0], [1, 2])
+        assert_npequal(b.bonds[0], [1, 0])
+        stale[0] = [0, 0]
+        assert_npequal(c.bonds[0], [0, 0])
+        
+        # Arrays read before the copy don't refer to the copy
+        bonds = b.bonds
+        c = b.copy()
+        bonds[0] = [3, 3]
+        assert_npequal(c.bonds[0], [1, 0])
+        np.copyto(b.bonds, np.zeros((5, 2), dtype='int'))
+        assert_npequal(c.bonds[1], [2, 3])
+        
+        # Reassigned arrays are never copied
+        c = b.copy()
+        d = c.copy()
+        value = c.get_attribute('type_array')._data
+        ok_(d.get_attribute('type_array')._data is value)
+        d.type_array = ['Z'] * 8
+        ok_(c.get_attribute('type_array')._data is value)
+        c.type_array[1] = 'Y'
+        assert_npequal(b.type_array[:2], ['A', 'B'])
+        assert_npequal(d.type_array[:2], ['Z', 'Z'])
+        
+        # The last owner doesn't copy
+        c = b.copy()
+        value = b.get_attribute('type_array')._data
+        del c
+        ok_(b.type_array is value)
     
     def test_concat(self):
         b = B.from_arrays(type_array=['A', 'B', 'D', 'E', 'F'],
@@ -396,3 +569,67 @@ class TestChemicalEntity(object):
         assert_npequal(b.sub(type_array=['B', 'D']).type_array, ['B', 'D'])
         assert_npequal(b.sub(a_index=1).type_array, ['D', 'E', 'F'])
         
+        # The index is dropped when the attribute is reassigned
+        b.type_array = ['A', 'A', 'Q', 'B', 'F']
+        assert_npequal(b.where(type_array='A')['x'], [True, True, False, False, False])
+        assert_npequal(b.where(type_array=['Q', 'Z'])['a'], [False, True])
+        assert_npequal(b.where(type_array=[])['x'], [False] * 5)
+
+    def test_view(self):
+        b = B.from_arrays(type_array=['A', 'B', 'D', 'E', 'F'],
+                          bonds=[[0, 1], [2, 3], [2, 4]],
+                          maps={('x', 'a'): [0, 0, 1, 1, 1],
+                                ('y', 'a'): [0, 1, 1]})
+        
+        c = b.sub(a_index=1, view=True)
+        eq_(c.dimensions['x'], 3)
+        eq_(c.get_attribute('type_array').size, 3)
+        assert_npequal(c.type_array, ['D', 'E', 'F'])
+        assert_npequal(c.bonds, [[0, 1], [0, 2]])
+        assert_npequal(c.maps['x', 'a'].value, [0, 0, 0])
+        assert_npequal(c.maps['y', 'a'].value, [0, 0])
+        
+        # Contiguous selections don't copy
+        ok_(np.may_share_memory(c.type_array, b.type_array))
+        
+        # Views are read-only until materialized
+        assert_raises(ValueError, c.type_array.__setitem__, 0, 'Z')
+        c.materialize()
+        c.type_array[0] = 'Z'
+        assert_npequal(b.type_array, ['A', 'B', 'D', 'E', 'F'])
+        
+        # Assigning a value doesn't affect the original
+        c = b.sub(type_array=['A', 'F'], view=True)
+        assert_npequal(c.type_array, ['A', 'F'])
+        c.type_array = ['X', 'Y']
+        assert_npequal(b.type_array, ['A', 'B', 'D', 'E', 'F'])
+        
+        assert_raises(ValueError, b.sub, a_index=1, view=True, inplace=True)
+    
+    def test_property_lookup(self):
+        import pickle
+        from chemlab.core import System
+        s = System.from_arrays(r_array=[[0.0, 0.0, 0.0]], type_array=['O'])
+        
+        # Aliases and names resolve to the same attribute
+        ok_(s.get_attribute('coords', alias=True) is s.get_attribute('r_array'))
+        ok_(s.has_attribute('coords', alias=True))
+        ok_(not s.has_attribute('coords'))
+        ok_(not s.has_attribute('velocities'))
+        
+        s.coords = [[1.0, 2.0, 3.0]]
+        assert_npequal(s.r_array, [[1.0, 2.0, 3.0]])
+        
+        # Modifying the property dictionaries invalidates the lookup
+        s.__attributes__['velocities'] = Attribute(alias='vel', dim='atom').create('velocities')
+        ok_(s.has_attribute('vel', alias=True))
+        del s.__attributes__['velocities']
+        ok_(not s.has_attribute('vel', alias=True))
+        
+        s.__attributes__ = {}
+        ok_(not s.has_attribute('r_array'))
+        
+        # Pickled copies keep track of their own properties
+        t = pickle.loads(pickle.dumps(s))
+        t.__attributes__['velocities'] = Attribute(alias='vel', dim='atom').create('velocities')
+        ok_(t.has_attribute('vel', alias=True))
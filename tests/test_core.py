@@ -1,15 +1,20 @@
 """Test core types like Molecule and Atom."""
 from __future__ import division, print_function
 
+import os
+import tempfile
+
 import numpy as np
 from nose.plugins.attrib import attr
-from nose.tools import assert_equals, eq_, ok_
+from nose.tools import assert_equals, assert_raises, eq_, ok_
 
 from chemlab.core import (System, crystal, merge_systems, random_box,
                           subsystem_from_atoms, subsystem_from_molecules,
-                          random_lattice_box, Atom, Molecule)
+                          random_lattice_box, Atom, Molecule, guess_bonds,
+                          solvate)
 
 from chemlab.table import vdw_radius
+from chemlab.utils.neighbors import neighbor_pairs
 from chemlab.io import datafile
 
 #from chemlab.graphics.qt import display_system
@@ -106,10 +111,42 @@ class TestSystem(object):
             [batch.append(mol) for mol in mols]
         self._assert_init(system)
 
+    def test_concatenate(self):
+        mols = self._make_molecules()
+        parts = [System(mols[:1]), System(), System(mols[1:3]), System(mols[3:])]
+        system = System.concatenate(parts)
+        self._assert_init(system)
+        assert_npequal(system.maps['atom', 'molecule'].value, 
+                       [0, 0, 0, 1, 1, 1, 2, 2, 2, 3, 3, 3])
+        
+        # A part without bonds
+        na = System([Molecule([Atom('Na', [0.0, 0.0, 0.0])])])
+        system = System.concatenate([na, System(mols[:2])])
+        assert_npequal(system.type_array, ['Na', 'O', 'H', 'H', 'O', 'H', 'H'])
+        assert_eqbonds(system.bonds, [[1, 2], [1, 3], [4, 5], [4, 6]])
+        assert_npequal(system.maps['bond', 'molecule'].value, [1, 1, 2, 2])
+        
+        eq_(System.concatenate([]).n_atoms, 0)
+
+    def test_concatenate_many_categories(self):
+        # The merged category tables have more entries than int16 can index
+        rng = np.random.RandomState(0)
+        symbols = np.array(['H', 'C', 'N', 'O', 'Na', 'Cl', 'S', 'P'])
+        types = symbols.take(np.argsort(rng.rand(9000, len(symbols)), axis=1)[:, :4])
+        parts = [System.from_arrays(type_array=t, r_array=np.zeros((4, 3)))
+                 for t in types]
+
+        system = System.concatenate(parts)
+        assert_npequal(system.type_array, types.ravel())
+        eq_(len(system.get_attribute('type_array').categories), len(symbols))
+
     def test_from_empty(self):
         s = System.empty(molecule=3, atom=9, bonds=6)
         assert_npequal(s.type_array, [''] * 9)
         assert_npequal(s.molecule_name, [''] * 3)
+        
+        s.type_array[0] = 'N'
+        assert_npequal(s.type_array, ['N'] + [''] * 8)
 
     def test_from_actual_empty(self):
         mols = self._make_molecules()
@@ -163,6 +200,75 @@ class TestSystem(object):
         system.reorder_molecules([1, 0, 2, 3])
         assert_eqbonds(system.bonds, [[0, 2], [3, 4]])
 
+        # The arrays passed by the caller are not modified
+        r = np.arange(12, dtype='float').reshape(4, 3)
+        s = System.from_arrays(r_array=r, type_array=['O', 'H', 'Na', 'Cl'],
+                               maps={('atom', 'molecule'): [0, 0, 1, 1]})
+        s.reorder_dimension([1, 0], 'molecule')
+        assert_npequal(r, np.arange(12).reshape(4, 3))
+        assert_npequal(s.r_array, [[6, 7, 8], [9, 10, 11], [0, 1, 2], [3, 4, 5]])
+        assert_npequal(s.type_array, ['Na', 'Cl', 'O', 'H'])
+
+    def test_get_molecule(self):
+        mols = self._make_molecules()
+        system = System(mols)
+        
+        for i, mol in enumerate(system.molecules):
+            assert_allclose(mol.r_array, mols[i].r_array)
+            assert_eqbonds(mol.bonds, [[0, 1], [0, 2]])
+            eq_(len(mol.get_attribute('bonds').index), 3)
+        eq_(len(system.molecules), 4)
+        
+        # Atoms of a molecule that are not contiguous
+        system = System.from_arrays(
+            type_array=['O', 'Na', 'H', 'H'],
+            bonds=[[0, 2], [0, 3]],
+            maps={('atom', 'molecule'): [0, 1, 0, 0],
+                  ('bond', 'molecule'): [0, 0]})
+        mol = system.get_molecule(0)
+        assert_npequal(mol.type_array, ['O', 'H', 'H'])
+        assert_eqbonds(mol.bonds, [[0, 1], [0, 2]])
+        assert_npequal(system.get_molecule(1).type_array, ['Na'])
+        eq_(system.get_molecule(1).dimensions['bond'], 0)
+
+
+    def test_molecule_reduce(self):
+        mols = self._make_molecules()
+        system = System(mols)
+        system.charge_array = [-0.8, 0.4, 0.4] * 4
+        # Molecules that are not contiguous
+        system.reorder_molecules([2, 0, 3, 1])
+        mols = [system.get_molecule(i) for i in range(4)]
+        
+        assert_allclose(system.molecule_reduce('geometric_center'),
+                        [m.r_array.mean(axis=0) for m in mols])
+        masses = np.array([15.9994, 1.00794, 1.00794])
+        assert_allclose(system.molecule_reduce('center_of_mass'),
+                        [np.average(m.r_array, axis=0, weights=masses) for m in mols])
+        assert_allclose(system.molecule_reduce('dipole_moment'),
+                        [(m.r_array * m.charge_array[:, np.newaxis]).sum(axis=0) for m in mols])
+        assert_allclose(system.molecule_reduce('charge'), [0.0] * 4)
+        assert_npequal(system.molecule_reduce('formula'), ['H2O'] * 4)
+        
+        # A block of frames is reduced at once
+        frames = np.random.random((5, 12, 3))
+        rg = system.molecule_reduce('radius_of_gyration', frames)
+        eq_(rg.shape, (5, 4))
+        assert_allclose(rg[3], system.molecule_reduce('radius_of_gyration', frames[3]))
+
+        # For two atoms at distance d, rg = d * sqrt(m1 * m2) / (m1 + m2)
+        system = System([Molecule([Atom('O', [0.0, 0.0, 0.0]), Atom('H', [0.1, 0.0, 0.0])]),
+                         Molecule([Atom('Na', [0.5, 0.5, 0.5])])])
+        assert_allclose(system.molecule_reduce('radius_of_gyration'), [0.0236120, 0.0])
+
+        # The last molecule has no atoms
+        system = System.from_arrays(type_array=['O', 'H', 'H'], molecule_name=['A', 'B'],
+                                    maps={('atom', 'molecule'): [0, 0, 1]})
+        system.maps['atom', 'molecule'].value = [0, 0, 0]
+        assert_allclose(system._molecule_sum(np.array([1.0, 2.0, 4.0])), [7.0, 0.0])
+        assert_allclose(system._molecule_sum(np.ones((2, 3, 3)), axis=1),
+                        [[[3.0] * 3, [0.0] * 3]] * 2)
+
 
 class TestWhere(object):
     def setup(self):
@@ -217,6 +323,18 @@ def test_crystal():
                    repetitions=[13, 13, 13])
     eq_(tsys.r_array.min(), 0.0)
     eq_(tsys.r_array.max(), 12.5)
+    eq_(tsys.n_mol, 8 * 13 ** 3)
+    
+    # The sites alternate as in the unit cell
+    assert_npequal(tsys.type_array[:8], ['Na'] * 4 + ['Cl'] * 4)
+    assert_allclose(tsys.box_vectors, np.eye(3) * 13)
+    
+    # Sites that are equivalent across the cell boundary are merged
+    from chemlab.core.spacegroup.spacegroup import Spacegroup
+    sites, kinds = Spacegroup(225).equivalent_sites([[0.0, 0.0, 0.0], [0.9999999, 0.5, 0.5]],
+                                                    ondublicates='keep')
+    eq_(len(sites), 4)
+    eq_(kinds, [0, 0, 0, 0])
 
 
 def test_sort():
@@ -233,28 +351,101 @@ def test_sort():
     assert_npequal(tsys.type_array[:tsys.n_mol // 2], ['Cl'] * (tsys.n_mol // 2))
 
 
-# def test_random_box():
-#     na = Molecule([Atom('Na', [0.0, 0.0, 0.0])])
-#     cl = Molecule([Atom('Cl', [0.0, 0.0, 0.0])])
-#     water = Molecule([Atom('O', [0.0, 0.0, 0.0]),
-#                       Atom('H', [0.0, 0.1, 0.0]),
-#                       Atom('H', [0.1, 0.0, 0.0]), ])
-# 
-#     box = random_box([na, cl, water],
-#                      total=200,
-#                      proportions=[0.1, 0.1, 0.8],
-#                      size=[3, 3, 3])
-# 
-#     from chemlab.utils.pbc import periodic_distance
-#     for a, b in [('O', 'Na'), ('O', 'Cl'), ('Na', 'Cl')]:
-#         asys = box.sub(atom_type=a)
-#         bsys = box.sub(atom_type=b)
-# 
-#         D = periodic_distance(asys.r_array[None, :], bsys.r_array[:, None], 
-#                               np.array([3, 3, 3]))
-# 
-#         ok_(D.min() > vdw_radius(a) + vdw_radius(b))
+def test_random_box():
+    na = Molecule([Atom('Na', [0.0, 0.0, 0.0])])
+    cl = Molecule([Atom('Cl', [0.0, 0.0, 0.0])])
+    water = Molecule([Atom('O', [0.0, 0.0, 0.0]),
+                      Atom('H', [0.0, 0.1, 0.0]),
+                      Atom('H', [0.1, 0.0, 0.0]), ])
+
+    calls = []
+    box = random_box([na, cl, water],
+                     total=200,
+                     proportions=[0.1, 0.1, 0.8],
+                     size=[3, 3, 3], seed=42,
+                     progress=lambda placed, total: calls.append((placed, total)))
+    eq_(box.n_mol, 200)
+    eq_(calls[-1], (200, 200))
+    assert_npequal(box.type_array[:40], ['Na'] * 20 + ['Cl'] * 20)
+
+    from chemlab.utils.pbc import periodic_distance
+    for a, b in [('O', 'Na'), ('O', 'Cl'), ('Na', 'Cl')]:
+        ra = box.r_array[box.type_array == a]
+        rb = box.r_array[box.type_array == b]
+
+        D = periodic_distance(ra[None, :], rb[:, None], 
+                              np.array([3, 3, 3]))
+
+        ok_(D.min() > vdw_radius(a) + vdw_radius(b))
+
+    # Same seed, same box
+    again = random_box([na, cl, water], total=200, proportions=[0.1, 0.1, 0.8],
+                       size=[3, 3, 3], seed=42)
+    assert_allclose(box.r_array, again.r_array)
+
+    # Dense box, that needs the relaxation
+    dense = random_box([water], total=1000, size=[3.1, 3.1, 3.1],
+                       tolerance=0.2, maxtries=5, relax=1000, seed=0)
+    eq_(dense.n_mol, 1000)
+    mol = dense.maps['atom', 'molecule'].value
+    pairs, distances = neighbor_pairs(dense.r_array, 0.2, dense.box_vectors)
+    ok_(np.all(mol[pairs[:, 0]] == mol[pairs[:, 1]]))
+    assert_allclose(np.linalg.norm(dense.r_array[1::3] - dense.r_array[::3], axis=1), 0.1)
+
+    # Too dense without relaxation
+    assert_raises(Exception, random_box, [water], total=1000, size=[3.1, 3.1, 3.1],
+                  tolerance=0.2, maxtries=5, seed=0)
+
+
+def _lattice():
+    # 8 points, 0.5 nm apart
+    return np.array(np.meshgrid([0.0, 0.5], [0.0, 0.5], [0.0, 0.5])).reshape(3, -1).T
+
+def test_merge_systems():
+    water = Molecule([Atom('O', [0.0, 0.0, 0.0]),
+                      Atom('H', [0.1, 0.0, 0.0]),
+                      Atom('H', [0.0, 0.1, 0.0])])
+    na = Molecule([Atom('Na', [0.0, 0.0, 0.0])])
+    
+    solvent = System.from_template(water, 8, _lattice(),
+                                   box_vectors=np.diag([1.0, 1.0, 1.0]))
+    # The first ion is near the hydrogen of the water in the origin,
+    # the second one is near the water at [0.5, 0.5, 0.5] through the box
+    ions = System.from_template(na, 2, [[0.05, 0.15, 0.0], [0.45, 0.45, 0.45]])
+    
+    s = merge_systems(solvent, ions)
+    eq_(s.n_mol, 8)
+    assert_npequal(s.type_array[-2:], ['Na', 'Na'])
+    assert_allclose(s.box_vectors, np.diag([1.0, 1.0, 1.0]))
+    eq_(s.molecule_reduce('geometric_center')[:, 0].tolist().count(0.1 / 3), 3)
+    
+    s = merge_systems(solvent, ions, bounding=False)
+    eq_(s.n_mol, 10)
 
+def test_solvate():
+    water = Molecule([Atom('O', [0.0, 0.0, 0.0]),
+                      Atom('H', [0.1, 0.0, 0.0]),
+                      Atom('H', [0.0, 0.1, 0.0])])
+    na = Molecule([Atom('Na', [0.0, 0.0, 0.0])])
+    
+    # Some molecules are across the boundary of the solvent box
+    solvent = System.from_template(water, 8, _lattice() - 0.05,
+                                   box_vectors=np.diag([1.0, 1.0, 1.0]))
+    solute = System.from_template(na, 1, [[1.5, 1.5, 1.5]],
+                                  box_vectors=np.diag([2.5, 2.5, 2.5]))
+    
+    s = solvate(solute, solvent)
+    # 125 lattice points, minus the one on the ion
+    eq_(s.n_mol, 1 + 124)
+    eq_(s.type_array[0], 'Na')
+    assert_allclose(s.box_vectors, np.diag([2.5, 2.5, 2.5]))
+    centers = s.molecule_reduce('geometric_center')[1:]
+    ok_(np.all((centers >= 0) & (centers < 2.5)))
+    
+    pairs, _ = neighbor_pairs(s.r_array, 0.2, s.box_vectors)
+    ok_(not np.any(pairs[:, 0] == 0))
+    
+    assert_raises(ValueError, solvate, System.from_template(na, 1), solvent)
 
 def test_random_lattice():
     '''Testing random made box'''
@@ -267,6 +458,40 @@ def test_random_lattice():
     eq_(s.dimensions['atom'], 160 * 5)
 
 
+def test_from_template():
+    wat = Molecule([Atom('O', [0.0, 0.0, 0.0]),
+                    Atom('H', [0.1, 0.0, 0.0]),
+                    Atom('H', [-0.03333, 0.09428, 0.0])], 
+                   bonds=[[0, 1], [0, 2]])
+    positions = np.array([[0.0, 0.0, 0.0], [1.0, 0.0, 0.0], [0.0, 0.0, 1.0]])
+    # Rotation of 90 degrees around z, as matrix and as quaternion
+    rot = np.array([[0.0, -1.0, 0.0], [1.0, 0.0, 0.0], [0.0, 0.0, 1.0]])
+    quat = [np.cos(np.pi/4), 0.0, 0.0, np.sin(np.pi/4)]
+    
+    # Same as adding the molecules one by one
+    mols = []
+    for p in positions:
+        m = wat.copy()
+        m.r_array = m.r_array.dot(rot.T) + p
+        mols.append(m)
+    ref = System(mols)
+    
+    for rotations in [[rot] * 3, [quat] * 3]:
+        s = System.from_template(wat, 3, positions, rotations)
+        eq_(s.dimensions, ref.dimensions)
+        assert_allclose(s.r_array, ref.r_array)
+        assert_npequal(s.type_array, ref.type_array)
+        assert_npequal(s.bonds, ref.bonds)
+        assert_npequal(s.molecule_name, ref.molecule_name)
+        for key in ref.maps:
+            assert_npequal(s.maps[key].value, ref.maps[key].value)
+        eq_(s.get_molecule(2).bonds.tolist(), [[0, 1], [0, 2]])
+    
+    s = System.from_template(wat, 2)
+    assert_npequal(s.r_array, np.concatenate([wat.r_array] * 2))
+    eq_(System.from_template(wat, 0).dimensions['atom'], 0)
+
+
 def test_bonds():
     # TODO: deprecate this shit
     from chemlab.io import datafile
@@ -300,6 +525,31 @@ def test_bonds():
     assert_npequal(ss.bonds, np.array([[0, 1]]))
 
 
+def test_guess_bonds():
+    water = np.array([[0.0, 0.0, 0.0],
+                      [0.0957, 0.0, 0.0],
+                      [-0.024, 0.0927, 0.0]])
+    r_array = np.concatenate([water + [0.5, 0.5, 0.5], water + [0.98, 0.3, 0.3]])
+    # The second molecule crosses the boundary of the unit box 
+    r_array[4] -= [1.0, 0.0, 0.0]
+    type_array = ['O', 'H', 'H'] * 2
+    
+    bonds = guess_bonds(r_array, type_array, threshold=0.01)
+    assert_eqbonds(bonds, [[0, 1], [0, 2], [3, 5]])
+    
+    box_vectors = np.eye(3)
+    bonds = guess_bonds(r_array, type_array, threshold=0.01, box_vectors=box_vectors)
+    assert_eqbonds(bonds, [[0, 1], [0, 2], [3, 4], [3, 5]])
+    
+    # Triclinic box, with periodic images along the sheared vector
+    box_vectors = np.array([[1.0, 0.0, 0.0], [0.5, 1.0, 0.0], [0.0, 0.0, 1.0]])
+    r_array = np.concatenate([water + [0.5, 0.5, 0.5], water + [0.5, 0.98, 0.5]])
+    r_array[5] -= box_vectors[1]
+    bonds = guess_bonds(r_array, type_array, threshold=0.01, box_vectors=box_vectors)
+    assert_eqbonds(bonds, [[0, 1], [0, 2], [3, 4], [3, 5]])
+    
+    eq_(guess_bonds(np.zeros((0, 3)), [], threshold=0.01).shape, (0, 2))
+
 def test_bond_orders():
     # Get a molecule with some bonds
     wat = _make_water()
@@ -380,3 +630,11 @@ def test_serialization():
     jsonstr = tsys.to_json()
 
     npeq_(System.from_json(jsonstr).r_array, tsys.r_array)
+
+    # Binary format
+    directory = os.path.join(tempfile.mkdtemp(), 'tsys.chem')
+    tsys.save(directory)
+    for mmap_mode in [None, 'r']:
+        s = System.load(directory, mmap_mode=mmap_mode)
+        eq_(s.to_json(), jsonstr)
+    eq_(s.r_array.flags.writeable, False)
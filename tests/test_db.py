@@ -37,6 +37,12 @@ def test_local():
     
     npeq_(pre_dict['r_array'], post_dict['r_array'])
     
+    # Binary format, memory-mapped
+    db.store("system", 'norbornene-3', s, nowarn=True, format='binary')
+    post = db.get('system', 'norbornene-3', mmap_mode='r')
+    npeq_(pre_dict['r_array'], post.r_array)
+    npeq_(pre_dict['maps'][('atom', 'molecule')], post.maps['atom', 'molecule'].value)
+    
     
 def test_rcsb():
     db = RcsbDB()
@@ -0,0 +1,49 @@
+'''Importing chemlab has to be fast: the slow optional dependencies
+and the database are loaded only when they are used.
+
+'''
+import os
+import subprocess
+import sys
+
+# Time budget to import chemlab.core and chemlab.io, in seconds,
+# after numpy is imported (they take about 0.05 s)
+IMPORT_BUDGET = 0.5
+
+# Slow dependencies that should be imported only when they are used
+HEAVY = ['dask', 'scipy', 'h5py', 'tables', 'cclib', 'urllib.request',
+         'chemlab.graphics']
+
+# Also used by benchmarks/bench_import.py
+SCRIPT = '''
+import sys, time
+import numpy
+start = time.time()
+import {module}
+elapsed = time.time() - start
+import chemlab.db.chemlabdb
+print(elapsed)
+print(' '.join(m for m in {heavy!r} if m in sys.modules))
+print(chemlab.db.chemlabdb._element_table is not None)
+'''
+
+def run_import(module):
+    '''Import *module* in a new interpreter, after numpy. Return the
+    time it took, the heavy dependencies it loaded and whether it
+    parsed the element table.
+
+    '''
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join([root, env.get('PYTHONPATH', '')])
+    output = subprocess.check_output([sys.executable, '-c',
+                                      SCRIPT.format(module=module, heavy=HEAVY)],
+                                     env=env)
+    elapsed, loaded, parsed = output.decode().split('\n')[:3]
+    return float(elapsed), loaded.split(), parsed == 'True'
+
+def test_import():
+    elapsed, loaded, parsed = run_import('chemlab.core, chemlab.io')
+    assert elapsed < IMPORT_BUDGET, 'import took {:.3f} s'.format(elapsed)
+    assert loaded == [], 'imported {}'.format(loaded)
+    assert not parsed, 'element table parsed at import'
@@ -6,6 +6,7 @@ from chemlab.io import datafile, add_default_handler
 
 from chemlab.io.handlers import GromacsIO
 from chemlab.io.handlers import EdrIO
+from chemlab.io.handlers.gro_map import gro_to_cl
 from nose.tools import assert_raises, eq_
 from nose.plugins.skip import SkipTest
 
@@ -56,6 +57,13 @@ def test_read_gromacs():
     df = datafile('tests/data/cry.gro')
     s = df.read('system')
 
+def test_gro_type_map():
+    # Built on first use, and still a mapping
+    eq_(gro_to_cl['OW'], 'O')
+    eq_(gro_to_cl.get('Na'), 'Na')
+    eq_(gro_to_cl.get('XYZ', 'Unknown'), 'Unknown')
+    assert 'CA' in gro_to_cl
+
 def test_write_gromacs():
     water = Molecule([Atom('O', [0.0, 0.0, 0.0], name="OW"),
                       Atom('H', [0.1, 0.0, 0.0], name='HW1'),
@@ -1,3 +1,4 @@
+import numpy as np
 from chemlab.table import *
 from nose.tools import eq_
 from .testtools import feq_, npeq_
@@ -5,6 +6,9 @@ from .testtools import feq_, npeq_
 def test_atomic_no():
     eq_(atomic_no('H'), 1)
     npeq_(atomic_no(['O', 'H', 'H']), [8, 1, 1])
+    # 'Uuh' appears twice in the table, the first one is used
+    eq_(atomic_no('Uuh'), 117)
+    npeq_(atomic_no(['Uuh']), [117])
     
 def test_atomic_weight():
     feq_(atomic_weight('H'), 1.00794)
@@ -16,3 +20,15 @@ def test_vdw_radius():
 
 
     
+def test_covalent_radius():
+    feq_(covalent_radius('C'), 0.076)
+
+def test_element_index():
+    eq_(element_index('Na'), 11)
+    npeq_(element_index(np.array([['O', 'H'], ['Na', 'H']])), [[8, 1], [11, 1]])
+    eq_(element_index([]).shape, (0,))
+    
+    from chemlab.db.chemlabdb import element_table
+    # The file is parsed only once
+    assert element_table() is element_table()
+    eq_(element_table()['symbol'][8], 'O')
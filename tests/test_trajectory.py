@@ -31,6 +31,39 @@ def test_map():
     traj = Trajectory(coords, t)
     
     summed_coords = traj.map(np.sum, attributes="coords")
+    npeq_(list(summed_coords), [c.sum() for c in coords])
+    
+    times = traj.map(lambda frame: frame['t'], attributes=['t', 'coords'])
+    npeq_(list(times), t[:10])
+
+def test_parallel_map():
+    coords = np.random.rand(25, 10, 3)
+    traj = Trajectory(coords, chunk_size=4)
+    
+    expected = [c.sum() for c in coords]
+    npeq_(list(traj.map(np.sum, "coords", workers=3)), expected)
+    npeq_(list(traj.map(np.sum, "coords", chunk_size=10, workers=2, pool='process')),
+          expected)
+    
+    total = traj.reduce(np.copy, np.add, "coords", workers=3)
+    assert np.allclose(total, coords.sum(axis=0))
+
+def test_from_reader():
+    class Frame(object):
+        def __init__(self, coords, time):
+            self.coords = coords
+            self.time = time
+            self.box = np.identity(3)
+    
+    coords = np.random.rand(10, 10, 3)
+    traj = Trajectory.from_reader(lambda: (Frame(c, i * 0.1) for i, c in enumerate(coords)),
+                                  chunk_size=3)
+    traj['energy'] = np.arange(10)
+    
+    npeq_(traj.at(4)['coords'], coords[4])
+    npeq_(list(traj.map(lambda frame: frame['energy'] * 0.1 - frame['t'],
+                        ['t', 'energy'], workers=2)), np.zeros(10))
+    npeq_(np.concatenate([block['coords'] for block in traj.chunks()]), coords)
 
 def test_offload():
     from chemlab.io import datafile
@@ -3,10 +3,14 @@
 '''
 import numpy as np
 # import dask.array as da
-from chemlab.utils.pbc import distance_matrix, minimum_image, noperiodic
+from chemlab.utils.pbc import distance_matrix, minimum_image, noperiodic, general_periodic_distance
 from chemlab.utils.geometry import cartesian_to_spherical
-from chemlab.utils.neighbors import count_neighbors, nearest_neighbors
+from chemlab.utils.neighbors import count_neighbors, nearest_neighbors, neighbor_pairs, NeighborList
+from chemlab.utils.celllinkedlist import CellLinkedList
+from chemlab.utils import distances_within, overlapping_points, iter_distances_within
+from chemlab.utils import distance_matrix as chemlab_distance_matrix
 from chemlab.utils.numbaz import Int32HashTable
+from nose.tools import assert_raises, eq_
 from .testtools import npeq_
 
 import time
@@ -76,6 +80,198 @@ def test_neighbors():
     npeq_(c[0], close)
     npeq_(c[1], [close[1]])
 
+def test_general_periodic_distance():
+    box = np.array([[1.0, 0.0, 0.0],
+                    [0.8, 1.0, 0.0],
+                    [0.0, 0.0, 1.0]])
+
+    # The nearest image is across the skewed face
+    npeq_(general_periodic_distance([0.0, 0.0, 0.0], [0.9, 0.9, 0.0], box),
+          np.sqrt(0.1 ** 2 + 0.1 ** 2))
+    npeq_(general_periodic_distance([[0.0, 0.0, 0.0]], [[0.0, 0.0, 0.9]], box), [0.1])
+
+def test_neighbors_triclinic():
+    rng = np.random.RandomState(42)
+    box = np.array([[2.0, 0.0, 0.0],
+                    [0.7, 1.8, 0.0],
+                    [-0.5, 0.4, 1.9]])
+    a = rng.uniform(-3, 3, (100, 3))
+    b = rng.uniform(-3, 3, (300, 3))
+
+    # Brute force minimum image distances
+    dist = general_periodic_distance(a[:, np.newaxis], b[np.newaxis], box)
+
+    ix, c = nearest_neighbors(a, b, box, r=0.6)
+    for i in range(len(a)):
+        npeq_(ix[i], np.nonzero(dist[i] <= 0.6)[0])
+        npeq_(c[i], b[ix[i]])
+
+    npeq_(count_neighbors(a, b, box, 0.6), (dist <= 0.6).sum(axis=1))
+    npeq_(count_neighbors(a[0], b, box, 0.6), (dist[0] <= 0.6).sum())
+
+    d, ix = nearest_neighbors(a, b, box, n=3)
+    npeq_(d, np.sort(dist, axis=1)[:, :3])
+    npeq_(dist[np.arange(len(a))[:, np.newaxis], ix], d)
+
+def _sorted_pairs(pairs, distances):
+    order = np.lexsort(pairs.T[::-1])
+    return pairs[order], distances[order]
+
+def test_neighbor_pairs():
+    rng = np.random.RandomState(0)
+    coords = rng.uniform(-1, 3, (400, 3))
+    boxes = [None, np.diag([2.0, 2.5, 3.0]),
+             np.array([[2.0, 0.0, 0.0],
+                       [0.7, 1.8, 0.0],
+                       [-0.5, 0.4, 1.9]])]
+
+    for box in boxes:
+        if box is None:
+            dist = np.sqrt(((coords[:, np.newaxis] - coords) ** 2).sum(axis=-1))
+        else:
+            dist = general_periodic_distance(coords[:, np.newaxis], coords[np.newaxis], box)
+        expected = np.argwhere(np.triu(dist <= 0.4, 1))
+
+        pairs, distances = _sorted_pairs(*neighbor_pairs(coords, 0.4, box))
+        npeq_(pairs, expected)
+        assert np.allclose(distances, dist[expected[:, 0], expected[:, 1]])
+
+    # The cells are not much more than the points
+    far = rng.uniform(0, 1000, (100, 3))
+    eq_(len(neighbor_pairs(far, 1e-5)[0]), 0)
+    assert_raises(ValueError, neighbor_pairs, coords, 1.1, boxes[1])
+
+def test_neighbor_list():
+    rng = np.random.RandomState(0)
+    box = np.array([[2.0, 0.0, 0.0],
+                    [0.7, 1.8, 0.0],
+                    [-0.5, 0.4, 1.9]])
+    inverse = np.linalg.inv(box)
+    coords = rng.uniform(0, 1, (500, 3)).dot(box)
+
+    nl = NeighborList(0.3, skin=0.1)
+    for frame in range(20):
+        coords = coords + rng.normal(0, 0.005, coords.shape)
+        # Points wrapped back in the box
+        frac = coords.dot(inverse)
+        wrapped = (frac - np.floor(frac)).dot(box)
+
+        i, j, d = nl.update(wrapped, box)
+        pairs, distances = _sorted_pairs(np.column_stack([i, j]), d)
+        expected_pairs, expected_distances = _sorted_pairs(*neighbor_pairs(wrapped, 0.3, box))
+        npeq_(pairs, expected_pairs)
+        npeq_(distances, expected_distances)
+        assert nl.i.flags['C_CONTIGUOUS']
+
+    assert 1 < nl.n_builds < 20
+
+    # The box changes at each frame, as in a constant pressure run
+    frac = coords.dot(inverse)
+    nl = NeighborList(0.3, skin=0.1)
+    for frame in range(20):
+        frac = frac + rng.normal(0, 0.001, frac.shape)
+        scaled = box * (1 + 0.01 * np.sin(frame / 3.0))
+        scaled[2, 0] += 0.02 * np.cos(frame / 3.0)
+        wrapped = (frac - np.floor(frac)).dot(scaled)
+
+        i, j, d = nl.update(wrapped, scaled)
+        pairs, distances = _sorted_pairs(np.column_stack([i, j]), d)
+        expected_pairs, expected_distances = _sorted_pairs(*neighbor_pairs(wrapped, 0.3, scaled))
+        npeq_(pairs, expected_pairs)
+        assert np.allclose(distances, expected_distances)
+
+    assert nl.n_builds < 10
+
+    # A strong compression leaves no skin
+    n_builds = nl.n_builds
+    i, j, d = nl.update(wrapped * 0.75, scaled * 0.75)
+    assert nl.n_builds == n_builds + 1
+    npeq_(_sorted_pairs(np.column_stack([i, j]), d)[0],
+          _sorted_pairs(*neighbor_pairs(wrapped * 0.75, 0.3, scaled * 0.75))[0])
+
+    # Without periodic boundaries, a big move causes a rebuild
+    nl = NeighborList(0.3, skin=0.1)
+    nl.update(coords)
+    nl.update(coords + [0.04, 0, 0])
+    assert nl.n_builds == 1
+
+    coords[0] += 0.06
+    i, j, d = nl.update(coords)
+    assert nl.n_builds == 2
+    pairs, distances = _sorted_pairs(np.column_stack([i, j]), d)
+    npeq_(pairs, _sorted_pairs(*neighbor_pairs(coords, 0.3))[0])
+
+def test_cell_linked_list():
+    rng = np.random.RandomState(0)
+    coords = rng.uniform(0, 2.0, (1000, 3))
+    other = rng.uniform(0, 2.0, (300, 3))
+    periodic = np.array([2.0, 2.0, 2.0])
+
+    cl = CellLinkedList(coords, 0.3, periodic)
+    i, j, d = cl.query_pairs(0.3)
+    pairs, distances = _sorted_pairs(np.column_stack([i, j]), d)
+    expected_pairs, expected_distances = _sorted_pairs(*neighbor_pairs(coords, 0.3, np.diag(periodic)))
+    npeq_(pairs, expected_pairs)
+    npeq_(distances, expected_distances)
+
+    # Between two lists
+    dist = general_periodic_distance(coords[:, np.newaxis], other[np.newaxis], np.diag(periodic))
+    cl_other = CellLinkedList(other, 0.3, periodic)
+    npeq_(cl.query_ball(cl_other, 0.3).toarray(), np.where(dist <= 0.3, dist, 0))
+    npeq_(cl.count_within(cl_other, 0.3), (dist <= 0.3).sum(axis=1))
+
+    i, j, d = cl.query_pairs(0.3, cl_other)
+    npeq_(d, dist[i, j])
+    assert len(d) == (dist <= 0.3).sum()
+
+    # Several threads find the same pairs
+    i, j, d = cl.query_pairs(0.3, n_threads=3)
+    npeq_(_sorted_pairs(np.column_stack([i, j]), d)[0], expected_pairs)
+    npeq_(cl.count_within(cl_other, 0.3, n_threads=3), (dist <= 0.3).sum(axis=1))
+    assert_raises(ValueError, cl.query_pairs, 0.3, None, 0)
+
+    # Cells smaller than the distance
+    assert_raises(ValueError, cl.query_pairs, 0.5)
+
+def test_distances_within():
+    rng = np.random.RandomState(0)
+    a = rng.uniform(-1, 2, (300, 3))
+    b = rng.uniform(-1, 2, (400, 3))
+
+    for periodic in [False, np.array([3.0, 3.0, 3.0])]:
+        simple = distances_within(a, b, 0.4, periodic, method='simple')
+        cells = distances_within(a, b, 0.4, periodic, method='cell-lists')
+        npeq_(np.sort(simple), np.sort(cells))
+
+        for method in ['simple', 'cell-lists']:
+            threads = distances_within(a, b, 0.4, periodic, method=method, n_threads=3)
+            npeq_(np.sort(threads), np.sort(simple))
+
+        matrix = chemlab_distance_matrix(a, b, 0.4, periodic)
+        npeq_(chemlab_distance_matrix(a, b, 0.4, periodic, n_threads=3), matrix)
+        npeq_(np.sort(matrix[matrix.nonzero()]), np.sort(simple))
+
+    dist = np.sqrt(((a[:, np.newaxis] - b) ** 2).sum(axis=-1))
+    npeq_(overlapping_points(a, b, 0.1), np.nonzero((dist <= 0.1).any(axis=0))[0])
+
+def test_iter_distances_within():
+    rng = np.random.RandomState(0)
+    a = rng.uniform(-1, 2, (300, 3))
+    b = rng.uniform(-1, 2, (400, 3))
+
+    for periodic in [False, np.array([3.0, 3.0, 3.0])]:
+        if periodic is False:
+            dist = np.sqrt(((a[:, np.newaxis] - b) ** 2).sum(axis=-1))
+        else:
+            dist = general_periodic_distance(a[:, np.newaxis], b[np.newaxis], np.diag(periodic))
+
+        # Chunks of 50 rows
+        chunks = list(iter_distances_within(a, b, 0.4, periodic, block_size=50 * len(b)))
+        assert len(chunks) == 6
+        i, j, d = [np.concatenate(c) for c in zip(*chunks)]
+        npeq_(np.column_stack([i, j]), np.argwhere(dist <= 0.4))
+        npeq_(d, dist[i, j])
+
 def test_hashtable():
     
     ht = Int32HashTable(16)